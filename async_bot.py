@@ -0,0 +1,617 @@
+# asyncio runtime of the bot: same commands as bot.py, with handlers, title lookups,
+# OMDb search and storage running as coroutines on a single event loop
+import os
+import io
+import asyncio
+import pandas as pd
+from dotenv import load_dotenv
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+import random
+from async_utils import *
+from title_index import title_index
+
+load_dotenv()
+TOKEN = os.getenv('TOKEN')
+OWNER_ID = int(os.getenv('OWNER_ID'))
+DATABASE_URL = os.getenv('DATABASE_URL')
+SQLITE_PATH = os.getenv('SQLITE_PATH')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+LOCAL_MEM_BUDGET = int(os.getenv('LOCAL_MEM_BUDGET', 64))
+USE_POLLING = os.getenv('USE_POLLING', '').lower() in ['true', '1', 'yes']
+APP_URL = os.getenv('APP_URL')
+OMDB_KEY = os.getenv('OMDB_KEY')
+TITLE_CACHE_SIZE = int(os.getenv('TITLE_CACHE_SIZE', 1024))
+TITLE_CACHE_TTL = int(os.getenv('TITLE_CACHE_TTL', 30 * 24 * 3600))
+TITLE_WORKERS = int(os.getenv('TITLE_WORKERS', 4))
+TITLE_WAIT_TIMEOUT = float(os.getenv('TITLE_WAIT_TIMEOUT', 10))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 1024))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 24 * 3600))
+TITLE_INDEX = os.getenv('TITLE_INDEX', 'imdb_index')
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', 0.3))
+INLINE_WORKERS = int(os.getenv('INLINE_WORKERS', 4))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+COMPACT_POLLS = os.getenv('COMPACT_POLLS', 'true').lower() in ['true', '1', 'yes']
+STATUS_EDIT_DELAY = float(os.getenv('STATUS_EDIT_DELAY', 2))
+DRAW_MESSAGES = int(os.getenv('DRAW_MESSAGES', 1))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+
+bot = AsyncTeleBot(TOKEN)
+outbox = async_dispatcher(bot, chat_rate=SEND_CHAT_RATE, global_rate=SEND_GLOBAL_RATE)
+http = async_http_session()
+
+def send(chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    '''
+    Queue a message to a chat. Returns a task with the sent message.
+    '''
+    return outbox.call(chat_id, 'send_message', chat_id, text, priority=priority, **kwargs)
+
+if DATABASE_URL is not None:
+    mem = async_sql_mem(DATABASE_URL, min_connections=DB_POOL_MIN, max_connections=DB_POOL_MAX)
+    print('Using PostgreSQL database')
+elif SQLITE_PATH is not None:
+    mem = async_storage(sqlite_mem(SQLITE_PATH))
+    print('Using SQLite database')
+else:
+    mem = async_storage(local_mem(memory_budget=LOCAL_MEM_BUDGET * 2 ** 20))
+    print('Using local disk database')
+
+# offline title index, built with title_index.py
+if os.path.exists(os.path.join(TITLE_INDEX, 'titles.bin')):
+    index = title_index(TITLE_INDEX)
+    print(f'Using title index with {len(index)} titles')
+else:
+    index = None
+
+titles = async_title_cache(mem, http, max_size=TITLE_CACHE_SIZE, ttl=TITLE_CACHE_TTL, index=index)
+searches = async_search_cache(lambda query: async_omdb_search(http, OMDB_KEY, query),
+    max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+inline = async_inline_search(delay=INLINE_DEBOUNCE, max_workers=INLINE_WORKERS)
+resolver = async_title_resolver(titles, max_workers=TITLE_WORKERS)
+# movies already suggested in the chats of each user, searched before the title index and OMDb, loaded in main()
+known = known_titles()
+
+async def update_chat(update):
+    '''
+    Get the chat of an update, to process the updates of a chat in order.
+    Poll answers do not carry a chat, so it is looked up from the poll.
+    '''
+    if update.poll_answer is not None:
+        return await mem.get_chat_from_poll(update.poll_answer.poll_id)
+    for message in [update.message, update.edited_message, update.channel_post, update.edited_channel_post]:
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    for query in [update.inline_query, update.chosen_inline_result, update.callback_query]:
+        if query is not None:
+            return query.from_user.id
+    return None
+
+updates = async_update_queue(bot, update_chat, max_size=UPDATE_QUEUE_SIZE)
+
+# AsyncTeleBot has no next step handlers, so the replies asked for by /choose, /extra and /veto
+# are handled here: the next message in the chat goes to the registered handler, as in bot.py
+next_steps = {}
+
+def register_next_step_handler(message, callback, *args):
+    '''
+    Handle the next message in the chat of message with callback(reply, *args).
+    '''
+    next_steps.setdefault(str(message.chat.id), []).append((callback, args))
+
+@bot.message_handler(func=lambda message: str(message.chat.id) in next_steps,
+    content_types=['text', 'photo', 'document', 'sticker', 'audio', 'video', 'voice', 'location', 'contact'])
+async def next_step(message):
+    for callback, args in next_steps.pop(str(message.chat.id), []):
+        await callback(message, *args)
+
+def get_username(user):
+    '''
+    Get the username of a user, or their first name if they have none.
+    '''
+    username = getattr(user, 'username', None)
+    if username is None:
+        username = user.first_name
+    return username
+
+async def store_choice(chat_id, user_id, username, tt, url, title):
+    '''
+    Save choice to memory.
+    '''
+    unique_id = get_unique_id(chat_id, user_id)
+    await mem.add_choice(unique_id, user_id, chat_id, username, tt, url, title)
+    known.add(chat_id, tt, title)
+    known.add_member(user_id, chat_id)
+
+async def save_choice(chat_id, user_id, username, tt, reply):
+    '''
+    Save choice and confirm it with reply(title).
+    If the title is not cached, the choice is saved right away with the tt tag as a
+    placeholder title. The title is then resolved in the background, and both
+    the choice and the confirmation message are updated.
+    '''
+    url = imdb_url(tt)
+    markup = types.ReplyKeyboardRemove(selective=False)
+    title = await titles.get(tt)
+    if title is not None:
+        await store_choice(chat_id, user_id, username, tt, url, title)
+        send(chat_id, reply(title), reply_markup=markup)
+        return
+    await store_choice(chat_id, user_id, username, tt, url, tt)
+    confirmation = send(chat_id, reply(tt), reply_markup=markup)
+
+    async def resolved(title):
+        await mem.update_title(get_unique_id(chat_id, user_id), tt, title)
+        known.add(chat_id, tt, title)
+        try:
+            outbox.call(chat_id, 'edit_message_text', reply(title), chat_id, (await confirmation).message_id)
+        except Exception as e:
+            print(e)
+
+    resolver.submit(chat_id, tt, resolved)
+
+@bot.message_handler(commands=['start', 'help'])
+async def start(message):
+    send(message.chat.id,
+    '''
+Hi, I'm a movie poll bot! I can help you choose a movie with friends.
+These are the available commands:
+/start, /help - show this message
+/choose - suggest a movie for the poll (must be a valid IMDb url or tt tag)
+/participate - participate in the poll without suggesting a movie
+/extra - add an extra movie to the poll (not assigned to a user)
+/choices - show all current choices
+/poll - create poll
+/random - choose random movie among all choices
+/clear - clear your choice
+/clearextra - clear the extra choice
+/clearall - delete all choices
+/veto - veto one of the current choices
+''')
+
+@bot.inline_handler(lambda query: type(query.query) == str)
+async def search(query):
+    '''
+    Search for movies using OMDb API
+    '''
+    if len(query.query) < 3:
+        return
+    inline.submit(query.from_user.id, lambda: search_titles(query.from_user.id, query.query, query.offset),
+        lambda search: answer_search(query, *search))
+
+async def search_titles(user_id, query, offset=''):
+    '''
+    Search movies already suggested in the chats of the user, then in the title index, or on OMDb if the index has none.
+    Returns the results and the offset of the next page. Suggested movies fill the first page on their own,
+    the others are only searched for when the next page is asked for.
+    '''
+    local = known.search(user_id, query)
+    if offset == '' and len(local) > 0:
+        return local, 'more'
+    search = index.search(query) if index is not None else []
+    if len(search) == 0:
+        search = await searches.get(query)
+    local_tts = set(movie['imdb_id'] for movie in local)
+    return [movie for movie in search if movie['imdb_id'] not in local_tts], ''
+
+async def answer_search(query, search, next_offset=''):
+    '''
+    Answer inline query with search results.
+    '''
+    answers = []
+    for i in range(min(10, len(search))):
+        title = search[i]['title'] + (f' ({search[i]["year"]})' if search[i]['year'] else '')
+        answers.append(types.InlineQueryResultArticle(
+            id=search[i]['imdb_id'],
+            title=title,
+            input_message_content=types.InputTextMessageContent(
+                message_text='/choose ' + imdb_url(search[i]['imdb_id']))))
+
+    # results start with the movies suggested in the chats of the user, so telegram must not share them
+    await bot.answer_inline_query(query.id, answers, cache_time=300, is_personal=True,
+        next_offset=next_offset)
+
+async def ask_choice(message, callback):
+    '''
+    Ask for a choice in a reply, to be handled by callback.
+    '''
+    markup = types.ForceReply(selective=False)
+    get_reply = await send(message.chat.id, "Please, enter a choice:", \
+        reply_markup=markup, reply_to_message_id=message.message_id)
+    register_next_step_handler(get_reply, callback, True)
+
+@bot.message_handler(commands=['choose'])
+async def choose(message, ignore_size=False):
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    if ignore_size:
+        user_input = message.text or ''
+    else:
+        user_input = message.text.split(' ', 1)
+        if len(user_input) <= 1:
+            await ask_choice(message, choose)
+            return
+        user_input = user_input[1]
+    tt = get_tt(user_input)
+    if tt is not None:
+        username = get_username(message.from_user)
+        await save_choice(chat_id, user_id, username, tt,
+            lambda title: f'Saved choice {title} for user {username}')
+    elif ignore_size:
+        markup = types.ReplyKeyboardRemove(selective=False)
+        send(chat_id, "No valid IMDb url or tt tag detected.", reply_markup=markup)
+
+@bot.message_handler(commands=['choosedummy'])
+async def choosedummy(message):
+    if message.from_user.id in [OWNER_ID]:
+        title = await titles.resolve(DUMMY_TT)
+        await store_choice(message.chat.id, DUMMY_USER_ID, DUMMY_USERNAME, DUMMY_TT, imdb_url(DUMMY_TT), title)
+        send(message.chat.id, f'Saved choice {title} for user {DUMMY_USERNAME}')
+    else:
+        send(message.chat.id, "You do not possess that kind of power.")
+
+@bot.message_handler(commands=['participate'])
+async def participate(message):
+    chat_id = message.chat.id
+    username = get_username(message.from_user)
+    await store_choice(chat_id, message.from_user.id, username, None, None, None)
+    send(chat_id, f'Added user {username} to participate')
+
+@bot.message_handler(commands=['extra'])
+async def extra(message, ignore_size=False):
+    chat_id = message.chat.id
+    if ignore_size:
+        user_input = message.text or ''
+    else:
+        user_input = message.text.split(' ', 1)
+        if len(user_input) <= 1:
+            await ask_choice(message, extra)
+            return
+        user_input = user_input[1]
+    tt = get_tt(user_input)
+    if tt is not None:
+        await save_choice(chat_id, EXTRA_USER_ID, 'Extra choice', tt, lambda title: f'Saved extra choice {title}.')
+    elif ignore_size:
+        markup = types.ReplyKeyboardRemove(selective=False)
+        send(chat_id, "No valid IMDb url or tt tag detected.", reply_markup=markup)
+
+@bot.message_handler(commands=['choices'])
+async def display_choices(message):
+    chat_id = message.chat.id
+    rows = await mem.get_choices(chat_id)
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
+    else:
+        choices = []
+        for row in rows:
+            if row[6] is not None:
+                choices.append(f'{row[3]}: {row[6]}')
+            else:
+                choices.append(f'{row[3]}: no suggestion')
+        send(chat_id, 'Current participants:\n' + '\n'.join(choices))
+
+@bot.message_handler(commands=['clear'])
+async def clear_choice(message):
+    chat_id = message.chat.id
+    if await mem.delete_choice(get_unique_id(chat_id, message.from_user.id)):
+        send(chat_id, 'Cleared choice for user 'f'{get_username(message.from_user)}')
+    else:
+        send(chat_id, 'No choice found.')
+
+@bot.message_handler(commands=['clearextra'])
+async def clear_extra(message):
+    chat_id = message.chat.id
+    if await mem.delete_choice(get_unique_id(chat_id, 0)):
+        send(chat_id, 'Extra choice deleted.')
+    else:
+        send(chat_id, 'No extra choice found.')
+
+@bot.message_handler(commands=['clearall'])
+async def clear_choices(message):
+    chat_id = message.chat.id
+    if await mem.delete_all_choices(chat_id):
+        send(chat_id, 'All choices cleared.')
+    else:
+        send(chat_id, 'No choices found.')
+
+@bot.message_handler(commands=['veto'])
+async def veto(message):
+    chat_id = message.chat.id
+    rows = await mem.get_choices(chat_id)
+    vetoable = [row[6] for row in rows if row[6] is not None]
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
+    elif len(vetoable) == 0:
+        send(chat_id, "No choices to veto.")
+    else:
+        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+        markup.add(*vetoable)
+        markup.add('Cancel')
+        get_reply = await send(chat_id, 'Which choice do you want to veto?', reply_markup=markup)
+        register_next_step_handler(get_reply, veto_choice)
+
+async def veto_choice(message):
+    chat_id = message.chat.id
+    markup = types.ReplyKeyboardRemove(selective=False)
+    if message.text == 'Cancel':
+        send(chat_id, 'No movie vetoed.', reply_markup=markup)
+        return
+    if await mem.delete_by_title(chat_id, message.text):
+        send(chat_id, 'Vetoed ' + message.text, reply_markup=markup)
+    else:
+        send(chat_id, 'Something went wrong. No changes were made.', reply_markup=markup)
+
+@bot.message_handler(commands=['deletemaindatabase', 'deleteresultsdatabase', 'deleteprefsdatabase'])
+async def reset_memory(message):
+    if message.from_user.id not in [OWNER_ID]:
+        send(message.chat.id, 'You do not possess that kind of power.')
+    elif message.text.startswith('/deletemaindatabase'):
+        await mem.reset_database()
+        known.reload(await mem.get_stored_titles(), await mem.get_chat_members())
+        send(message.chat.id, 'Bot memory reinitialized.')
+    elif message.text.startswith('/deleteresultsdatabase'):
+        await mem.reset_results()
+        known.reload(await mem.get_stored_titles(), await mem.get_chat_members())
+        send(message.chat.id, 'Results database reinitialized.')
+    else:
+        await mem.reset_prefs()
+        send(message.chat.id, 'Preferences database reinitialized.')
+
+@bot.message_handler(commands=['stats'])
+async def stats(message):
+    if message.from_user.id in [OWNER_ID]:
+        lines = [f'titles: {titles.stats()}', f'searches: {searches.stats()}', f'known: {known.stats()}',
+            f'inline: {inline.stats()}', f'outbox: {outbox.stats()}', f'status: {status.stats()}',
+            f'updates: {updates.stats()}']
+        if index is not None:
+            lines.append(f'index: {index.stats()}')
+        for host, host_stats in http.stats().items():
+            lines.append(f'{host}: {host_stats}')
+        send(message.chat.id, '\n'.join(lines))
+    else:
+        send(message.chat.id, 'You do not possess that kind of power.')
+
+async def render_status(chat_id):
+    '''
+    Text of the status message of a poll: votes so far and participants still to vote.
+    '''
+    voted = set(str(row[0]) for row in await mem.get_votes(chat_id))
+    participants = [row for row in await mem.get_choices(chat_id) if str(row[1]) not in NON_VOTING_USER_IDS]
+    waiting = [row[3] for row in participants if str(row[1]) not in voted]
+    text = f'Poll created. Votes: {len(participants) - len(waiting)}/{len(participants)}'
+    if len(waiting) > 0:
+        return text + '\nWaiting for: ' + ', '.join(waiting)
+    return text + '\nAll votes are in!'
+
+status = async_poll_status(outbox, render_status, delay=STATUS_EDIT_DELAY)
+
+@bot.message_handler(commands=['poll'])
+async def poll(message):
+    chat_id = message.chat.id
+    if not await resolver.wait(chat_id, timeout=TITLE_WAIT_TIMEOUT):
+        send(chat_id, 'Some titles could not be found in time. Using IMDb tags instead.', priority=PRIORITY_HIGH)
+    rows = await mem.get_choices(chat_id)
+    titles = [row[6] for row in rows if row[6] is not None]
+    tts = [row[4] for row in rows if row[4] is not None]
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
+    elif len(titles) < 2:
+        send(chat_id, 'You need to have at least two choices to create a poll.')
+    else:
+        if COMPACT_POLLS:
+            listing = [f'{row[6]}: {row[5]}' for row in rows if row[6] is not None]
+            send(chat_id, 'Creating poll... Here are the choices:\n' + '\n'.join(listing),
+                disable_web_page_preview=True, priority=PRIORITY_HIGH)
+        else:
+            send(chat_id, 'Creating poll... Here are the choices:', priority=PRIORITY_HIGH)
+            for row in rows:
+                if row[6] is not None:
+                    send(chat_id, f'{row[6]}: {row[5]}', disable_notification=True, priority=PRIORITY_HIGH)
+        poll = await outbox.call(chat_id, 'send_poll', chat_id, random.choice(vote_lines),
+            titles, is_anonymous=False, priority=PRIORITY_HIGH)
+        await mem.add_poll(chat_id, poll.poll.id, poll.message_id, titles, tts)
+        # counted like polls_count, which is only saved with results enabled
+        if await mem.results_enabled(chat_id):
+            for tt, title in zip(tts, titles):
+                known.add(chat_id, tt, title, polls=1)
+        if COMPACT_POLLS:
+            await status.start(chat_id, priority=PRIORITY_HIGH)
+        else:
+            send(chat_id, 'Poll created.', priority=PRIORITY_HIGH)
+
+@bot.message_handler(commands=['fakepoll'])
+async def fakepoll(message):
+    if message.from_user.id in [OWNER_ID]:
+        titles = ['The Godfather', 'Forrest Gump', 'The Shawshank Redemption']
+        tts = ['tt0068646', 'tt0109830', 'tt0111161']
+        poll = await outbox.call(message.chat.id, 'send_poll', message.chat.id, random.choice(vote_lines),
+            titles, is_anonymous=False, priority=PRIORITY_HIGH)
+        await mem.add_poll(message.chat.id, poll.poll.id, poll.message_id, titles, tts)
+    else:
+        send(message.chat.id, 'You do not possess that kind of power.')
+
+def send_draw(chat_id, intro, rerolls, result):
+    '''
+    Announce a random draw and its rerolls, in at most DRAW_MESSAGES messages.
+    '''
+    parts = [intro]
+    for i in range(1, rerolls + 1):
+        parts.append(f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
+            f'Thats the {ordinal(i)} reroll.')
+    parts.append(result)
+    for text in group_messages(parts, DRAW_MESSAGES):
+        send(chat_id, text, priority=PRIORITY_HIGH)
+
+@bot.poll_answer_handler()
+async def poll_complete(pollAnswer):
+    username = get_username(pollAnswer.user)
+    poll = await mem.get_active_poll(pollAnswer.poll_id)
+    if poll is None:
+        return
+    chat_id, poll_msg_id = poll
+    user_id = pollAnswer.user.id
+    known.add_member(user_id, chat_id)
+    if len(pollAnswer.option_ids) == 0:
+        counts, complete = await mem.vote(chat_id, user_id, None)
+        if not COMPACT_POLLS:
+            send(chat_id, f'User {username} has retracted their vote.', priority=PRIORITY_LOW)
+    else:
+        counts, complete = await mem.vote(chat_id, user_id, pollAnswer.option_ids[0])
+        if not COMPACT_POLLS:
+            send(chat_id, f'User {username} has voted.', priority=PRIORITY_LOW)
+    if COMPACT_POLLS:
+        if complete:
+            await status.stop(chat_id)
+        else:
+            status.update(chat_id)
+    if complete:
+        winners = top_titles(counts)
+        if len(winners) == 1:
+            winner = winners[0]
+            send(chat_id, f'Poll complete! Winner: {winner}', priority=PRIORITY_HIGH)
+        else:
+            reroll_chance, rerolls, winner = simulate_draw(winners)
+            send_draw(chat_id, f'{random.choice(exclamations)} '\
+                f'There is a tie!\nChoosing random option. Reroll chance: '\
+                    f'{reroll_chance:.2f}%', rerolls,
+                f'Poll complete! Random winner after poll tie: {winner}')
+        await mem.results_win(chat_id, winner)
+        outbox.call(chat_id, 'stop_poll', chat_id, poll_msg_id, priority=PRIORITY_HIGH)
+        await mem.end_poll(chat_id)
+
+@bot.message_handler(commands=['random'])
+async def random_choice(message):
+    chat_id = message.chat.id
+    choices = [row[6] for row in await mem.get_choices(chat_id) if row[6] is not None]
+    if len(choices) == 0:
+        send(chat_id, 'No choices have been made.')
+        return
+    elif len(choices) == 1:
+        send(chat_id, 'You need to have at least two options to choose from.')
+        return
+    reroll_chance, rerolls, winner = simulate_draw(choices)
+    await mem.results_win(chat_id, winner)
+    send_draw(chat_id, f'Choosing random option. Reroll chance: {reroll_chance:.2f}%.', rerolls,
+        f'Random winner: {winner}')
+    await mem.end_poll(chat_id)
+
+@bot.message_handler(commands=['enableresults'])
+async def enable_results(message):
+    chat_id = message.chat.id
+    if await mem.enable_results(chat_id):
+        send(chat_id, 'Results history enabled. Use /results to view.')
+    else:
+        send(chat_id, 'Results history was already enabled. Use /results to view.')
+
+@bot.message_handler(commands=['disableresults'])
+async def disable_results(message):
+    chat_id = message.chat.id
+    if await mem.disable_results(chat_id):
+        send(chat_id, 'Results history disabled. '
+            'Remember to clear results history with /clearhistory, if desired.')
+    else:
+        send(chat_id, 'Results history was already disabled. '
+            'Remember to clear results history with /clearhistory, if desired.')
+
+@bot.message_handler(commands=['clearresults'])
+async def clear_results(message):
+    chat_id = message.chat.id
+    if await mem.clear_results(chat_id):
+        known.clear_polls(chat_id)
+        send(chat_id, 'Results history cleared. ')
+    else:
+        send(chat_id, 'Results history was already cleared.')
+
+def results_file(results):
+    '''
+    Write results to an Excel file in memory.
+    '''
+    df = pd.DataFrame()
+    df['tt'] = [row[2] for row in results]
+    df['url'] = [row[3] for row in results]
+    df['title'] = [row[4] for row in results]
+    df['polls_count'] = [row[5] for row in results]
+    df['votes_count'] = [row[6] for row in results]
+    df['wins_count'] = [row[7] for row in results]
+    df['last_poll'] = [row[8] for row in results]
+    df['last_win'] = [row[9] for row in results]
+    file_obj = io.BytesIO()
+    df.to_excel(file_obj, index=False)
+    file_obj.name = "results.xlsx"
+    file_obj.seek(0)
+    return file_obj
+
+@bot.message_handler(commands=['results'])
+async def results(message):
+    chat_id = message.chat.id
+    results = await mem.get_results(chat_id)
+    if len(results) == 0:
+        send(chat_id, 'No results saved in history for this chat.')
+        return
+    # writing the file is CPU bound, so it runs on a worker thread
+    file_obj = await asyncio.to_thread(results_file, results)
+    outbox.call(chat_id, 'send_document', chat_id, file_obj, priority=PRIORITY_HIGH)
+    send(chat_id, 'Results history uploaded.', priority=PRIORITY_HIGH)
+
+async def get_message(request):
+    '''
+    Webhook endpoint: check and queue the update, and answer right away.
+    '''
+    if WEBHOOK_SECRET is not None and \
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403, text='Forbidden')
+    try:
+        update = types.Update.de_json(await request.text())
+    except Exception:
+        update = None
+    if update is None:
+        return web.Response(status=400, text='Bad request')
+    # telegram sends the update again later when the queue is full
+    if not await updates.put(update):
+        return web.Response(status=503, text='Busy')
+    return web.Response(text='!')
+
+async def health(request):
+    return web.Response(text='!')
+
+async def poll_updates():
+    '''
+    Get updates by long polling, and queue them.
+    '''
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            for update in await bot.get_updates(offset=offset, timeout=20):
+                await updates.put(update, block=True)
+                offset = update.update_id + 1
+        except Exception as e:
+            print(e)
+            await asyncio.sleep(1)
+
+async def main():
+    if isinstance(mem, async_sql_mem):
+        await mem.connect()
+    known.reload(await mem.get_stored_titles(), await mem.get_chat_members())
+    if USE_POLLING:
+        print('Using polling')
+        await poll_updates()
+        return
+    print('Using webhook')
+    # a single connection makes telegram deliver updates in order
+    await bot.set_webhook(url=APP_URL+TOKEN, secret_token=WEBHOOK_SECRET, max_connections=1)
+    app = web.Application()
+    app.router.add_get('/', health)
+    app.router.add_post('/' + TOKEN, get_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', int(os.environ.get('PORT', 5000))).start()
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    asyncio.run(main())
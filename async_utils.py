@@ -0,0 +1,890 @@
+import asyncio
+import codecs
+import itertools
+import random
+import re
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import aiohttp
+from utils import *
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+class async_http_session:
+    '''
+    Shared aiohttp session for all outbound lookups (IMDb and OMDb) in the asyncio runtime.
+    Same behaviour as http_session: limits concurrent connections per host,
+    applies connect/read timeouts, retries failed GETs with jittered exponential
+    backoff and records latency metrics per host.
+    '''
+    retry_status = http_session.retry_status
+    record = http_session.record
+    stats = http_session.stats
+
+    def __init__(self, max_per_host=4, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.5):
+        self.max_per_host = max_per_host
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.metrics = defaultdict(lambda: {
+            'requests': 0, 'errors': 0, 'retries': 0, 'latencies': deque(maxlen=1000)})
+        self.metrics_lock = threading.Lock()
+
+    def get_session(self):
+        '''
+        Get the aiohttp session, created on first use inside the event loop.
+        '''
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_per_host), timeout=self.timeout)
+        return self.session
+
+    @asynccontextmanager
+    async def get(self, url, **kwargs):
+        '''
+        GET url, for use in an async with statement. Yields the response.
+        '''
+        host = urlparse(url).hostname
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = await self.get_session().get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.record(host, time.perf_counter() - start, True, attempt > 0)
+                if attempt == self.retries:
+                    raise
+            else:
+                failed = response.status in self.retry_status
+                self.record(host, time.perf_counter() - start, failed, attempt > 0)
+                if not failed or attempt == self.retries:
+                    try:
+                        yield response
+                    finally:
+                        response.release()
+                    return
+                response.release()
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+async def async_get_title_stream(http, url, max_bytes=2 ** 21):
+    '''
+    Get title from url without downloading or parsing the whole page, like get_title_stream.
+    '''
+    async with http.get(url, headers = {"Accept-Language": "en-US", 'User-Agent': 'Mozilla/5.0'}) as response:
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        parser = title_parser()
+        read = 0
+        async for chunk in response.content.iter_chunked(2 ** 14):
+            parser.feed(decoder.decode(chunk))
+            read += len(chunk)
+            if parser.done or read >= max_bytes:
+                break
+        return parser.get_title()
+
+async def async_omdb_search(http, apikey, query):
+    '''
+    Search movies on OMDb. Returns dicts with title, year and imdb_id, like OMDBClient.search,
+    and whether they are every match for the query, like omdb_search.
+    '''
+    async with http.get('https://www.omdbapi.com/', params={'apikey': apikey, 's': query}) as response:
+        data = await response.json(content_type=None)
+    results = [{'title': movie['Title'], 'year': movie['Year'], 'imdb_id': movie['imdbID']}
+        for movie in data.get('Search', [])]
+    if data.get('Response') == 'True':
+        complete = int(data.get('totalResults', 0)) <= len(results)
+    else:
+        complete = data.get('Error') == 'Movie not found!'
+    return results, complete
+
+class async_search_cache(search_cache):
+    '''
+    search_cache for the asyncio runtime, with search a coroutine function.
+    Concurrent searches for the same query share a single OMDb request.
+    '''
+
+    async def get(self, query):
+        '''
+        Get search results for query, from cache if possible. Otherwise, search OMDb.
+        '''
+        query = normalize_query(query)
+        with self.lock:
+            results = self.lookup(query)
+            if results is not None:
+                return results
+            task = self.searching.get(query)
+            if task is None:
+                self.misses += 1
+                task = asyncio.ensure_future(self.fetch(query))
+                self.searching[query] = task
+                task.add_done_callback(lambda task: self.searching.pop(query, None))
+            else:
+                self.shared += 1
+        return await asyncio.shield(task)
+
+    async def fetch(self, query):
+        '''
+        Search OMDb for a normalized query and cache the results.
+        '''
+        results, complete = await self.search(query)
+        with self.lock:
+            self.save(query, results, complete)
+        return results
+
+class async_title_cache(title_cache):
+    '''
+    title_cache for the asyncio runtime, backed by an async bot memory.
+    Concurrent lookups of the same title share a single IMDb request.
+    '''
+
+    def __init__(self, mem, http, max_size=1024, ttl=30 * 24 * 3600, index=None):
+        super().__init__(mem, max_size=max_size, ttl=ttl, index=index)
+        self.http = http
+        self.resolving = {}
+
+    async def get(self, tt):
+        '''
+        Get cached title for tt. Returns None if not cached or expired.
+        '''
+        now = time.time()
+        with self.lock:
+            if tt in self.titles:
+                title, cached_at = self.titles[tt]
+                if now - cached_at < self.ttl:
+                    self.titles.move_to_end(tt)
+                    self.hits += 1
+                    return title
+                del self.titles[tt]
+        cached = await self.mem.get_cached_title(tt)
+        if cached is not None:
+            title, cached_at = cached
+            if now - cached_at < self.ttl:
+                self.remember(tt, title, cached_at)
+                with self.lock:
+                    self.store_hits += 1
+                return title
+        # the index has the original titles, so titles already saved from IMDb come first
+        if self.index is not None:
+            title = self.index.get(tt)
+            if title is not None:
+                self.remember(tt, title, now)
+                with self.lock:
+                    self.index_hits += 1
+                return title
+        with self.lock:
+            self.misses += 1
+        return None
+
+    async def put(self, tt, title):
+        '''
+        Save title in cache and in the bot memory.
+        '''
+        cached_at = time.time()
+        self.remember(tt, title, cached_at)
+        await self.mem.cache_title(tt, title, cached_at)
+
+    async def resolve(self, tt):
+        '''
+        Get title for tt, from cache if possible. Otherwise, get it from IMDb.
+        '''
+        title = await self.get(tt)
+        if title is not None:
+            return title
+        task = self.resolving.get(tt)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch(tt))
+            self.resolving[tt] = task
+            task.add_done_callback(lambda task: self.resolving.pop(tt, None))
+        return await asyncio.shield(task)
+
+    async def fetch(self, tt):
+        title = await async_get_title_stream(self.http, imdb_url(tt))
+        await self.put(tt, title)
+        return title
+
+class async_title_resolver:
+    '''
+    Resolve movie titles in background tasks, at most max_workers at a time.
+    Pending resolutions are tracked per chat, so that they can be waited for.
+    '''
+
+    def __init__(self, titles, max_workers=4):
+        self.titles = titles
+        self.max_workers = max_workers
+        # created in the event loop, on first use
+        self.slots = None
+        self.pending = defaultdict(set)
+
+    def submit(self, chat_id, tt, callback):
+        '''
+        Resolve title for tt in the background, then await callback(title).
+        '''
+        task = asyncio.ensure_future(self.run(tt, callback))
+        self.pending[chat_id].add(task)
+        task.add_done_callback(lambda task: self.done(chat_id, task))
+        return task
+
+    async def run(self, tt, callback):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        try:
+            async with self.slots:
+                title = await self.titles.resolve(tt)
+        except Exception as e:
+            print(f'Could not resolve title for {tt}: {e}')
+            return
+        await callback(title)
+
+    def done(self, chat_id, task):
+        self.pending[chat_id].discard(task)
+        if len(self.pending[chat_id]) == 0:
+            del self.pending[chat_id]
+
+    async def wait(self, chat_id, timeout=None):
+        '''
+        Wait for pending resolutions in a chat.
+        Returns True if all are done, False if timed out.
+        '''
+        tasks = set(self.pending.get(chat_id, ()))
+        if len(tasks) == 0:
+            return True
+        _, not_done = await asyncio.wait(tasks, timeout=timeout)
+        return len(not_done) == 0
+
+class async_inline_search:
+    '''
+    inline_search for the asyncio runtime: a task per user answers their newest inline query,
+    at most max_workers lookups at a time. A newer query cancels the task of the previous one,
+    whether it is waiting for the delay, for a slot or for the lookup.
+    '''
+    stats = inline_search.stats
+
+    def __init__(self, delay=0.3, max_workers=4):
+        self.delay = delay
+        self.max_workers = max_workers
+        # created in the event loop, on first use
+        self.slots = None
+        self.latest = {}
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.debounced = 0
+        self.dropped = 0
+        self.answered = 0
+        self.errors = 0
+
+    def submit(self, user_id, lookup, answer):
+        '''
+        Make query of user_id the newest: await lookup() after the delay, then answer(result).
+        '''
+        self.submitted += 1
+        task = self.latest.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        task = asyncio.ensure_future(self.run(user_id, lookup, answer))
+        self.latest[user_id] = task
+        task.add_done_callback(lambda task: self.done(user_id, task))
+        return task
+
+    async def run(self, user_id, lookup, answer):
+        '''
+        Look up and answer a query, unless cancelled by a newer one.
+        '''
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.debounced += 1
+            raise
+        try:
+            async with self.slots:
+                result = await lookup()
+        except asyncio.CancelledError:
+            self.dropped += 1
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f'Could not answer inline query: {e}')
+            return
+        try:
+            await answer(result)
+        except Exception as e:
+            self.errors += 1
+            print(f'Could not answer inline query: {e}')
+            return
+        self.answered += 1
+
+    def done(self, user_id, task):
+        if self.latest.get(user_id) is task:
+            del self.latest[user_id]
+
+class async_dispatcher:
+    '''
+    Outgoing bot API calls in the asyncio runtime, with the limits of message_dispatcher:
+    token buckets keep each chat under chat_rate calls per second and the bot under global_rate,
+    and calls answered with 429 Too Many Requests are retried after retry_after seconds.
+    Calls to a chat are made one at a time, in the order they were made.
+    priority is accepted for the same signature as message_dispatcher.call, but does not reorder calls.
+    '''
+
+    def __init__(self, bot, chat_rate=1.0, chat_burst=3, global_rate=30.0, global_burst=30, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = token_bucket(global_rate, global_burst)
+        self.buckets = {}
+        self.locks = {}
+        self.waiting = {}
+        self.sent = 0
+        self.retries = 0
+        self.errors = 0
+
+    def call(self, chat_id, method, *args, priority=PRIORITY_NORMAL, **kwargs):
+        '''
+        Queue a call to bot.method(*args, **kwargs), counted against the limits of chat_id.
+        Returns a task with the result.
+        '''
+        chat_id = str(chat_id)
+        if chat_id not in self.locks:
+            self.locks[chat_id] = asyncio.Lock()
+            self.waiting[chat_id] = 0
+        self.waiting[chat_id] += 1
+        return asyncio.ensure_future(self.send(chat_id, method, args, kwargs))
+
+    async def send(self, chat_id, method, args, kwargs):
+        '''
+        Make a call once the chat is free and within the limits, retrying it after 429 errors.
+        '''
+        try:
+            async with self.locks[chat_id]:
+                for attempt in range(self.max_retries + 1):
+                    await self.take(chat_id)
+                    try:
+                        result = await getattr(self.bot, method)(*args, **kwargs)
+                    except Exception as e:
+                        wait_time = retry_after(e)
+                        if wait_time is None or attempt == self.max_retries:
+                            self.errors += 1
+                            print(e)
+                            raise
+                        self.retries += 1
+                        await asyncio.sleep(wait_time)
+                        continue
+                    self.sent += 1
+                    return result
+        finally:
+            self.waiting[chat_id] -= 1
+            if self.waiting[chat_id] == 0:
+                del self.waiting[chat_id]
+                del self.locks[chat_id]
+
+    async def take(self, chat_id):
+        '''
+        Wait until a call to the chat is within the limits, and count it.
+        '''
+        if chat_id not in self.buckets:
+            self.prune()
+            self.buckets[chat_id] = token_bucket(self.chat_rate, self.chat_burst)
+        while True:
+            now = time.monotonic()
+            wait_time = max(self.buckets[chat_id].wait_time(now), self.global_bucket.wait_time(now))
+            if wait_time == 0:
+                self.buckets[chat_id].take(now)
+                self.global_bucket.take(now)
+                return
+            await asyncio.sleep(wait_time)
+
+    def prune(self):
+        '''
+        Forget rate limits of idle chats, when there are many.
+        '''
+        if len(self.buckets) < 4096:
+            return
+        now = time.monotonic()
+        for chat_id in list(self.buckets):
+            if chat_id not in self.waiting and self.buckets[chat_id].full(now):
+                del self.buckets[chat_id]
+
+    def stats(self):
+        '''
+        Get queued calls and counters.
+        '''
+        return {
+            'queued': sum(self.waiting.values()),
+            'chats_waiting': len(self.waiting),
+            'max_chat_depth': max(self.waiting.values(), default=0),
+            'sent': self.sent,
+            'retries': self.retries,
+            'errors': self.errors
+        }
+
+class async_poll_status:
+    '''
+    poll_status for the asyncio runtime: a single status message per poll, edited as votes arrive.
+    Edits are debounced: votes within delay seconds of the first one are shown by a single edit.
+    render(chat_id) is a coroutine returning the text of the status message of a chat.
+    '''
+
+    def __init__(self, outbox, render, delay=2.0):
+        self.outbox = outbox
+        self.render = render
+        self.delay = delay
+        self.messages = {}
+        self.timers = {}
+        self.edits = 0
+        self.skipped = 0
+
+    async def start(self, chat_id, priority=PRIORITY_NORMAL):
+        '''
+        Send the status message of a new poll.
+        '''
+        chat_id = str(chat_id)
+        self.cancel(chat_id)
+        await self.send(chat_id, await self.render(chat_id), priority)
+
+    async def send(self, chat_id, text, priority=PRIORITY_NORMAL):
+        try:
+            message = await self.outbox.call(chat_id, 'send_message', chat_id, text, priority=priority)
+            self.messages[chat_id] = (message.message_id, text)
+        except Exception as e:
+            print(f'Could not send poll status: {e}')
+            self.messages.pop(chat_id, None)
+
+    def update(self, chat_id):
+        '''
+        Schedule an edit of the status message, unless one is already scheduled.
+        '''
+        chat_id = str(chat_id)
+        if chat_id in self.timers:
+            self.skipped += 1
+            return
+        self.timers[chat_id] = asyncio.get_running_loop().call_later(
+            self.delay, lambda: asyncio.ensure_future(self.flush(chat_id)))
+
+    def cancel(self, chat_id):
+        timer = self.timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def flush(self, chat_id, final=False):
+        '''
+        Edit the status message to show the current state of the poll.
+        If the message is unknown (e.g. after a restart), a new one is sent, unless final.
+        With final, the message is forgotten afterwards.
+        '''
+        self.timers.pop(chat_id, None)
+        text = await self.render(chat_id)
+        state = self.messages.get(chat_id)
+        if state is None:
+            if not final:
+                await self.send(chat_id, text)
+            return
+        message_id, old_text = state
+        # telegram rejects edits that do not change the message
+        if text != old_text:
+            self.outbox.call(chat_id, 'edit_message_text', text, chat_id, message_id)
+            self.edits += 1
+        if final:
+            self.messages.pop(chat_id, None)
+        else:
+            self.messages[chat_id] = (message_id, text)
+
+    async def stop(self, chat_id):
+        '''
+        Show the final state of the poll right away, and forget its status message.
+        '''
+        chat_id = str(chat_id)
+        self.cancel(chat_id)
+        await self.flush(chat_id, final=True)
+
+    def stats(self):
+        return {'scheduled': len(self.timers), 'edits': self.edits, 'merged': self.skipped}
+
+class async_update_queue:
+    '''
+    Incoming updates in the asyncio runtime, processed in order within a chat and concurrently across chats.
+    Each chat with queued updates has a task that processes them one at a time.
+    key(update) is a coroutine returning the chat of an update, compared as a string.
+    put returns False when max_size updates are queued, so that the webhook can ask Telegram to send it later.
+    '''
+
+    def __init__(self, bot, key, max_size=1000):
+        self.bot = bot
+        self.key = key
+        self.max_size = max_size
+        self.queues = {}
+        self.tasks = set()
+        self.size = 0
+        self.room = None
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def put(self, update, block=False):
+        '''
+        Queue an update. Returns False if the queue is full.
+        With block, waits for room in the queue instead.
+        '''
+        try:
+            key = await self.key(update)
+        except Exception as e:
+            print(e)
+            key = None
+        # chat ids are numbers in messages, but strings when read from the bot memory (poll answers)
+        if key is not None:
+            key = str(key)
+        if self.room is None:
+            self.room = asyncio.Condition()
+        if self.size >= self.max_size:
+            if not block:
+                self.rejected += 1
+                return False
+            async with self.room:
+                await self.room.wait_for(lambda: self.size < self.max_size)
+        self.size += 1
+        if key in self.queues:
+            self.queues[key].append(update)
+        else:
+            self.queues[key] = deque([update])
+            task = asyncio.ensure_future(self.run(key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def run(self, key):
+        '''
+        Process the updates of a chat, one at a time, until there are none left.
+        '''
+        pending = self.queues[key]
+        while len(pending) > 0:
+            try:
+                await self.bot.process_new_updates([pending[0]])
+                self.processed += 1
+            except Exception as e:
+                print(e)
+                self.errors += 1
+            pending.popleft()
+            self.size -= 1
+            async with self.room:
+                self.room.notify_all()
+        del self.queues[key]
+
+    def stats(self):
+        return {'queued': self.size, 'chats_waiting': len(self.queues), 'processed': self.processed,
+            'rejected': self.rejected, 'errors': self.errors}
+
+class async_storage:
+    '''
+    Async interface to a storage (local_mem, sqlite_mem, sql_mem, ...):
+    every method becomes a coroutine that runs the storage method on a worker thread.
+    PostgreSQL has async_sql_mem instead, which is not bound by the threads of the executor.
+    '''
+
+    def __init__(self, mem):
+        self.mem = mem
+
+    def __getattr__(self, name):
+        method = getattr(self.mem, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+def numbered(statement):
+    '''
+    Turn the %s placeholders of sql_statements into the $1, $2, ... placeholders of asyncpg.
+    '''
+    if isinstance(statement, list):
+        return [numbered(s) for s in statement]
+    count = itertools.count(1)
+    return re.sub('%s', lambda match: f'${next(count)}', statement)
+
+def row_count(status):
+    '''
+    Number of rows changed by a statement, from its asyncpg status (e.g. "DELETE 3").
+    '''
+    count = status.split()[-1]
+    return int(count) if count.isdigit() else 0
+
+class async_sql_mem:
+    '''
+    Bot "memory" on PostgreSQL for the asyncio runtime, with asyncpg.
+    Runs the same statements and migrations as sql_mem, from sql_statements and migrations.
+    Call connect() in the event loop before use.
+    '''
+    statements = {name: numbered(statement) for name, statement in sql_statements.items()}
+
+    def __init__(self, DATABASE_URL, min_connections=1, max_connections=10):
+        if asyncpg is None:
+            raise RuntimeError('The asyncio runtime needs asyncpg for PostgreSQL. Install it with pip install asyncpg.')
+        self.DATABASE_URL = DATABASE_URL
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.pool = None
+
+    async def connect(self):
+        '''
+        Create connection pool and apply pending schema migrations.
+        '''
+        self.pool = await asyncpg.create_pool(
+            self.DATABASE_URL, min_size=self.min_connections, max_size=self.max_connections)
+        await self.initialize_database()
+
+    async def close(self):
+        '''
+        Close all connections of the pool.
+        '''
+        await self.pool.close()
+
+    async def initialize_database(self, force=False):
+        '''
+        Apply pending schema migrations, like sql_mem.initialize_database.
+        '''
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                # only one bot process migrates at a time
+                await connection.execute(self.statements['lock_schema'], schema_lock_id)
+                await connection.execute(self.statements['create_schema_version'])
+                current = 0 if force else await connection.fetchval(self.statements['get_schema_version'])
+                for version, statements in migrations:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        await connection.execute(statement)
+                    await connection.execute(self.statements['set_schema_version'], version)
+
+    async def fetch(self, name, *args):
+        '''
+        Run a statement. Returns its rows as tuples.
+        '''
+        rows = await self.pool.fetch(self.statements[name], *args)
+        return [tuple(row) for row in rows]
+
+    async def fetchrow(self, name, *args):
+        '''
+        Run a statement. Returns its first row as a tuple, or None if there are no rows.
+        '''
+        row = await self.pool.fetchrow(self.statements[name], *args)
+        return tuple(row) if row is not None else None
+
+    async def execute(self, name, *args):
+        '''
+        Run a statement. Returns the number of rows it changed.
+        '''
+        return row_count(await self.pool.execute(self.statements[name], *args))
+
+    async def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+        return await self.fetchrow('add_choice', unique_id, str(user_id), str(chat_id), username, tt, url, title)
+
+    async def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+        return await self.execute('update_title', title, unique_id, tt) > 0
+
+    async def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        return await self.execute('delete_choice', unique_id) > 0
+
+    async def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        return await self.execute('delete_by_title', str(chat_id), title) > 0
+
+    async def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices from memory. Returns True if successful, False otherwise.
+        '''
+        return await self.end_poll(chat_id) > 0
+
+    async def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+        return await self.fetch('get_choices', str(chat_id))
+
+    async def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        '''
+        counts, results = poll_rows(chat_id, poll_id, titles, tts)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                poll = await connection.fetchrow(self.statements['add_poll'], str(chat_id), poll_id, str(msg_id))
+                await connection.execute(self.statements['delete_poll_counts'], str(chat_id))
+                await connection.execute(self.statements['add_poll_counts'], *counts)
+                if len(tts) > 0:
+                    # the results flag is checked by the statement itself
+                    await connection.execute(self.statements['add_poll_results'], *results)
+        return tuple(poll)
+
+    async def get_active_poll(self, poll_id):
+        '''
+        Get (chat_id, msg_id) of an active poll, or None if the poll is not active.
+        '''
+        return await self.fetchrow('get_active_poll', poll_id)
+
+    async def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+        poll = await self.get_active_poll(poll_id)
+        return poll[0] if poll is not None else None
+
+    async def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+        poll = await self.get_active_poll(poll_id)
+        return poll[1] if poll is not None else None
+
+    async def get_poll(self, chat_id):
+        '''
+        Get the polls row of a chat, or None if the chat never had a poll.
+        '''
+        return await self.fetchrow('get_poll', str(chat_id))
+
+    async def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+        return await self.fetch('get_poll_counts', str(chat_id))
+
+    async def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+        return await self.fetch('get_votes', str(chat_id))
+
+    async def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None, in a single round trip.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+        rows = await self.fetch('vote', str(chat_id), str(user_id), option_id)
+        counts = [row[:3] for row in rows]
+        complete = len(rows) > 0 and rows[0][3]
+        return counts, complete
+
+    async def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts. Returns the number of rows changed.
+        '''
+        changed = 0
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                for statement in self.statements['end_poll']:
+                    changed += row_count(await connection.execute(statement, str(chat_id)))
+        return changed
+
+    async def results_win(self, chat_id, title):
+        '''
+        Register win for a movie.
+        '''
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                tt = await connection.fetchval(self.statements['get_choice_tt'], str(chat_id), title)
+                await connection.execute(self.statements['results_win'], get_unique_id(str(chat_id), tt))
+
+    async def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat. Returns True if it changed, False if it was already set.
+        '''
+        return await self.execute('set_results', str(chat_id), enabled) > 0
+
+    async def enable_results(self, chat_id):
+        return await self.set_results(chat_id, True)
+
+    async def disable_results(self, chat_id):
+        return await self.set_results(chat_id, False)
+
+    async def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat.
+        '''
+        row = await self.fetchrow('results_enabled', str(chat_id))
+        return row[0] if row is not None else False
+
+    async def get_results(self, chat_id):
+        '''
+        Get results for a chat.
+        '''
+        return await self.fetch('get_results', str(chat_id))
+
+    async def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat. Returns True if there were results, False otherwise.
+        '''
+        return await self.execute('clear_results', str(chat_id)) > 0
+
+    async def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats.
+        Choices have a polls_count of 0.
+        '''
+        return await self.fetch('get_stored_titles')
+
+    async def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat.
+        '''
+        return await self.fetch('get_chat_members')
+
+    async def get_cached_title(self, tt):
+        '''
+        Get cached title for tt. Returns (title, cached_at) if cached, None otherwise.
+        '''
+        return await self.fetchrow('get_cached_title', tt)
+
+    async def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in title cache.
+        '''
+        await self.execute('cache_title', tt, title, cached_at)
+
+    async def reset_tables(self, tables):
+        '''
+        Drop tables and create them again.
+        '''
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                for table in tables:
+                    await connection.execute(f"DROP TABLE {table};")
+        await self.initialize_database(force=True)
+
+    async def reset_database(self):
+        '''
+        Reset database.
+        '''
+        await self.reset_tables(['user_choices', 'users_voted', 'polls', 'poll_counts'])
+
+    async def reset_prefs(self):
+        '''
+        Reset enable_results table.
+        '''
+        await self.reset_tables(['enable_results'])
+
+    async def reset_results(self):
+        '''
+        Reset results database.
+        '''
+        await self.reset_tables(['results'])
+
+    async def flush(self):
+        pass
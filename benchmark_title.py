@@ -0,0 +1,73 @@
+# run this script to compare the streaming title extractor with the full BeautifulSoup parse
+# by default it runs on the trimmed IMDb pages saved in tests/pages:
+#   python benchmark_title.py
+# to run it on other pages, save some IMDb title pages first, e.g.:
+#   curl -H "Accept-Language: en-US" -A "Mozilla/5.0" https://www.imdb.com/title/tt0068646/ -o tt0068646.html
+# then run:
+#   python benchmark_title.py tt0068646.html [more pages...]
+
+# import packages
+import os
+import sys
+import time
+import tracemalloc
+from utils import get_soup, get_title, title_from_chunks
+
+ROUNDS = 20
+
+def chunked(html, size=2 ** 14):
+    '''
+    Split html in chunks, as they would arrive from a streamed response.
+    '''
+    for i in range(0, len(html), size):
+        yield html[i:i + size]
+
+def soup_title(html):
+    return get_title(get_soup(html))
+
+def stream_title(html):
+    return title_from_chunks(chunked(html))
+
+def measure(function, html):
+    '''
+    Get mean time (ms) and peak memory (KiB) of function over ROUNDS runs.
+    '''
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        function(html)
+    elapsed = (time.perf_counter() - start) * 1000 / ROUNDS
+    tracemalloc.start()
+    function(html)
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+def bytes_read(html, size=2 ** 14):
+    '''
+    Get how many characters the streaming extractor reads before stopping.
+    '''
+    read = 0
+    chunks = chunked(html, size)
+    def counted():
+        nonlocal read
+        for chunk in chunks:
+            read += len(chunk)
+            yield chunk
+    title_from_chunks(counted())
+    return read
+
+if __name__ == '__main__':
+    paths = sys.argv[1:]
+    if len(paths) == 0:
+        pages = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'pages')
+        paths = [os.path.join(pages, name) for name in sorted(os.listdir(pages))]
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        soup, stream = soup_title(html), stream_title(html)
+        soup_ms, soup_kib = measure(soup_title, html)
+        stream_ms, stream_kib = measure(stream_title, html)
+        print(f'{path}: {len(html)} chars, titles match: {soup == stream} ({stream})')
+        print(f'  get_soup + get_title: {soup_ms:.2f} ms, peak {soup_kib:.0f} KiB, read {len(html)} chars')
+        print(f'  title_from_chunks:    {stream_ms:.2f} ms, peak {stream_kib:.0f} KiB, '
+            f'read {bytes_read(html)} chars')
@@ -10,15 +10,52 @@ from flask import Flask, request
 import random
 from omdb import OMDBClient
 from utils import *
+from title_index import title_index
 
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 OWNER_ID = int(os.getenv('OWNER_ID'))
 DATABASE_URL = os.getenv('DATABASE_URL')
+SQLITE_PATH = os.getenv('SQLITE_PATH')
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 0))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', 1024))
+LOCAL_MEM_BUDGET = int(os.getenv('LOCAL_MEM_BUDGET', 64))
 USE_POLLING = os.getenv('USE_POLLING')
 OMDB_KEY = os.getenv('OMDB_KEY')
+TITLE_CACHE_SIZE = int(os.getenv('TITLE_CACHE_SIZE', 1024))
+TITLE_CACHE_TTL = int(os.getenv('TITLE_CACHE_TTL', 30 * 24 * 3600))
+TITLE_WORKERS = int(os.getenv('TITLE_WORKERS', 4))
+TITLE_WAIT_TIMEOUT = float(os.getenv('TITLE_WAIT_TIMEOUT', 10))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 1024))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 24 * 3600))
+TITLE_INDEX = os.getenv('TITLE_INDEX', 'imdb_index')
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', 0.3))
+INLINE_WORKERS = int(os.getenv('INLINE_WORKERS', 4))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+COMPACT_POLLS = os.getenv('COMPACT_POLLS', 'true').lower() in ['true', '1', 'yes']
+STATUS_EDIT_DELAY = float(os.getenv('STATUS_EDIT_DELAY', 2))
+DRAW_MESSAGES = int(os.getenv('DRAW_MESSAGES', 1))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+STATE_STORE = os.getenv('STATE_STORE', 'sql' if WEB_CONCURRENCY > 1 else 'memory')
 
 omdb_client = OMDBClient(apikey=OMDB_KEY)
+omdb_client.session = http
+
+# offline title index, built with title_index.py
+if os.path.exists(os.path.join(TITLE_INDEX, 'titles.bin')):
+    index = title_index(TITLE_INDEX)
+    print(f'Using title index with {len(index)} titles')
+else:
+    index = None
+searches = search_cache(lambda query: omdb_search(omdb_client, query),
+    max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+inline = inline_search(delay=INLINE_DEBOUNCE, max_workers=INLINE_WORKERS)
 
 if USE_POLLING is not None:
     if USE_POLLING.lower() in ['true', '1', 'yes']:
@@ -28,7 +65,27 @@ if USE_POLLING is not None:
         USE_POLLING = False
         print('Using webhook')
 
-bot = telebot.TeleBot(TOKEN)
+# conversational state, shared by all processes when there are several
+SHARED_STATE = STATE_STORE == 'sql'
+if SHARED_STATE:
+    if DATABASE_URL is None:
+        raise RuntimeError('A shared state store (STATE_STORE=sql or WEB_CONCURRENCY > 1) needs DATABASE_URL.')
+    store = sql_store(DATABASE_URL, max_connections=UPDATE_WORKERS + 4)
+    print('Using shared state store')
+else:
+    store = memory_store()
+
+# handlers run on the update queue lanes instead of the bot's own thread pool
+bot = telebot.TeleBot(TOKEN, threaded=False, next_step_backend=store_handler_backend(store))
+# each process gets its share of the API limits
+outbox = message_dispatcher(bot, chat_rate=SEND_CHAT_RATE / WEB_CONCURRENCY,
+    global_rate=SEND_GLOBAL_RATE / WEB_CONCURRENCY)
+
+def send(chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    '''
+    Queue a message to a chat. Returns a future with the sent message.
+    '''
+    return outbox.call(chat_id, 'send_message', chat_id, text, priority=priority, **kwargs)
 
 if not USE_POLLING:
 
@@ -38,30 +95,113 @@ if not USE_POLLING:
 
     @server.route("/")
     def webhook():
-        bot.remove_webhook()
-        # time.sleep(1)
-        bot.set_webhook(url=APP_URL+TOKEN)
         return "!", 200
 
     @server.route('/' + TOKEN, methods=['POST'])
     def getMessage():
-        json_string = request.stream.read().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if WEBHOOK_SECRET is not None and \
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return "Forbidden", 403
+        try:
+            update = telebot.types.Update.de_json(request.get_data(as_text=True))
+        except Exception:
+            return "Bad request", 400
+        if update is None:
+            return "Bad request", 400
+        # telegram sends the update again later when the queue is full
+        if not updates.put(update):
+            return "Busy", 503
         return "!", 200
 
 if DATABASE_URL is not None:
-    mem = sql_mem(DATABASE_URL)
-    sql = True
+    # caches would go stale when other processes write
+    mem = sql_mem(DATABASE_URL, min_connections=DB_POOL_MIN, max_connections=DB_POOL_MAX,
+        cache_size=0 if SHARED_STATE else DB_CACHE_SIZE)
     print('Using PostgreSQL database')
+elif SQLITE_PATH is not None:
+    mem = sqlite_mem(SQLITE_PATH)
+    print('Using SQLite database')
 else:
-    sql = False
-    mem = local_mem()
+    mem = local_mem(memory_budget=LOCAL_MEM_BUDGET * 2 ** 20)
     print('Using local disk database')
 
+if WRITE_BEHIND_INTERVAL > 0 and SHARED_STATE:
+    print('Write-behind cache disabled, as state is shared with other processes')
+elif WRITE_BEHIND_INTERVAL > 0:
+    mem = cached_mem(mem, flush_interval=WRITE_BEHIND_INTERVAL)
+    print('Using write-behind cache')
+
+def update_chat(update):
+    '''
+    Get the chat of an update, to process the updates of a chat in order.
+    Poll answers do not carry a chat, so it is looked up from the poll.
+    '''
+    if update.poll_answer is not None:
+        return mem.get_chat_from_poll(update.poll_answer.poll_id)
+    for message in [update.message, update.edited_message, update.channel_post, update.edited_channel_post]:
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    for query in [update.inline_query, update.chosen_inline_result, update.callback_query]:
+        if query is not None:
+            return query.from_user.id
+    return None
+
+updates = update_queue(bot, update_chat, lanes=UPDATE_WORKERS, max_size=UPDATE_QUEUE_SIZE,
+    store=store if SHARED_STATE else None)
+
+titles = title_cache(mem, max_size=TITLE_CACHE_SIZE, ttl=TITLE_CACHE_TTL, index=index)
+resolver = title_resolver(titles, max_workers=TITLE_WORKERS)
+# movies already suggested in the chats of each user, searched before the title index and OMDb
+known = known_titles(mem.get_stored_titles(), mem.get_chat_members())
+
+def store_choice(chat_id, user_id, username, tt, url, title):
+    '''
+    Save choice to memory.
+    '''
+    unique_id = get_unique_id(chat_id, user_id)
+    mem.add_choice(unique_id, user_id, chat_id, username, tt, url, title)
+    known.add(chat_id, tt, title)
+    known.add_member(user_id, chat_id)
+
+def update_choice_title(chat_id, user_id, tt, title):
+    '''
+    Replace the placeholder title of a choice, if the choice was not changed meanwhile.
+    '''
+    mem.update_title(get_unique_id(chat_id, user_id), tt, title)
+    known.add(chat_id, tt, title)
+
+def save_choice(chat_id, user_id, username, tt, reply):
+    '''
+    Save choice and confirm it with reply(title).
+    If the title is not cached, the choice is saved right away with the tt tag as a
+    placeholder title. The title is then resolved in the background, and both
+    the choice and the confirmation message are updated.
+    '''
+    url = imdb_url(tt)
+    markup = types.ReplyKeyboardRemove(selective=False)
+    title = titles.get(tt)
+    if title is not None:
+        store_choice(chat_id, user_id, username, tt, url, title)
+        send(chat_id, reply(title), reply_markup=markup)
+        return
+    store_choice(chat_id, user_id, username, tt, url, tt)
+    confirmation = send(chat_id, reply(tt), reply_markup=markup)
+
+    def resolved(title):
+        update_choice_title(chat_id, user_id, tt, title)
+        try:
+            outbox.call(chat_id, 'edit_message_text', reply(title), chat_id,
+                confirmation.result().message_id)
+        except Exception as e:
+            print(e)
+
+    resolver.submit(chat_id, tt, resolved)
+
 @bot.message_handler(commands=['start', 'help'])
 def start(message):
-    bot.send_message(message.chat.id,
+    send(message.chat.id,
     '''
 Hi, I'm a movie poll bot! I can help you choose a movie with friends.
 These are the available commands:
@@ -85,17 +225,41 @@ def search(query):
     '''
     if len(query.query) < 3:
         return
-    search = omdb_client.search(query.query)
+    inline.submit(query.from_user.id, lambda: search_titles(query.from_user.id, query.query, query.offset),
+        lambda search: answer_search(query, *search))
+
+def search_titles(user_id, query, offset=''):
+    '''
+    Search movies already suggested in the chats of the user, then in the title index, or on OMDb if the index has none.
+    Returns the results and the offset of the next page. Suggested movies fill the first page on their own,
+    the others are only searched for when the next page is asked for.
+    '''
+    local = known.search(user_id, query)
+    if offset == '' and len(local) > 0:
+        return local, 'more'
+    search = index.search(query) if index is not None else []
+    if len(search) == 0:
+        search = searches.get(query)
+    local_tts = set(movie['imdb_id'] for movie in local)
+    return [movie for movie in search if movie['imdb_id'] not in local_tts], ''
+
+def answer_search(query, search, next_offset=''):
+    '''
+    Answer inline query with search results.
+    '''
     answers = []
 
     for i in range(min(10, len(search))):
+        title = search[i]['title'] + (f' ({search[i]["year"]})' if search[i]['year'] else '')
         answers.append(types.InlineQueryResultArticle(
-            id=str(i),
-            title=f'{search[i]["title"]} ({search[i]["year"]})',
+            id=search[i]['imdb_id'],
+            title=title,
             input_message_content=types.InputTextMessageContent(
                 message_text='/choose ' + imdb_url(search[i]['imdb_id']))))
 
-    bot.answer_inline_query(query.id, answers, cache_time=300)
+    # results start with the movies suggested in the chats of the user, so telegram must not share them
+    bot.answer_inline_query(query.id, answers, cache_time=300, is_personal=True,
+        next_offset=next_offset)
 
 @bot.message_handler(commands=['choose'])
 def choose(message, ignore_size=False):
@@ -107,8 +271,8 @@ def choose(message, ignore_size=False):
         user_input = message.text.split(' ', 1)
         if len(user_input) <= 1:
             markup = telebot.types.ForceReply(selective=False)
-            get_reply = bot.send_message(chat_id, "Please, enter a choice:", \
-                reply_markup=markup, reply_to_message_id=message.message_id)
+            get_reply = send(chat_id, "Please, enter a choice:", \
+                reply_markup=markup, reply_to_message_id=message.message_id).result()
             bot.register_next_step_handler(get_reply, choose, True)
             return
         else:
@@ -121,42 +285,21 @@ def choose(message, ignore_size=False):
                 username = message.from_user.first_name
         except:
             username = message.from_user.first_name
-        url = imdb_url(tt)
-        title = get_title(get_soup(getHTML(url)))
-        if sql:
-            unique_id = get_unique_id(chat_id, user_id)
-            mem.add_choice(unique_id, user_id, chat_id, username, tt, url, title)
-        else:
-            mem.user_choices[chat_id][user_id] = {
-                'username': username,
-                'tt': tt,
-                'url': url,
-                'title': title
-            }
-            mem.sync_mem()
-        markup = types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(
-            message.chat.id, f'Saved choice {title} for user {username}', reply_markup=markup)
+        save_choice(chat_id, user_id, username, tt,
+            lambda title: f'Saved choice {title} for user {username}')
     elif ignore_size:
         markup = telebot.types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(
+        send(
             message.chat.id, "No valid IMDb url or tt tag detected.", reply_markup=markup)
 
 @bot.message_handler(commands=['choosedummy'])
-def choosedummy(message): # TODO: update to use sql
+def choosedummy(message):
     if message.from_user.id in [OWNER_ID]:
-        tt = 'tt0068646'
-        url = imdb_url(tt)
-        title = get_title(get_soup(getHTML(url)))
-        mem.user_choices[message.chat.id]['dummy'] = {
-            'tt': tt,
-            'url': url,
-            'title': title
-        }
-        mem.sync_mem()
-        bot.send_message(message.chat.id, f'Saved choice {title} for user {"dummy"}')
+        title = titles.resolve(DUMMY_TT)
+        store_choice(message.chat.id, DUMMY_USER_ID, DUMMY_USERNAME, DUMMY_TT, imdb_url(DUMMY_TT), title)
+        send(message.chat.id, f'Saved choice {title} for user {DUMMY_USERNAME}')
     else:
-        bot.send_message(message.chat.id, "You do not possess that kind of power.")
+        send(message.chat.id, "You do not possess that kind of power.")
 
 @bot.message_handler(commands=['participate'])
 def participate(message):
@@ -168,23 +311,13 @@ def participate(message):
             username = message.from_user.first_name
     except:
         username = message.from_user.first_name
-    if sql:
-        unique_id = get_unique_id(chat_id, user_id)
-        mem.add_choice(unique_id, user_id, chat_id, username, None, None, None)
-    else:
-        mem.user_choices[chat_id][user_id] = {
-            'username': username,
-            'tt': None,
-            'url': None,
-            'title': None
-        }
-        mem.sync_mem()
-    bot.send_message(chat_id, f'Added user {username} to participate')
+    store_choice(chat_id, user_id, username, None, None, None)
+    send(chat_id, f'Added user {username} to participate')
 
 @bot.message_handler(commands=['extra'])
 def extra(message, ignore_size=False):
     chat_id = message.chat.id
-    user_id = 0
+    user_id = EXTRA_USER_ID
     username = 'Extra choice'
     if ignore_size:
         user_input = message.text
@@ -192,284 +325,233 @@ def extra(message, ignore_size=False):
         user_input = message.text.split(' ', 1)
         if len(user_input) <= 1:
             markup = telebot.types.ForceReply(selective=False)
-            get_reply = bot.send_message(chat_id, "Please, enter a choice:", \
-                reply_markup=markup, reply_to_message_id=message.message_id)
+            get_reply = send(chat_id, "Please, enter a choice:", \
+                reply_markup=markup, reply_to_message_id=message.message_id).result()
             bot.register_next_step_handler(get_reply, extra, True)
             return
         else: user_input = user_input[1]
     tt = get_tt(user_input)
     if tt is not None:
-        url = imdb_url(tt)
-        title = get_title(get_soup(getHTML(url)))
-        if sql:
-            unique_id = get_unique_id(chat_id, user_id)
-            mem.add_choice(unique_id, user_id, chat_id, username, tt, url, title)
-        else:
-            mem.user_choices[chat_id]['0'] = {
-                'username': username,
-                'tt': tt,
-                'url': url,
-                'title': title
-            }
-            mem.sync_mem()
-        markup = types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(chat_id, f'Saved extra choice {title}.', reply_markup=markup)
+        save_choice(chat_id, user_id, username, tt, lambda title: f'Saved extra choice {title}.')
     elif ignore_size:
         markup = types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(chat_id, "No valid IMDb url or tt tag detected.", reply_markup=markup)
+        send(chat_id, "No valid IMDb url or tt tag detected.", reply_markup=markup)
 
 @bot.message_handler(commands=['choices'])
 def display_choices(message):
     chat_id = message.chat.id
-    if sql:
-        rows = mem.get_choices(chat_id)
-        if rows is None:
-            bot.send_message(chat_id, "No choices have been made yet.")
-        else:
-            choices = []
-            for row in rows:
-                if row[6] is not None:
-                    choices.append(f'{row[3]}: {row[6]}')
-                else:
-                    choices.append(f'{row[3]}: no suggestion')
-            if len(choices) > 0:
-                bot.send_message(chat_id, 'Current participants:\n' + '\n'.join(choices))
-            else:
-                bot.send_message(chat_id, "No choices found.")
+    rows = mem.get_choices(chat_id)
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
     else:
-        if chat_id in mem.user_choices:
-            if len(mem.user_choices[chat_id]) == 0:
-                bot.send_message(chat_id, "No current choices found.")
+        choices = []
+        for row in rows:
+            if row[6] is not None:
+                choices.append(f'{row[3]}: {row[6]}')
             else:
-                choices = []
-                for user_id in mem.user_choices[chat_id]:
-                    if mem.user_choices[chat_id][user_id]['title'] is not None:
-                        choices.append(
-                            f'{mem.user_choices[chat_id][user_id]["username"]}: '\
-                            f'{mem.user_choices[chat_id][user_id]["title"]}')
-                    else:
-                        choices.append(\
-                        f'{mem.user_choices[chat_id][user_id]["username"]}: no suggestion')
-                bot.send_message(chat_id, 'Current participants:\n' + '\n'.join(choices))
-        else:
-            bot.send_message(chat_id, "No choices have been made yet.")
+                choices.append(f'{row[3]}: no suggestion')
+        send(chat_id, 'Current participants:\n' + '\n'.join(choices))
 
 @bot.message_handler(commands=['clear'])
 def clear_choice(message):
     chat_id = message.chat.id
-    if sql:
-        unique_id = get_unique_id(chat_id, message.from_user.id)
-        try:
-            username = message.from_user.username
-            if username is None:
-                username = message.from_user.first_name
-        except:
+    unique_id = get_unique_id(chat_id, message.from_user.id)
+    try:
+        username = message.from_user.username
+        if username is None:
             username = message.from_user.first_name
-        if mem.delete_choice(unique_id):
-            bot.send_message(chat_id, 'Cleared choice for user 'f'{username}')
-        else:
-            bot.send_message(chat_id, 'No choice found.')
+    except:
+        username = message.from_user.first_name
+    if mem.delete_choice(unique_id):
+        send(chat_id, 'Cleared choice for user 'f'{username}')
     else:
-        if message.from_user.id in mem.user_choices[chat_id]:
-            bot.send_message(chat_id, \
-            f'Cleared choice for user '\
-            f'{mem.user_choices[chat_id][message.from_user.id]["username"]}')
-            del(mem.user_choices[chat_id][message.from_user.id])
-            mem.sync_mem()
-        else:
-            bot.send_message(chat_id, "No choice found.")
+        send(chat_id, 'No choice found.')
 
 @bot.message_handler(commands=['clearextra'])
 def clear_extra(message):
     chat_id = message.chat.id
-    if sql:
-        if mem.delete_choice(get_unique_id(chat_id, 0)):
-            bot.send_message(chat_id, 'Extra choice deleted.')
-        else:
-            bot.send_message(chat_id, 'No extra choice found.')
+    if mem.delete_choice(get_unique_id(chat_id, 0)):
+        send(chat_id, 'Extra choice deleted.')
     else:
-        if '0' in mem.user_choices[chat_id]:
-            bot.send_message(chat_id, f'Cleared extra choice.')
-            del(mem.user_choices[chat_id]['0'])
-            mem.sync_mem()
-        else:
-            bot.send_message(chat_id, f'No extra choice found.')
+        send(chat_id, 'No extra choice found.')
 
 @bot.message_handler(commands=['clearall'])
 def clear_choices(message):
     chat_id = message.chat.id
     # if message.from_user.id in [OWNER_ID]:
     if True: # use the line above if you want to be the only one who can clear all choices at once
-        if sql:
-            if mem.delete_all_choices(chat_id):
-                bot.send_message(chat_id, 'All choices cleared.')
-            else:
-                bot.send_message(chat_id, 'No choices found.')
+        if mem.delete_all_choices(chat_id):
+            send(chat_id, 'All choices cleared.')
         else:
-            if chat_id in mem.user_choices:
-                mem.user_choices[chat_id].clear()
-                mem.sync_mem()
-                bot.send_message(chat_id, 'All choices cleared.')
-            else:
-                bot.send_message(chat_id, 'No choices found.')
+            send(chat_id, 'No choices found.')
     else:
-        bot.send_message(chat_id, 'You do not possess that kind of power.')
+        send(chat_id, 'You do not possess that kind of power.')
 
 @bot.message_handler(commands=['veto'])
 def veto(message):
     chat_id = message.chat.id
-    if sql:
-        rows = mem.get_choices(chat_id)
-        if rows is None:
-            bot.send_message(chat_id, "No choices have been made yet.")
-        else:
-            markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-            markup.add(*[row[6] for row in rows if row[6] is not None])
-            markup.add('Cancel')
-            get_reply = bot.send_message(
-                chat_id, 'Which choice do you want to veto?', reply_markup=markup)
-            bot.register_next_step_handler(get_reply, veto_choice)
+    rows = mem.get_choices(chat_id)
+    vetoable = [row[6] for row in rows if row[6] is not None]
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
+    elif len(vetoable) == 0:
+        send(chat_id, "No choices to veto.")
     else:
-        if chat_id in mem.user_choices:
-            if len(mem.user_choices[chat_id]) > 0:
-                markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-                markup.add(*[value['title'] for _, value in \
-                    mem.user_choices[chat_id].items() if value['title'] is not None])
-                markup.add('Cancel')
-                get_reply = bot.send_message(
-                    chat_id, "Please, enter a choice to veto:", reply_markup=markup)
-                bot.register_next_step_handler(get_reply, veto_choice)
-            else:
-                bot.send_message(chat_id, "No choices to veto.")
-        else:
-            bot.send_message(chat_id, 'No choices have been made yet.')
+        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+        markup.add(*vetoable)
+        markup.add('Cancel')
+        get_reply = send(
+            chat_id, 'Which choice do you want to veto?', reply_markup=markup).result()
+        bot.register_next_step_handler(get_reply, veto_choice)
 
 @bot.message_handler(commands=[])
 def veto_choice(message):
     chat_id = message.chat.id
+    markup = types.ReplyKeyboardRemove(selective=False)
     if message.text == 'Cancel':
-        markup = types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(chat_id, 'No movie vetoed.', reply_markup=markup)
+        send(chat_id, 'No movie vetoed.', reply_markup=markup)
         return
-    if sql:
-        markup = types.ReplyKeyboardRemove(selective=False)
-        if mem.delete_by_title(chat_id, message.text):
-            bot.send_message(chat_id, 'Vetoed ' + message.text, reply_markup=markup)
-        else:
-            bot.send_message(chat_id, 'Something went wrong. No changes were made.', \
-                reply_markup=markup)
+    if mem.delete_by_title(chat_id, message.text):
+        send(chat_id, 'Vetoed ' + message.text, reply_markup=markup)
     else:
-        if chat_id in mem.user_choices:
-            for key, value in mem.user_choices[chat_id].items():
-                if value['title'] == message.text:
-                    bot.send_message(
-                        chat_id, f'Vetoed choice {message.text}.', reply_markup=markup)
-                    del(mem.user_choices[chat_id][key])
-                    mem.sync_mem()
-                    markup = types.ReplyKeyboardRemove(selective=False)
-                    return
-            markup = types.ReplyKeyboardRemove(selective=False)
-            bot.send_message(chat_id, 'Choice not found.', reply_markup=markup)
-        else:
-            markup = types.ReplyKeyboardRemove(selective=False)
-            bot.send_message(chat_id, 'No choices found.', reply_markup=markup)
+        send(chat_id, 'Something went wrong. No changes were made.', \
+            reply_markup=markup)
 
 @bot.message_handler(commands=['deletemaindatabase'])
 def clear_memory(message):
     if message.from_user.id in [OWNER_ID]:
-        if sql:
-            mem.reset_database()
-            bot.send_message(message.chat.id, 'Bot memory reinitialized.')
-        else:
-            mem.create_mem()
-            bot.send_message(message.chat.id, 'Bot memory reinitialized.')
+        mem.reset_database()
+        known.reload(mem.get_stored_titles(), mem.get_chat_members())
+        send(message.chat.id, 'Bot memory reinitialized.')
     else:
-        bot.send_message(message.chat.id, 'You do not possess that kind of power.')
+        send(message.chat.id, 'You do not possess that kind of power.')
+
+@bot.message_handler(commands=['stats'])
+def stats(message):
+    if message.from_user.id in [OWNER_ID]:
+        lines = [f'titles: {titles.stats()}', f'searches: {searches.stats()}', f'known: {known.stats()}',
+            f'inline: {inline.stats()}']
+        if index is not None:
+            lines.append(f'index: {index.stats()}')
+        if hasattr(mem, 'cache_stats'):
+            for name, cache_stats in mem.cache_stats().items():
+                lines.append(f'{name}: {cache_stats}')
+        lines.append(f'outbox: {outbox.stats()}')
+        lines.append(f'status: {status.stats()}')
+        lines.append(f'updates: {updates.stats()}')
+        for host, host_stats in http.stats().items():
+            lines.append(f'{host}: {host_stats}')
+        send(message.chat.id, '\n'.join(lines))
+    else:
+        send(message.chat.id, 'You do not possess that kind of power.')
 
 @bot.message_handler(commands=['deleteresultsdatabase'])
 def clear_results(message):
     if message.from_user.id in [OWNER_ID]:
-        if sql:
-            mem.reset_results()
-            bot.send_message(message.chat.id, 'Results database reinitialized.')
-        else:
-            bot.send_message(message.chat.id, 'Results database reinitialized.')
+        mem.reset_results()
+        known.reload(mem.get_stored_titles(), mem.get_chat_members())
+        send(message.chat.id, 'Results database reinitialized.')
     else:
-        bot.send_message(message.chat.id, 'You do not possess that kind of power.')
+        send(message.chat.id, 'You do not possess that kind of power.')
 
 @bot.message_handler(commands=['deleteprefsdatabase'])
 def clear_prefs(message):
     if message.from_user.id in [OWNER_ID]:
-        if sql:
-            mem.reset_prefs()
-            bot.send_message(message.chat.id, 'Preferences database reinitialized.')
-        else:
-            bot.send_message(message.chat.id, 'Preferences database reinitialized.')
+        mem.reset_prefs()
+        send(message.chat.id, 'Preferences database reinitialized.')
     else:
-        bot.send_message(message.chat.id, 'You do not possess that kind of power.')
+        send(message.chat.id, 'You do not possess that kind of power.')
+
+def render_status(chat_id):
+    '''
+    Text of the status message of a poll: votes so far and participants still to vote.
+    '''
+    voted = set(str(row[0]) for row in mem.get_votes(chat_id))
+    participants = [row for row in mem.get_choices(chat_id) if str(row[1]) not in NON_VOTING_USER_IDS]
+    waiting = [row[3] for row in participants if str(row[1]) not in voted]
+    text = f'Poll created. Votes: {len(participants) - len(waiting)}/{len(participants)}'
+    if len(waiting) > 0:
+        return text + '\nWaiting for: ' + ', '.join(waiting)
+    return text + '\nAll votes are in!'
+
+status = poll_status(outbox, render_status, store, delay=STATUS_EDIT_DELAY)
+
+def wait_for_titles(chat_id, timeout):
+    '''
+    Wait for the titles of the choices in a chat to be resolved.
+    With a shared state store, they may be resolved by another process,
+    so the saved choices are checked for placeholder titles too.
+    Returns True if all are resolved, False if timed out.
+    '''
+    deadline = time.monotonic() + timeout
+    if not resolver.wait(chat_id, timeout=timeout):
+        return False
+    while SHARED_STATE and any(row[4] is not None and row[6] == row[4] for row in mem.get_choices(chat_id)):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
 
 # create a poll from each choice
 @bot.message_handler(commands=['poll'])
 def poll(message):
     chat_id = message.chat.id
-    if sql:
-        rows = mem.get_choices(chat_id)
-        titles = [row[6] for row in rows if row[6] is not None]
-        tts = [row[4] for row in rows if row[4] is not None]
-        if rows is None:
-            bot.send_message(chat_id, "No choices have been made yet.")
-        elif len(titles) < 2:
-            bot.send_message(
-                chat_id, 'You need to have at least two choices to create a poll.')
+    if not wait_for_titles(chat_id, TITLE_WAIT_TIMEOUT):
+        send(chat_id, 'Some titles could not be found in time. Using IMDb tags instead.', priority=PRIORITY_HIGH)
+    rows = mem.get_choices(chat_id)
+    titles = [row[6] for row in rows if row[6] is not None]
+    tts = [row[4] for row in rows if row[4] is not None]
+    if len(rows) == 0:
+        send(chat_id, "No choices have been made yet.")
+    elif len(titles) < 2:
+        send(
+            chat_id, 'You need to have at least two choices to create a poll.')
+    else:
+        if COMPACT_POLLS:
+            listing = [f'{row[6]}: {row[5]}' for row in rows if row[6] is not None]
+            send(chat_id, 'Creating poll... Here are the choices:\n' + '\n'.join(listing),
+                disable_web_page_preview=True, priority=PRIORITY_HIGH)
         else:
-            bot.send_message(chat_id, 'Creating poll... Here are the choices:')
+            send(chat_id, 'Creating poll... Here are the choices:', priority=PRIORITY_HIGH)
             for row in rows:
                 if row[6] is not None:
-                    bot.send_message(
-                        chat_id, f'{row[6]}: {row[5]}', disable_notification=True)
-            poll = bot.send_poll(chat_id, random.choice(vote_lines),
-                titles, is_anonymous=False)
-            mem.add_poll(chat_id, poll.poll.id, poll.message_id, titles, tts)
-            bot.send_message(chat_id, 'Poll created.')
-    else:
-        if len(mem.user_choices[chat_id]) > 1:
-            bot.send_message(chat_id, 'Creating poll... Here are the choices:')
-            for key, value in mem.user_choices[chat_id].items():
-                if value['title'] is not None:
-                    bot.send_message(
-                        chat_id, f'{value["title"]}: {value["url"]}',
-                        disable_notification=True)
-            mem.last_poll[chat_id] = bot.send_poll(
-                chat_id, random.choice(vote_lines), [value["title"] for key, value in \
-                    mem.user_choices[chat_id].items() if value["title"] is not None], \
-                        is_anonymous=False)
-            mem.users_voted[chat_id] = []
-            mem.poll_counts[chat_id] = len(mem.user_choices[chat_id]) * [0]
-            mem.poll_chats[mem.last_poll[chat_id].poll.poll.id] = chat_id
-            mem.sync_mem()
+                    send(
+                        chat_id, f'{row[6]}: {row[5]}', disable_notification=True, priority=PRIORITY_HIGH)
+        poll = outbox.call(chat_id, 'send_poll', chat_id, random.choice(vote_lines),
+            titles, is_anonymous=False, priority=PRIORITY_HIGH).result()
+        mem.add_poll(chat_id, poll.poll.id, poll.message_id, titles, tts)
+        # counted like polls_count, which is only saved with results enabled
+        if mem.results_enabled(chat_id):
+            for tt, title in zip(tts, titles):
+                known.add(chat_id, tt, title, polls=1)
+        if COMPACT_POLLS:
+            status.start(chat_id, priority=PRIORITY_HIGH)
         else:
-            bot.send_message(
-                chat_id, 'You need to have at least two choices to create a poll.')
+            send(chat_id, 'Poll created.', priority=PRIORITY_HIGH)
 
 # create a dummy poll
 @bot.message_handler(commands=['fakepoll'])
 def fakepoll(message):
     if message.from_user.id in [OWNER_ID]:
-        if sql:
-            titles = ['The Godfather', 'Forrest Gump', 'The Shawshank Redemption']
-            tts = ['tt0068646', 'tt0109830', 'tt0111161']
-            poll = bot.send_poll(message.chat.id, random.choice(vote_lines),
-                titles, is_anonymous=False)
-            mem.add_poll(message.chat.id, poll.poll.id, poll.message_id, titles, tts)
-        else:
-            mem.last_poll[message.chat.id] = bot.send_poll(
-                message.chat.id, 'Choose', ['The Godfather', 'Forrest Gump'], is_anonymous=False)
-            mem.users_voted[message.chat.id] = []
-            mem.poll_chats[mem.last_poll[message.chat.id].poll.poll.id] = message.chat.id
-            mem.poll_counts[message.chat.id] = 2 * [0]
-            mem.sync_mem()
+        titles = ['The Godfather', 'Forrest Gump', 'The Shawshank Redemption']
+        tts = ['tt0068646', 'tt0109830', 'tt0111161']
+        poll = outbox.call(message.chat.id, 'send_poll', message.chat.id, random.choice(vote_lines),
+            titles, is_anonymous=False, priority=PRIORITY_HIGH).result()
+        mem.add_poll(message.chat.id, poll.poll.id, poll.message_id, titles, tts)
     else:
-        bot.send_message(message.chat.id, 'You do not possess that kind of power.')
+        send(message.chat.id, 'You do not possess that kind of power.')
+
+def send_draw(chat_id, intro, rerolls, result):
+    '''
+    Announce a random draw and its rerolls, in at most DRAW_MESSAGES messages.
+    '''
+    parts = [intro]
+    for i in range(1, rerolls + 1):
+        parts.append(f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
+            f'Thats the {ordinal(i)} reroll.')
+    parts.append(result)
+    for text in group_messages(parts, DRAW_MESSAGES):
+        send(chat_id, text, priority=PRIORITY_HIGH)
 
 # check if all users in user_choices have voted
 @bot.poll_answer_handler()
@@ -480,204 +562,130 @@ def poll_complete(pollAnswer):
             username = pollAnswer.user.first_name
     except:
         username = pollAnswer.user.first_name
-    if sql:
-        chat_id = mem.get_chat_from_poll(pollAnswer.poll_id)
-        if chat_id is None:
-            return
-        user_id = pollAnswer.user.id
-        if len(pollAnswer.option_ids) == 0:
-            mem.remove_vote(chat_id, user_id)
-            bot.send_message(chat_id, f'User {username} has retracted their vote.')
-        else:
-            mem.add_vote(chat_id, user_id, pollAnswer.option_ids[0])
-            bot.send_message(chat_id, f'User {username} has voted.')
-        if mem.check_poll_complete(chat_id):
-            winner = mem.get_poll_winner(chat_id)
-            if winner is not None:
-                bot.send_message(chat_id, f'Poll complete! Winner: {winner}')
-            else:
-                rerolls = 0
-                reroll_chance, winner = mem.random_poll_winner(chat_id)
-                bot.send_message(chat_id, f'{random.choice(exclamations)} '\
-                    f'There is a tie!\nChoosing random option. Reroll chance: '\
-                        f'{reroll_chance:.2f}%')
-                while winner == None:
-                    rerolls += 1
-                    reroll_chance, winner = mem.random_poll_winner(
-                        chat_id, reroll_chance=reroll_chance)
-                    msg = f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
-                            f'Thats the {ordinal(rerolls)} reroll.'
-                    bot.send_message(chat_id, msg)
-                bot.send_message(chat_id, f'Poll complete! Random winner after poll tie: {winner}')
-            mem.results_win(chat_id, winner)
-            poll_msg_id = mem.get_msg_from_poll(pollAnswer.poll_id)
-            bot.stop_poll(chat_id, poll_msg_id)
-            mem.end_poll(chat_id)
+    chat_id = mem.get_chat_from_poll(pollAnswer.poll_id)
+    if chat_id is None:
+        return
+    user_id = pollAnswer.user.id
+    known.add_member(user_id, chat_id)
+    if len(pollAnswer.option_ids) == 0:
+        counts, complete = mem.vote(chat_id, user_id, None)
+        if not COMPACT_POLLS:
+            send(chat_id, f'User {username} has retracted their vote.', priority=PRIORITY_LOW)
     else:
-        if not pollAnswer.poll_id in mem.poll_chats:
-            return
-        chat_id = mem.poll_chats[pollAnswer.poll_id]
-        if mem.last_poll[chat_id] is None:
-            return
-        if pollAnswer.user.id not in mem.users_voted[chat_id]:
-            mem.poll_counts[chat_id][pollAnswer.option_ids[0]] += 1
-            mem.users_voted[chat_id].append(pollAnswer.user.id)
-            bot.send_message(chat_id, f'User {username} has voted.')
+        counts, complete = mem.vote(chat_id, user_id, pollAnswer.option_ids[0])
+        if not COMPACT_POLLS:
+            send(chat_id, f'User {username} has voted.', priority=PRIORITY_LOW)
+    if COMPACT_POLLS:
+        if complete:
+            status.stop(chat_id)
         else:
-            bot.send_message(chat_id, f'User {username} has voted (again).')
-        if (set(mem.user_choices[chat_id].keys()) - set(['dummy', '0'])).issubset(set(mem.users_voted[chat_id])):
-            bot.stop_poll(chat_id, mem.last_poll[chat_id].id)
-            ids = mem.poll_counts[chat_id]
-            winner_count = max(ids)
-            choices = [index for index, value in enumerate(ids) if value == winner_count]
-            if ids.count(winner_count) > 1:
-                random_key = None
-                reroll_slots = random.randint(1, len(choices))
-                keys = choices + reroll_slots * [None]
-                bot.send_message(chat_id, f'{random.choice(exclamations)} '\
-                    f'There is a tie!\nChoosing random option. Reroll chance: '\
-                        f'{reroll_slots*100/(len(keys)):.2f}%')
-                rerolls = 0
-                while random_key == None:
-                    random_key = random.choice(keys)
-                    if random_key == None:
-                        rerolls += 1
-                        msg = f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
-                            f'Thats the {ordinal(rerolls)} reroll.'
-                        bot.send_message(chat_id, msg)
-                bot.send_message(chat_id, f'Random winner after poll tie: '\
-                                        f'{mem.last_poll[chat_id].poll.options[random_key].text}')
-            else:
-                bot.send_message(
-                    chat_id, f'Winner: {mem.last_poll[chat_id].poll.options[choices[0]].text}')
-            mem.user_choices[chat_id].clear()
-            mem.users_voted[chat_id].clear()
-            mem.poll_counts[chat_id].clear()
-            bot.send_message(chat_id, 'Poll complete!')
-        mem.sync_mem()
+            status.update(chat_id)
+    if complete:
+        winner = mem.get_poll_winner(chat_id, counts)
+        if winner is not None:
+            send(chat_id, f'Poll complete! Winner: {winner}', priority=PRIORITY_HIGH)
+        else:
+            reroll_chance, rerolls, winner = mem.random_poll_winner(chat_id, counts)
+            send_draw(chat_id, f'{random.choice(exclamations)} '\
+                f'There is a tie!\nChoosing random option. Reroll chance: '\
+                    f'{reroll_chance:.2f}%', rerolls,
+                f'Poll complete! Random winner after poll tie: {winner}')
+        mem.results_win(chat_id, winner)
+        poll_msg_id = mem.get_msg_from_poll(pollAnswer.poll_id)
+        outbox.call(chat_id, 'stop_poll', chat_id, poll_msg_id, priority=PRIORITY_HIGH)
+        mem.end_poll(chat_id)
 
 @bot.message_handler(commands=['random'])
 def random_choice(message):
     chat_id = message.chat.id
-    if sql:
-        choices = mem.get_choices(chat_id)
-        if choices is None or len(choices) == 0:
-            bot.send_message(chat_id, 'No choices have been made.')
-            return
-        elif len(choices) == 1:
-            bot.send_message(chat_id, \
-                'You need to have at least two options to choose from.')
-            return
-        reroll_chance, winner = mem.random_winner(chat_id)
-        bot.send_message(chat_id, \
-            f'Choosing random option. Reroll chance: {reroll_chance:.2f}%.')
-        rerolls = 0
-        while winner == None:
-            rerolls += 1
-            reroll_chance, winner = mem.random_winner(chat_id, reroll_chance=reroll_chance)
-            msg = f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
-                        f'Thats the {ordinal(rerolls)} reroll.'
-            bot.send_message(chat_id, msg)
-        mem.results_win(chat_id, winner)
-        bot.send_message(chat_id, f'Random winner: {winner}')
-        mem.end_poll(chat_id)
-    else:
-        choices = mem.user_choices[chat_id]
-        if len(choices) > 1:
-            random_key = None
-            reroll_slots = random.randint(1, len(choices))
-            keys = list(choices.keys()) + reroll_slots * [None]
-            bot.send_message(chat_id, \
-                f'Choosing random option. Reroll chance: {reroll_slots*100/(len(keys)):.2f}%.')
-            rerolls = 0
-            while random_key == None:
-                random_key = random.choice(keys)
-                if random_key == None:
-                    rerolls += 1
-                    msg = f'{random.choice(reroll_exclamations)}\n{random.choice(exclamations)} '\
-                        f'Thats the {ordinal(rerolls)} reroll.'
-                    bot.send_message(chat_id, msg)
-            bot.send_message(chat_id, f'Random winner: {choices[random_key]["title"]}')
-            mem.user_choices[chat_id].clear()
-            mem.users_voted[chat_id].clear()
-            mem.poll_counts[chat_id].clear()
-            mem.sync_mem()
-        else:
-            bot.send_message(chat_id, 'You need to have at least two options to choose from.')
+    choices = [row[6] for row in mem.get_choices(chat_id) if row[6] is not None]
+    if len(choices) == 0:
+        send(chat_id, 'No choices have been made.')
+        return
+    elif len(choices) == 1:
+        send(chat_id, \
+            'You need to have at least two options to choose from.')
+        return
+    reroll_chance, rerolls, winner = simulate_draw(choices)
+    mem.results_win(chat_id, winner)
+    send_draw(chat_id, f'Choosing random option. Reroll chance: {reroll_chance:.2f}%.', rerolls,
+        f'Random winner: {winner}')
+    mem.end_poll(chat_id)
 
 @bot.message_handler(commands=['enableresults'])
 def enable_results(message):
     chat_id = message.chat.id
-    if sql:
-        if mem.enable_results(chat_id):
-            bot.send_message(chat_id, 'Results history enabled. Use /results to view.')
-        else:
-            bot.send_message(chat_id, 'Results history was already enabled. Use /results to view.')
+    if mem.enable_results(chat_id):
+        send(chat_id, 'Results history enabled. Use /results to view.')
     else:
-        bot.send_message(chat_id, 'Results history is not supported at this time.')
+        send(chat_id, 'Results history was already enabled. Use /results to view.')
 
 @bot.message_handler(commands=['disableresults'])
 def disable_results(message):
     chat_id = message.chat.id
-    if sql:
-        if mem.disable_results(chat_id):
-            bot.send_message(chat_id, 'Results history disabled. '
-                'Remember to clear results history with /clearhistory, if desired.')
-        else:
-            bot.send_message(chat_id, 'Results history was already disabled. '
-                'Remember to clear results history with /clearhistory, if desired.')
+    if mem.disable_results(chat_id):
+        send(chat_id, 'Results history disabled. '
+            'Remember to clear results history with /clearhistory, if desired.')
     else:
-        bot.send_message(chat_id, 'Results history is not supported at this time.')
+        send(chat_id, 'Results history was already disabled. '
+            'Remember to clear results history with /clearhistory, if desired.')
 
 @bot.message_handler(commands=['clearresults'])
 def clear_results(message):
     chat_id = message.chat.id
-    if sql:
-        if mem.clear_results(chat_id):
-            bot.send_message(chat_id, 'Results history cleared. ')
-        else:
-            bot.send_message(chat_id, 'Results history was already cleared.')
+    if mem.clear_results(chat_id):
+        known.clear_polls(chat_id)
+        send(chat_id, 'Results history cleared. ')
     else:
-        bot.send_message(chat_id, 'Results history is not supported at this time.')
+        send(chat_id, 'Results history was already cleared.')
 
 @bot.message_handler(commands=['results'])
 def results(message):
     chat_id = message.chat.id
-    if sql:
-        results = mem.get_results(chat_id)
-        if len(results) == 0:
-            bot.send_message(chat_id, 'No results saved in history for this chat.')
-            return
-        
-        df = pd.DataFrame()
-        df['tt'] = [row[2] for row in results]
-        df['url'] = [row[3] for row in results]
-        df['title'] = [row[4] for row in results]
-        df['polls_count'] = [row[5] for row in results]
-        df['votes_count'] = [row[6] for row in results]
-        df['wins_count'] = [row[7] for row in results]
-        df['last_poll'] = [row[8] for row in results]
-        df['last_win'] = [row[9] for row in results]
-
-        # send data frame as csv in chat
-        my_bytes = pickle.dumps(df, protocol=4)
-        file_obj = io.BytesIO()
-        df.to_excel(file_obj, index=False)
-        file_obj.name = "results.xlsx"
-        file_obj.seek(0)
-        bot.send_document(chat_id, file_obj)
-        bot.send_message(chat_id, 'Results history uploaded.')
-    else:
-        bot.send_message(chat_id, 'Results history is not supported at this time.')
+    results = mem.get_results(chat_id)
+    if len(results) == 0:
+        send(chat_id, 'No results saved in history for this chat.')
+        return
+    
+    df = pd.DataFrame()
+    df['tt'] = [row[2] for row in results]
+    df['url'] = [row[3] for row in results]
+    df['title'] = [row[4] for row in results]
+    df['polls_count'] = [row[5] for row in results]
+    df['votes_count'] = [row[6] for row in results]
+    df['wins_count'] = [row[7] for row in results]
+    df['last_poll'] = [row[8] for row in results]
+    df['last_win'] = [row[9] for row in results]
+
+    # send data frame as csv in chat
+    my_bytes = pickle.dumps(df, protocol=4)
+    file_obj = io.BytesIO()
+    df.to_excel(file_obj, index=False)
+    file_obj.name = "results.xlsx"
+    file_obj.seek(0)
+    outbox.call(chat_id, 'send_document', chat_id, file_obj, priority=PRIORITY_HIGH)
+    send(chat_id, 'Results history uploaded.', priority=PRIORITY_HIGH)
+
+if not USE_POLLING:
+    # registered once the update queue and the handlers are set up, so that updates can be taken
+    try:
+        # a single connection makes telegram deliver updates in order
+        bot.set_webhook(url=APP_URL+TOKEN, secret_token=WEBHOOK_SECRET, max_connections=1)
+    except Exception as e:
+        print(f'Could not set webhook: {e}')
 
 if __name__ == "__main__":
     if USE_POLLING:
         bot.remove_webhook()
+        offset = None
         while True:
             try:
-                bot.polling(non_stop=True)
+                for update in bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20):
+                    updates.put(update, block=True)
+                    offset = update.update_id + 1
             except Exception as e:
                 print(e)
+                time.sleep(1)
     else:
         PORT = int(os.environ.get('PORT', 5000))
         server.run(host="0.0.0.0", port=PORT)
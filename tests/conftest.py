@@ -0,0 +1,60 @@
+import os
+import sys
+import asyncio
+import importlib.util
+import pytest
+
+# the bot modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import local_mem, sqlite_mem, sql_mem, cached_mem
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+needs_database = pytest.mark.skipif(TEST_DATABASE_URL is None, reason='TEST_DATABASE_URL is not set')
+needs_asyncpg = pytest.mark.skipif(
+    importlib.util.find_spec('asyncpg') is None or importlib.util.find_spec('aiohttp') is None,
+    reason='asyncpg and aiohttp are not installed')
+
+class blocking_mem:
+    '''
+    Storage with blocking methods, running the coroutines of an async storage in an event loop of its own.
+    '''
+
+    def __init__(self, mem):
+        self.mem = mem
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def __getattr__(self, name):
+        method = getattr(self.mem, name)
+        return lambda *args, **kwargs: self.run(method(*args, **kwargs))
+
+    def close(self):
+        self.run(self.mem.close())
+        self.loop.close()
+
+# each storage backend, empty; the PostgreSQL ones reset the test database before and after
+@pytest.fixture(params=['local_mem', 'sqlite_mem', 'cached_mem', pytest.param('sql_mem', marks=needs_database),
+    pytest.param('async_sql_mem', marks=[needs_database, needs_asyncpg])])
+def mem(request, tmp_path):
+    if request.param == 'local_mem':
+        yield local_mem(str(tmp_path / 'mem'))
+    elif request.param == 'sqlite_mem':
+        yield sqlite_mem(str(tmp_path / 'mem.db'))
+    elif request.param == 'cached_mem':
+        yield cached_mem(local_mem(str(tmp_path / 'mem')))
+    else:
+        if request.param == 'sql_mem':
+            mem = sql_mem(TEST_DATABASE_URL, cache_size=0)
+        else:
+            from async_utils import async_sql_mem
+            mem = blocking_mem(async_sql_mem(TEST_DATABASE_URL))
+            mem.connect()
+        for reset in [mem.reset_database, mem.reset_results, mem.reset_prefs]:
+            reset()
+        yield mem
+        for reset in [mem.reset_database, mem.reset_results, mem.reset_prefs]:
+            reset()
+        if request.param == 'async_sql_mem':
+            mem.close()
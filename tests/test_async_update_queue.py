@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+from async_utils import async_update_queue
+
+class fake_update:
+    '''
+    Update of a chat, with only the fields the queue uses.
+    '''
+
+    def __init__(self, update_id, chat_id):
+        self.update_id = update_id
+        self.chat_id = chat_id
+
+class slow_message_bot:
+    '''
+    Bot that is slow on messages (int chat ids) and quick on poll answers (str chat ids).
+    '''
+
+    def __init__(self):
+        self.processed = []
+
+    async def process_new_updates(self, updates):
+        for update in updates:
+            await asyncio.sleep(0.1 if isinstance(update.chat_id, int) else 0)
+            self.processed.append(update.update_id)
+
+async def chat_of(update):
+    return update.chat_id
+
+def test_message_and_poll_answer_of_a_chat_are_processed_in_order():
+    async def main():
+        bot = slow_message_bot()
+        updates = async_update_queue(bot, chat_of)
+        # a message, then a poll answer, whose chat id is read from the bot memory as a string
+        assert await updates.put(fake_update(1, -1001234567890))
+        assert await updates.put(fake_update(2, '-1001234567890'))
+        assert updates.stats()['chats_waiting'] == 1
+        await asyncio.gather(*updates.tasks)
+        return bot.processed
+
+    assert asyncio.run(main()) == [1, 2]
@@ -0,0 +1,63 @@
+import random
+from collections import Counter
+import pytest
+from utils import simulate_draw
+
+def old_draw_winner(options, reroll_chance, rng):
+    '''
+    draw_winner before rerolls were simulated in memory, with the module random replaced by rng.
+    '''
+    if reroll_chance is None:
+        reroll_slots = rng.choice(list(range(1, len(options) + 1)))
+    else:
+        reroll_slots = int(len(options) * reroll_chance / (1 - reroll_chance))
+    choices = options + [None] * reroll_slots
+    reroll_chance = 100 * reroll_slots / len(choices)
+    return reroll_chance, rng.choice(choices)
+
+def old_draw(options, rng):
+    '''
+    The reroll loop of /random and poll ties before rerolls were simulated in memory.
+    '''
+    first_chance, winner = old_draw_winner(options, None, rng)
+    reroll_chance = first_chance
+    rerolls = 0
+    while winner is None:
+        rerolls += 1
+        reroll_chance, winner = old_draw_winner(options, reroll_chance, rng)
+    return first_chance, rerolls, winner
+
+def frequencies(draw, options, seed, rounds=20000):
+    rng = random.Random(seed)
+    chances, rerolls, winners = Counter(), Counter(), Counter()
+    for _ in range(rounds):
+        chance, count, winner = draw(list(options), rng)
+        chances[round(chance, 6)] += 1 / rounds
+        rerolls[count] += 1 / rounds
+        winners[winner] += 1 / rounds
+    return chances, rerolls, winners
+
+@pytest.mark.parametrize('options', [['A', 'B'], ['A', 'B', 'C'], ['A', 'B', 'C', 'D', 'E']])
+def test_draw_frequencies_match_old_loop(options):
+    old = frequencies(old_draw, options, seed=1)
+    new = frequencies(simulate_draw, options, seed=2)
+    for old_counts, new_counts in zip(old, new):
+        assert set(old_counts) == set(new_counts)
+        for key in old_counts:
+            assert new_counts[key] == pytest.approx(old_counts[key], abs=0.02)
+
+@pytest.mark.parametrize('options', [['A', 'B'], ['A', 'B', 'C', 'D']])
+def test_reroll_probability(options):
+    # the first draw has k reroll slots, k uniform in 1..n, and a reroll never rerolls again
+    n = len(options)
+    expected = sum(k / (n + k) for k in range(1, n + 1)) / n
+    _, rerolls, winners = frequencies(simulate_draw, options, seed=3)
+    assert set(rerolls) == {0, 1}
+    assert rerolls[1] == pytest.approx(expected, abs=0.02)
+    for option in options:
+        assert winners[option] == pytest.approx(1 / n, abs=0.02)
+
+def test_draw_is_repeatable_with_seeded_rng():
+    options = ['A', 'B', 'C']
+    assert [simulate_draw(options, random.Random(seed)) for seed in range(50)] == \
+        [simulate_draw(options, random.Random(seed)) for seed in range(50)]
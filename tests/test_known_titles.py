@@ -0,0 +1,61 @@
+from utils import known_titles
+
+def titles(results):
+    return [movie['title'] for movie in results]
+
+def test_users_search_the_chats_they_are_in():
+    known = known_titles([
+        ('1', 'tt0068646', 'The Godfather', 0),
+        ('2', 'tt0071562', 'The Godfather Part II', 0),
+    ], [('10', '1'), ('20', '2')])
+    assert titles(known.search(10, 'godf')) == ['The Godfather']
+    assert titles(known.search(20, 'godf')) == ['The Godfather Part II']
+    assert known.search(30, 'godf') == []
+    known.add_member(30, 1)
+    known.add_member(30, 2)
+    assert titles(known.search(30, 'the godf')) == ['The Godfather', 'The Godfather Part II']
+
+def test_movies_in_more_polls_come_first():
+    known = known_titles([
+        ('1', 'tt0068646', 'The Godfather', 1),
+        ('1', 'tt0071562', 'The Godfather Part II', 3),
+        ('2', 'tt0068646', 'The Godfather', 3),
+    ], [('10', '1'), ('10', '2')])
+    assert titles(known.search(10, 'godfather')) == ['The Godfather', 'The Godfather Part II']
+    known.clear_polls(2)
+    assert titles(known.search(10, 'godfather')) == ['The Godfather Part II', 'The Godfather']
+
+def test_choices_and_title_updates_are_not_polls():
+    known = known_titles(members=[('10', '1')])
+    # a choice saved with a placeholder title, then resolved, then chosen again by another user
+    known.add(1, 'tt0068646', 'tt0068646')
+    known.add(1, 'tt0068646', 'The Godfather')
+    known.add(1, 'tt0068646', 'The Godfather')
+    known.add(1, 'tt0071562', 'The Godfather Part II', polls=1)
+    assert titles(known.search(10, 'god')) == ['The Godfather Part II', 'The Godfather']
+    assert known.stats()['titles'] == 2
+
+def test_extra_choices_user_is_not_a_member():
+    known = known_titles([('1', 'tt0068646', 'The Godfather', 0)], [('0', '1')])
+    assert known.search(0, 'godfather') == []
+
+def test_stored_titles_and_members(mem):
+    mem.enable_results(1)
+    mem.add_choice('1_2', 2, 1, 'user2', 'tt0068646', 'url', 'The Godfather')
+    mem.add_choice('1_3', 3, 1, 'user3', 'tt0071562', 'url', 'The Godfather Part II')
+    mem.add_choice('1_0', '0', 1, 'Extra choice', 'tt0111161', 'url', 'The Shawshank Redemption')
+    mem.add_poll(1, 'poll', 'msg', ['The Godfather', 'The Godfather Part II', 'The Shawshank Redemption'],
+        ['tt0068646', 'tt0071562', 'tt0111161'])
+    mem.vote(1, 4, 0)
+    mem.add_choice('5_2', 2, 5, 'user2', None, None, None)
+    rows = sorted((str(chat_id), tt, title, polls) for chat_id, tt, title, polls in mem.get_stored_titles())
+    assert rows == [
+        ('1', 'tt0068646', 'The Godfather', 0),
+        ('1', 'tt0068646', 'The Godfather', 1),
+        ('1', 'tt0071562', 'The Godfather Part II', 0),
+        ('1', 'tt0071562', 'The Godfather Part II', 1),
+        ('1', 'tt0111161', 'The Shawshank Redemption', 0),
+        ('1', 'tt0111161', 'The Shawshank Redemption', 1),
+    ]
+    members = {(str(user_id), str(chat_id)) for user_id, chat_id in mem.get_chat_members()}
+    assert members == {('0', '1'), ('2', '1'), ('3', '1'), ('4', '1'), ('2', '5')}
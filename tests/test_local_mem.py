@@ -0,0 +1,63 @@
+import utils
+from utils import local_mem
+
+def test_chat_saved_while_evicted_keeps_changes(tmp_path, monkeypatch):
+    mem = local_mem(str(tmp_path / 'mem'), memory_budget=0, min_idle=0)
+    mem.add_choice('1_2', 2, 1, 'user', 'tt0068646', 'url', 'The Godfather')
+    mem.add_choice('3_2', 2, 3, 'user', 'tt0111161', 'url', 'The Shawshank Redemption')
+    write_atomic = utils.write_atomic
+
+    def evict_first(path, data):
+        # another thread evicts chats while this one is writing them
+        if path == mem.shard_path('1'):
+            with mem.lock:
+                mem.evict()
+                assert '1' in mem.shards
+        write_atomic(path, data)
+
+    monkeypatch.setattr(utils, 'write_atomic', evict_first)
+    mem.compact()
+    monkeypatch.setattr(utils, 'write_atomic', write_atomic)
+    with mem.lock:
+        mem.evict()
+    assert [row[4] for row in mem.get_choices(1)] == ['tt0068646']
+    assert [row[4] for row in mem.get_choices(3)] == ['tt0111161']
+
+class unscannable(dict):
+    '''
+    Poll index that fails if it is scanned.
+    '''
+
+    def items(self):
+        raise AssertionError('the poll index was scanned')
+
+def test_votes_do_not_scan_polls_of_other_chats(tmp_path):
+    path = str(tmp_path / 'mem')
+    mem = local_mem(path)
+    for chat_id in range(1, 4):
+        mem.add_choice(f'{chat_id}_2', 2, chat_id, 'user', 'tt0068646', 'url', 'The Godfather')
+        mem.add_poll(chat_id, f'old{chat_id}', '10', ['The Godfather'], ['tt0068646'])
+        mem.add_poll(chat_id, f'poll{chat_id}', '11', ['The Godfather'], ['tt0068646'])
+    mem.poll_chats = unscannable(mem.poll_chats)
+    mem.vote(2, 2, 0)
+    mem.journal.flush()
+    reloaded = local_mem(path)
+    assert [reloaded.get_chat_from_poll(f'poll{chat_id}') for chat_id in range(1, 4)] == ['1', '2', '3']
+    assert reloaded.get_chat_from_poll('old2') is None
+    assert reloaded.get_votes(2) == [('2', 0)]
+
+def test_titles_are_journaled(tmp_path, monkeypatch):
+    path = str(tmp_path / 'mem')
+    mem = local_mem(path)
+    written = []
+    write_atomic = utils.write_atomic
+    monkeypatch.setattr(utils, 'write_atomic', lambda path, data: (written.append(path), write_atomic(path, data)))
+    mem.cache_title('tt0068646', 'The Godfather', 1.0)
+    mem.cache_title('tt0111161', 'The Shawshank Redemption', 2.0)
+    assert written == []
+    mem.journal.flush()
+    reloaded = local_mem(path)
+    assert reloaded.get_cached_title('tt0068646') == ('The Godfather', 1.0)
+    # the replayed titles are saved with the chats, and survive a memory reset
+    reloaded.reset_database()
+    assert local_mem(path).get_cached_title('tt0111161') == ('The Shawshank Redemption', 2.0)
@@ -0,0 +1,40 @@
+from utils import search_cache
+
+MOVIES = [
+    {'title': 'The Godfather', 'year': '1972', 'imdb_id': 'tt0068646'},
+    {'title': 'The Godfather Part II', 'year': '1974', 'imdb_id': 'tt0071562'},
+    {'title': 'God Bless America', 'year': '2011', 'imdb_id': 'tt1912398'},
+    {'title': 'City of God', 'year': '2002', 'imdb_id': 'tt0317248'},
+]
+
+def fake_omdb(queries):
+    '''
+    Search MOVIES by whole words, like OMDb, recording the queries.
+    '''
+    def search(query):
+        queries.append(query)
+        words = query.split()
+        return [movie for movie in MOVIES if all(word in movie['title'].lower().split() for word in words)], True
+    return search
+
+def test_longer_word_is_searched():
+    queries = []
+    cache = search_cache(fake_omdb(queries))
+    assert [movie['title'] for movie in cache.get('god')] == ['God Bless America', 'City of God']
+    assert [movie['title'] for movie in cache.get('godfather')] == ['The Godfather', 'The Godfather Part II']
+    assert queries == ['god', 'godfather']
+
+def test_new_word_is_answered_from_cache():
+    queries = []
+    cache = search_cache(fake_omdb(queries))
+    cache.get('The')
+    assert [movie['title'] for movie in cache.get('the  godfather part')] == ['The Godfather Part II']
+    assert queries == ['the']
+    assert cache.stats()['prefix_hits'] == 1
+
+def test_partial_word_is_not_answered_from_cache():
+    queries = []
+    cache = search_cache(fake_omdb(queries))
+    cache.get('the')
+    assert cache.get('the godf') == []
+    assert queries == ['the', 'the godf']
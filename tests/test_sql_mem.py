@@ -0,0 +1,110 @@
+import os
+from contextlib import contextmanager
+import pytest
+from utils import sql_mem
+
+# these tests reset the database, so they only run against one set apart for them
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+pytestmark = pytest.mark.skipif(TEST_DATABASE_URL is None, reason='TEST_DATABASE_URL is not set')
+
+# round trips per operation before the writes were upserts: a SELECT, then an UPDATE or INSERT,
+# inside a transaction (BEGIN and COMMIT)
+BEFORE = {
+    'add_choice': 4,
+    'delete_choice': 3,
+    'delete_by_title': 3,
+    'delete_all_choices': 6,
+    'set_results': 4,
+}
+
+AFTER = {
+    'add_choice': 1,
+    'delete_choice': 1,
+    'delete_by_title': 1,
+    'delete_all_choices': 6,
+    'set_results': 1,
+}
+
+class counted_cursor:
+    '''
+    Cursor that counts the statements it runs.
+    '''
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter['round_trips'] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class counted_mem(sql_mem):
+    '''
+    sql_mem counting database round trips: statements, plus BEGIN and COMMIT outside autocommit.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.counter = {'round_trips': 0}
+        super().__init__(*args, **kwargs)
+
+    @contextmanager
+    def get_cursor(self, autocommit=False):
+        if not autocommit:
+            self.counter['round_trips'] += 2
+        with super().get_cursor(autocommit=autocommit) as cursor:
+            yield counted_cursor(cursor, self.counter)
+
+    def round_trips(self, method, *args):
+        self.counter['round_trips'] = 0
+        getattr(self, method)(*args)
+        return self.counter['round_trips']
+
+@pytest.fixture
+def mem():
+    mem = counted_mem(TEST_DATABASE_URL, cache_size=0)
+    mem.reset_database()
+    mem.reset_prefs()
+    yield mem
+    mem.reset_database()
+    mem.reset_prefs()
+
+def test_add_choice_round_trips(mem):
+    assert mem.round_trips('add_choice', '1_2', 2, 1, 'user', 'tt0068646', 'url', 'The Godfather') == \
+        AFTER['add_choice'] < BEFORE['add_choice']
+    # replacing a choice is the same single upsert
+    assert mem.round_trips('add_choice', '1_2', 2, 1, 'user', 'tt0111161', 'url', 'The Shawshank Redemption') == \
+        AFTER['add_choice']
+    assert [row[4] for row in mem.get_choices(1)] == ['tt0111161']
+
+def test_delete_round_trips(mem):
+    mem.add_choice('1_2', 2, 1, 'user', 'tt0068646', 'url', 'The Godfather')
+    mem.add_choice('1_3', 3, 1, 'other', 'tt0111161', 'url', 'The Shawshank Redemption')
+    mem.add_choice('1_4', 4, 1, 'third', 'tt0109830', 'url', 'Forrest Gump')
+    assert mem.round_trips('delete_choice', '1_2') == AFTER['delete_choice'] <= BEFORE['delete_choice']
+    assert mem.round_trips('delete_by_title', 1, 'Forrest Gump') == \
+        AFTER['delete_by_title'] <= BEFORE['delete_by_title']
+    assert mem.round_trips('delete_all_choices', 1) == \
+        AFTER['delete_all_choices'] <= BEFORE['delete_all_choices']
+    assert mem.get_choices(1) == []
+
+def test_set_results_round_trips(mem):
+    assert mem.round_trips('set_results', 1, True) == AFTER['set_results'] < BEFORE['set_results']
+    assert mem.round_trips('set_results', 1, True) == AFTER['set_results']
+    assert mem.round_trips('set_results', 1, False) == AFTER['set_results']
+    assert mem.results_enabled(1) is False
+
+def test_add_poll_with_a_single_connection():
+    # a second connection borrowed inside add_poll would wait forever
+    mem = sql_mem(TEST_DATABASE_URL, max_connections=1)
+    mem.reset_database()
+    mem.reset_prefs()
+    mem.set_results(1, True)
+    mem.results_cache.invalidate()
+    mem.add_poll(1, 'poll', '10', ['The Godfather', 'Forrest Gump'], ['tt0068646', 'tt0109830'])
+    assert sorted(row[2] for row in mem.get_results(1)) == ['tt0068646', 'tt0109830']
+    mem.reset_database()
+    mem.reset_prefs()
+    mem.reset_results()
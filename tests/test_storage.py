@@ -0,0 +1,74 @@
+import pytest
+from utils import storage, sql_mem, sqlite_mem, local_mem, cached_mem, get_unique_id, \
+    EXTRA_USER_ID, DUMMY_USER_ID, DUMMY_TT, DUMMY_USERNAME
+
+@pytest.mark.parametrize('backend', [sql_mem, sqlite_mem, local_mem, cached_mem])
+def test_backends_implement_storage(backend):
+    assert backend.__abstractmethods__ == frozenset()
+
+def test_incomplete_backend_fails_when_created():
+    class incomplete_mem(storage):
+        def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+            return None
+
+    with pytest.raises(TypeError):
+        incomplete_mem()
+
+def test_dummy_choice_is_kept_apart_from_the_extra_choice(mem):
+    mem.add_choice(get_unique_id(1, EXTRA_USER_ID), EXTRA_USER_ID, 1, 'Extra choice', 'tt0111161', 'url',
+        'The Shawshank Redemption')
+    mem.add_choice(get_unique_id(1, DUMMY_USER_ID), DUMMY_USER_ID, 1, DUMMY_USERNAME, DUMMY_TT, 'url',
+        'The Godfather')
+    mem.add_choice(get_unique_id(1, 2), 2, 1, 'user', 'tt0109830', 'url', 'Forrest Gump')
+    assert sorted(row[1] for row in mem.get_choices(1)) == sorted(['0', 'dummy', '2'])
+    mem.add_poll(1, 'poll', '10', ['The Shawshank Redemption', 'The Godfather', 'Forrest Gump'],
+        ['tt0111161', DUMMY_TT, 'tt0109830'])
+    # neither the extra nor the dummy choice is waited for
+    counts, complete = mem.vote(1, 2, 2)
+    assert complete
+
+def test_poll_from_choices_to_results(mem):
+    assert mem.set_results(1, True)
+    assert not mem.set_results(1, True)
+    assert mem.results_enabled(1)
+    mem.add_choice('1_2', 2, 1, 'user2', 'tt0068646', 'url', 'tt0068646')
+    assert mem.update_title('1_2', 'tt0068646', 'The Godfather')
+    assert not mem.update_title('1_2', 'tt0111161', 'The Shawshank Redemption')
+    mem.add_choice('1_3', 3, 1, 'user3', 'tt0109830', 'url', 'Forrest Gump')
+    mem.add_poll(1, 'poll', 10, ['The Godfather', 'Forrest Gump'], ['tt0068646', 'tt0109830'])
+    assert tuple(mem.get_active_poll('poll')) == ('1', '10')
+    assert mem.get_chat_from_poll('other') is None
+    assert tuple(mem.get_poll(1)) == ('1', 'poll', '10', True)
+
+    counts, complete = mem.vote(1, 2, 1)
+    assert [tuple(row) for row in counts] == [(0, 0, 'The Godfather'), (1, 1, 'Forrest Gump')] and not complete
+    counts, complete = mem.vote(1, 2, None)
+    assert [row[1] for row in counts] == [0, 0] and not complete
+    mem.vote(1, 2, 0)
+    counts, complete = mem.vote(1, 3, 0)
+    assert [row[1] for row in counts] == [2, 0] and complete
+    assert sorted((str(user_id), option_id) for user_id, option_id in mem.get_votes(1)) == [('2', 0), ('3', 0)]
+    assert [tuple(row) for row in mem.get_poll_counts(1)] == [(0, 2, 'The Godfather'), (1, 0, 'Forrest Gump')]
+
+    mem.results_win(1, 'The Godfather')
+    mem.end_poll(1)
+    assert mem.get_active_poll('poll') is None
+    assert list(mem.get_choices(1)) == []
+    results = {row[2]: row[5:8] for row in mem.get_results(1)}
+    assert {tt: tuple(counts) for tt, counts in results.items()} == {'tt0068646': (1, 2, 1), 'tt0109830': (1, 0, 0)}
+    assert mem.clear_results(1)
+    assert not mem.clear_results(1)
+
+def test_poll_without_results(mem):
+    mem.add_choice('1_2', 2, 1, 'user2', 'tt0068646', 'url', 'The Godfather')
+    mem.add_poll(1, 'poll', 10, ['The Godfather'], ['tt0068646'])
+    mem.vote(1, 2, 0)
+    assert list(mem.get_results(1)) == []
+    assert mem.delete_all_choices(1)
+    assert list(mem.get_choices(1)) == [] and list(mem.get_poll_counts(1)) == []
+
+def test_cached_titles(mem):
+    # the title cache is kept when the database is reset
+    mem.cache_title('tt0068646', 'The Godfather', 100.0)
+    mem.cache_title('tt0068646', 'The Godfather', 200.0)
+    assert tuple(mem.get_cached_title('tt0068646')) == ('The Godfather', 200.0)
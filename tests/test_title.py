@@ -0,0 +1,32 @@
+import os
+import pytest
+from utils import get_soup, get_title, title_from_chunks
+
+PAGES = os.path.join(os.path.dirname(__file__), 'pages')
+
+def chunked(html, size):
+    for i in range(0, len(html), size):
+        yield html[i:i + size]
+
+@pytest.mark.parametrize('name', sorted(os.listdir(PAGES)))
+@pytest.mark.parametrize('size', [7, 512, 2 ** 14])
+def test_stream_title_matches_soup(name, size):
+    with open(os.path.join(PAGES, name), encoding='utf-8') as f:
+        html = f.read()
+    assert title_from_chunks(chunked(html, size)) == get_title(get_soup(html))
+
+def test_stream_title_stops_after_h1():
+    with open(os.path.join(PAGES, 'tt0068646.html'), encoding='utf-8') as f:
+        html = f.read()
+    read = []
+    def counted():
+        for chunk in chunked(html, 2 ** 10):
+            read.append(chunk)
+            yield chunk
+    assert title_from_chunks(counted()) == 'The Godfather'
+    assert sum(len(chunk) for chunk in read) < len(html)
+
+def test_stream_title_falls_back_to_og_title():
+    html = '<html><head><meta property="og:title" content="Am&eacute;lie (2001) - IMDb"/>' \
+        '<title>ignored</title></head><body></body></html>'
+    assert title_from_chunks(chunked(html, 5)) == 'Amélie (2001)'
@@ -0,0 +1,61 @@
+import time
+import asyncio
+import pytest
+from utils import title_cache
+
+class fake_mem:
+    '''
+    Bot memory with only the title cache.
+    '''
+
+    def __init__(self):
+        self.titles = {}
+
+    def get_cached_title(self, tt):
+        return self.titles.get(tt)
+
+    def cache_title(self, tt, title, cached_at):
+        self.titles[tt] = (title, cached_at)
+
+class fake_index:
+    '''
+    Title index with the original titles, like the IMDb datasets.
+    '''
+
+    def get(self, tt):
+        return {'tt0245429': 'Sen to Chihiro no kamikakushi'}.get(tt)
+
+def test_saved_title_comes_before_index():
+    mem = fake_mem()
+    mem.cache_title('tt0245429', 'Spirited Away', time.time())
+    titles = title_cache(mem, index=fake_index())
+    assert titles.get('tt0245429') == 'Spirited Away'
+    assert titles.stats()['store_hits'] == 1
+    assert titles.stats()['index_hits'] == 0
+
+def test_index_is_used_when_title_is_not_saved():
+    titles = title_cache(fake_mem(), index=fake_index())
+    assert titles.get('tt0245429') == 'Sen to Chihiro no kamikakushi'
+    assert titles.get('tt0000001') is None
+    assert titles.stats()['index_hits'] == 1
+    assert titles.stats()['misses'] == 1
+    # then it comes from the in-process cache
+    assert titles.get('tt0245429') == 'Sen to Chihiro no kamikakushi'
+    assert titles.stats()['hits'] == 1
+
+class async_fake_mem(fake_mem):
+    '''
+    Async bot memory with only the title cache.
+    '''
+
+    async def get_cached_title(self, tt):
+        return super().get_cached_title(tt)
+
+def test_index_hits_are_counted_in_the_asyncio_runtime():
+    pytest.importorskip('aiohttp')
+    from async_utils import async_title_cache
+    titles = async_title_cache(async_fake_mem(), None, index=fake_index())
+    assert asyncio.run(titles.get('tt0245429')) == 'Sen to Chihiro no kamikakushi'
+    assert asyncio.run(titles.get('tt0000001')) is None
+    assert titles.stats()['index_hits'] == 1
+    assert titles.stats()['misses'] == 1
@@ -0,0 +1,48 @@
+import os
+import pytest
+from title_index import read_ratings, read_titles, write_index, title_index
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+@pytest.fixture(scope='module')
+def folder(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('index'))
+    votes = read_ratings(os.path.join(FIXTURES, 'title.ratings.tsv'))
+    titles = read_titles(os.path.join(FIXTURES, 'title.basics.tsv'), votes)
+    assert write_index(folder, titles) == (10, 24)
+    return folder
+
+def test_write_index_skips_episodes(folder):
+    index = title_index(folder)
+    assert len(index) == 10
+    assert index.get('tt0583435') is None
+    assert sorted(os.listdir(folder)) == ['postings.bin', 'titles.bin', 'titles.txt', 'tokens.bin', 'tokens.txt']
+
+def test_get(folder):
+    index = title_index(folder)
+    assert index.get('tt0068646') == 'The Godfather'
+    assert index.get('tt0245429') == 'Sen to Chihiro no kamikakushi'
+    assert index.get('tt0000001') is None
+    assert index.get('tt9999999') is None
+    assert index.stats()['hits'] == 2
+    assert index.stats()['misses'] == 2
+
+def test_search_by_word_prefix_most_voted_first(folder):
+    index = title_index(folder)
+    assert index.search('god') == [
+        {'title': 'The Godfather', 'year': '1972', 'imdb_id': 'tt0068646'},
+        {'title': 'The Godfather Part II', 'year': '1974', 'imdb_id': 'tt0071562'},
+        {'title': 'City of God', 'year': '2002', 'imdb_id': 'tt0317248'},
+        {'title': 'Godzilla', 'year': '1954', 'imdb_id': 'tt0047034'},
+        {'title': 'God Bless America', 'year': '2011', 'imdb_id': 'tt1912398'},
+        {'title': "God's Own Country", 'year': '2017', 'imdb_id': 'tt5635026'},
+        {'title': 'Untitled Godfather Project', 'year': '', 'imdb_id': 'tt9999998'},
+    ]
+    assert [movie['title'] for movie in index.search('The  GODF par', limit=1)] == ['The Godfather Part II']
+    assert index.search('godfather zilla') == []
+    assert index.search('!') == []
+
+def test_candidates_are_the_most_voted_across_words(folder):
+    # "god" comes before "godfather" among the words, but its titles have fewer votes
+    index = title_index(folder, max_candidates=2)
+    assert [movie['title'] for movie in index.search('god')] == ['The Godfather', 'The Godfather Part II']
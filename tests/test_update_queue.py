@@ -0,0 +1,91 @@
+import os
+import time
+import threading
+import pytest
+from utils import update_queue, memory_store, sql_store
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+class fake_update:
+    '''
+    Update of a chat, with only the fields the queue uses.
+    '''
+
+    def __init__(self, update_id, chat_id):
+        self.update_id = update_id
+        self.chat_id = chat_id
+
+class recording_bot:
+    '''
+    Bot that records the updates it processes, slowly, in a list shared with other bots.
+    '''
+
+    def __init__(self, processed, delay=0.01):
+        self.processed = processed
+        self.delay = delay
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            time.sleep(self.delay)
+            self.processed.append(update.update_id)
+
+def make_stores():
+    stores = [memory_store]
+    if TEST_DATABASE_URL is not None:
+        stores.append(lambda: sql_store(TEST_DATABASE_URL, max_connections=8))
+    return stores
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@pytest.mark.parametrize('make_store', make_stores())
+def test_updates_of_a_chat_are_processed_in_order_across_processes(make_store):
+    store = make_store()
+    processed = []
+    # two queues sharing a store stand for two processes; updates of the chat alternate between them
+    processes = [update_queue(recording_bot(processed), lambda update: update.chat_id, lanes=2, store=store)
+        for i in range(2)]
+    for update_id in range(1, 41):
+        assert processes[update_id % 2].put(fake_update(update_id, 7), block=True)
+    assert wait_until(lambda: len(processed) == 40)
+    assert processed == list(range(1, 41))
+
+@pytest.mark.skipif(TEST_DATABASE_URL is None, reason='TEST_DATABASE_URL is not set')
+def test_lock_outlives_its_lease_while_held():
+    store = sql_store(TEST_DATABASE_URL, max_connections=4, lease=0.3)
+    events = []
+
+    def other():
+        with store.lock('chat:lease'):
+            events.append('other')
+
+    with store.lock('chat:lease'):
+        thread = threading.Thread(target=other)
+        thread.start()
+        time.sleep(1)
+        events.append('holder')
+    thread.join(timeout=5)
+    assert events == ['holder', 'other']
+
+class slow_message_bot(recording_bot):
+    '''
+    Bot that is slow on messages (int chat ids) and quick on poll answers (str chat ids).
+    '''
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            time.sleep(0.2 if isinstance(update.chat_id, int) else 0)
+            self.processed.append(update.update_id)
+
+@pytest.mark.parametrize('chat_id', [-1001234567890, -1001234567891, -1001234567892, 123456789])
+def test_message_and_poll_answer_of_a_chat_are_processed_in_order(chat_id):
+    processed = []
+    updates = update_queue(slow_message_bot(processed), lambda update: update.chat_id, lanes=8)
+    # a message, then a poll answer, whose chat id is read from the bot memory as a string
+    assert updates.put(fake_update(1, chat_id))
+    assert updates.put(fake_update(2, str(chat_id)))
+    assert wait_until(lambda: len(processed) == 2)
+    assert processed == [1, 2]
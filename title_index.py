@@ -0,0 +1,267 @@
+# run this script to build an offline title index from the IMDb datasets (https://datasets.imdbws.com)
+# download title.basics.tsv.gz, and optionally title.ratings.tsv.gz to rank search results by votes, then run:
+#   python title_index.py title.basics.tsv.gz [title.ratings.tsv.gz] [index folder]
+# the index is saved in the imdb_index folder, set TITLE_INDEX when using another one
+# titles and searches found in the index are answered without going to IMDb or OMDb
+
+# import packages
+import os
+import re
+import sys
+import gzip
+import mmap
+import time
+import struct
+import bisect
+import heapq
+import threading
+from array import array
+from collections import defaultdict
+
+# title types kept in the index, tvEpisode (most of the dataset) and videoGame are left out
+TITLE_TYPES = {'movie', 'tvMovie', 'tvSeries', 'tvMiniSeries', 'tvSpecial', 'tvShort', 'short', 'video'}
+
+# tt number, offset and length of the title in titles.txt, start year, number of votes
+TITLE_RECORD = struct.Struct('<IIHHI')
+# offset and length of the token in tokens.txt, offset and length of its postings in postings.bin
+TOKEN_RECORD = struct.Struct('<IHII')
+
+def tokenize(text):
+    '''
+    Split text in lowercase words.
+    '''
+    return re.findall(r'\w+', text.lower())
+
+def open_dataset(path):
+    '''
+    Open an IMDb dataset file, gzipped or not, and skip its header.
+    '''
+    f = gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')
+    f.readline()
+    return f
+
+def read_ratings(path):
+    '''
+    Get number of votes by tt number from title.ratings.tsv.
+    '''
+    votes = {}
+    with open_dataset(path) as f:
+        for line in f:
+            tconst, _, num_votes = line.rstrip('\n').split('\t')
+            votes[int(tconst[2:])] = int(num_votes)
+    return votes
+
+def read_titles(path, votes):
+    '''
+    Get (tt number, title, start year, votes) of the titles in title.basics.tsv, sorted by tt.
+    '''
+    titles = []
+    with open_dataset(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6 or fields[1] not in TITLE_TYPES:
+                continue
+            tt = int(fields[0][2:])
+            year = int(fields[5]) if fields[5].isdigit() else 0
+            titles.append((tt, fields[2], year, votes.get(tt, 0)))
+    titles.sort()
+    return titles
+
+def write_index(folder, titles):
+    '''
+    Write index files for titles in folder. Files are replaced at the end,
+    so that a bot using the old index keeps working until it is restarted.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    postings = defaultdict(lambda: array('I'))
+    with open(os.path.join(folder, 'titles.bin.tmp'), 'wb') as records, \
+            open(os.path.join(folder, 'titles.txt.tmp'), 'wb') as text:
+        offset = 0
+        for i, (tt, title, year, votes) in enumerate(titles):
+            encoded = title.encode('utf-8')[:65535]
+            records.write(TITLE_RECORD.pack(tt, offset, len(encoded), min(year, 65535), min(votes, 2 ** 32 - 1)))
+            text.write(encoded)
+            offset += len(encoded)
+            for token in set(tokenize(title)):
+                postings[token.encode('utf-8')[:65535]].append(i)
+    with open(os.path.join(folder, 'tokens.bin.tmp'), 'wb') as records, \
+            open(os.path.join(folder, 'tokens.txt.tmp'), 'wb') as text, \
+            open(os.path.join(folder, 'postings.bin.tmp'), 'wb') as postings_file:
+        offset = 0
+        position = 0
+        for token in sorted(postings):
+            # most voted titles first, so that searches can stop early
+            ids = sorted(postings[token], key=lambda i: -titles[i][3])
+            records.write(TOKEN_RECORD.pack(offset, len(token), position, len(ids)))
+            text.write(token)
+            array('I', ids).tofile(postings_file)
+            offset += len(token)
+            position += len(ids)
+    for name in ['titles.bin', 'titles.txt', 'tokens.bin', 'tokens.txt', 'postings.bin']:
+        os.replace(os.path.join(folder, name + '.tmp'), os.path.join(folder, name))
+    return len(titles), len(postings)
+
+def map_file(path):
+    '''
+    Memory-map a file for reading. Empty files are not mapped.
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class record_keys:
+    '''
+    Sequence of the keys of fixed-size records in a memory-mapped file, for bisect.
+    '''
+
+    def __init__(self, data, record, key):
+        self.data = data
+        self.record = record
+        self.key = key
+
+    def __len__(self):
+        return len(self.data) // self.record.size
+
+    def __getitem__(self, i):
+        return self.key(self.record.unpack_from(self.data, i * self.record.size))
+
+class title_index:
+    '''
+    Offline movie title index built by this script from the IMDb datasets.
+    The index files are memory-mapped, so they are shared by all processes and only the parts
+    that are read are loaded. Titles are looked up by tt with a binary search over records
+    sorted by tt, and searched by word prefix through a sorted token list.
+    '''
+
+    def __init__(self, folder, max_candidates=5000):
+        self.folder = folder
+        self.max_candidates = max_candidates
+        self.titles = map_file(os.path.join(folder, 'titles.bin'))
+        self.text = map_file(os.path.join(folder, 'titles.txt'))
+        self.tokens = map_file(os.path.join(folder, 'tokens.bin'))
+        self.token_text = map_file(os.path.join(folder, 'tokens.txt'))
+        self.postings = map_file(os.path.join(folder, 'postings.bin'))
+        self.tt_keys = record_keys(self.titles, TITLE_RECORD, lambda record: record[0])
+        self.token_keys = record_keys(self.tokens, TOKEN_RECORD,
+            lambda record: self.token_text[record[0]:record[0] + record[1]])
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.search_hits = 0
+        self.search_misses = 0
+
+    def __len__(self):
+        return len(self.tt_keys)
+
+    def title(self, i):
+        '''
+        Get (tt number, title, start year, votes) of record i.
+        '''
+        tt, offset, length, year, votes = TITLE_RECORD.unpack_from(self.titles, i * TITLE_RECORD.size)
+        return tt, self.text[offset:offset + length].decode('utf-8'), year, votes
+
+    def get(self, tt):
+        '''
+        Get title for tt. Returns None if not in the index.
+        '''
+        number = int(tt[2:])
+        i = bisect.bisect_left(self.tt_keys, number)
+        found = i < len(self.tt_keys) and self.tt_keys[i] == number
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return self.title(i)[1] if found else None
+
+    def votes(self, i):
+        '''
+        Get votes of record i.
+        '''
+        return TITLE_RECORD.unpack_from(self.titles, i * TITLE_RECORD.size)[4]
+
+    def posting_list(self, position, count, chunk=256):
+        '''
+        Get (-votes, record) of a token's postings, most voted first, read in chunks.
+        '''
+        for start in range(position, position + count, chunk):
+            postings = array('I')
+            postings.frombytes(self.postings[start * 4:min(start + chunk, position + count) * 4])
+            for i in postings:
+                yield -self.votes(i), i
+
+    def matching(self, prefix):
+        '''
+        Get records of the most voted titles with a word starting with prefix, at most max_candidates.
+        '''
+        prefix = prefix.encode('utf-8')
+        lists = []
+        i = bisect.bisect_left(self.token_keys, prefix)
+        while i < len(self.token_keys):
+            offset, length, position, count = TOKEN_RECORD.unpack_from(self.tokens, i * TOKEN_RECORD.size)
+            if not self.token_text[offset:offset + length].startswith(prefix):
+                break
+            lists.append(self.posting_list(position, count))
+            i += 1
+        # postings of each token are sorted by votes, so merging them keeps the most voted across tokens
+        ids = set()
+        for _, i in heapq.merge(*lists):
+            if len(ids) >= self.max_candidates:
+                break
+            ids.add(i)
+        return ids
+
+    def search(self, query, limit=10):
+        '''
+        Search titles with a word starting with each word of query, most voted first.
+        Returns dicts with title, year and imdb_id, like OMDBClient.search.
+        '''
+        words = tokenize(query)
+        results = []
+        if len(words) > 0:
+            # the longest word is usually the one matching fewest titles
+            ids = self.matching(max(words, key=len))
+            for i in ids:
+                tt, title, year, votes = self.title(i)
+                title_words = tokenize(title)
+                if all(any(word.startswith(part) for word in title_words) for part in words):
+                    results.append((votes, tt, title, year))
+            results.sort(key=lambda result: (-result[0], result[1]))
+        with self.lock:
+            if len(results) > 0:
+                self.search_hits += 1
+            else:
+                self.search_misses += 1
+        return [{'title': title, 'year': str(year) if year > 0 else '', 'imdb_id': f'tt{tt:07d}'}
+            for _, tt, title, year in results[:limit]]
+
+    def stats(self):
+        '''
+        Get index size and hit/miss counters.
+        '''
+        with self.lock:
+            return {
+                'titles': len(self),
+                'hits': self.hits,
+                'misses': self.misses,
+                'search_hits': self.search_hits,
+                'search_misses': self.search_misses
+            }
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python title_index.py title.basics.tsv.gz [title.ratings.tsv.gz] [index folder]')
+        sys.exit(1)
+    basics = sys.argv[1]
+    ratings = None
+    folder = 'imdb_index'
+    for arg in sys.argv[2:]:
+        if 'ratings' in os.path.basename(arg):
+            ratings = arg
+        else:
+            folder = arg
+    start = time.perf_counter()
+    votes = read_ratings(ratings) if ratings is not None else {}
+    count, tokens = write_index(folder, read_titles(basics, votes))
+    print(f'Indexed {count} titles and {tokens} words in {folder} ({time.perf_counter() - start:.1f} s)')
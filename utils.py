@@ -1,12 +1,41 @@
 import os
 import re
+import atexit
 import bs4
 import requests
 import pickle
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
+import sqlite3
+import datetime
 import random
+import time
+import threading
+import codecs
+import heapq
+import bisect
+import queue
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import requests.adapters
+from html.parser import HTMLParser
 from urllib.parse import urlparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from telebot.handler_backends import HandlerBackend
+from title_index import tokenize
+
+# user id of extra choices
+EXTRA_USER_ID = '0'
+# choice saved by /choosedummy, under a user of its own
+DUMMY_USER_ID = 'dummy'
+DUMMY_TT = 'tt0068646'
+DUMMY_USERNAME = 'dummy'
+# users of the choices that polls do not wait for a vote from
+NON_VOTING_USER_IDS = (EXTRA_USER_ID, DUMMY_USER_ID)
 
 # list of exclamations
 exclamations = [
@@ -50,11 +79,86 @@ def ordinal(x):
         suffix = ["th", "st", "nd", "rd", "th"][min(x % 10, 4)]
     return str(x) + suffix
 
+class http_session(requests.Session):
+    '''
+    Shared HTTP session for all outbound lookups (IMDb and OMDb).
+    Keeps connections alive in a pool, limits concurrent connections per host,
+    applies connect/read timeouts, retries failed GETs with jittered exponential
+    backoff and records latency metrics per host.
+    '''
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_hosts=10, max_per_host=4, connect_timeout=3.05, read_timeout=10,
+        retries=2, backoff=0.5):
+        super().__init__()
+        # pool_block makes the per-host pool a hard concurrency limit
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_hosts, pool_maxsize=max_per_host, pool_block=True)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = defaultdict(lambda: {
+            'requests': 0, 'errors': 0, 'retries': 0, 'latencies': deque(maxlen=1000)})
+        self.metrics_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlparse(url).hostname
+        retries = self.retries if method.upper() in ('GET', 'HEAD') else 0
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(host, time.perf_counter() - start, True, attempt > 0)
+                if attempt == retries:
+                    raise
+            else:
+                failed = response.status_code in self.retry_status
+                self.record(host, time.perf_counter() - start, failed, attempt > 0)
+                if not failed or attempt == retries:
+                    return response
+                response.close()
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def record(self, host, latency, error, retry):
+        '''
+        Record a request in the metrics of host.
+        '''
+        with self.metrics_lock:
+            metrics = self.metrics[host]
+            metrics['requests'] += 1
+            metrics['errors'] += error
+            metrics['retries'] += retry
+            metrics['latencies'].append(latency)
+
+    def stats(self):
+        '''
+        Get request counters and latency percentiles (in seconds) per host.
+        '''
+        stats = {}
+        with self.metrics_lock:
+            for host, metrics in self.metrics.items():
+                latencies = sorted(metrics['latencies'])
+                stats[host] = {
+                    'requests': metrics['requests'],
+                    'errors': metrics['errors'],
+                    'retries': metrics['retries'],
+                    'p50': latencies[len(latencies) // 2] if latencies else None,
+                    'p99': latencies[int(len(latencies) * 0.99)] if latencies else None
+                }
+        return stats
+
+http = http_session()
+
 def getHTML(url):
     '''
     Get HTML from url
     '''
-    response = requests.get(url, headers = {"Accept-Language": "en-US", 'User-Agent': 'Mozilla/5.0'})
+    response = http.get(url, headers = {"Accept-Language": "en-US", 'User-Agent': 'Mozilla/5.0'})
     return response.text
 
 def get_soup(html):
@@ -81,6 +185,91 @@ def get_title(soup):
     title = soup.find('h1').text
     return title
 
+class title_parser(HTMLParser):
+    '''
+    Incremental HTML parser that keeps only what is needed to get a page title:
+    og:title, <title> and the text of the first <h1>.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.og_title = None
+        self.title = None
+        self.h1 = None
+        self.h1_depth = 0
+        self.in_title = False
+        self.text = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'h1':
+            self.h1_depth += 1
+        elif tag == 'title' and self.title is None and self.h1_depth == 0:
+            self.in_title = True
+        elif tag == 'meta' and self.og_title is None:
+            attrs = dict(attrs)
+            if attrs.get('property') == 'og:title':
+                self.og_title = attrs.get('content')
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == 'h1' and self.h1_depth > 0:
+            self.h1_depth -= 1
+            if self.h1_depth == 0:
+                self.h1 = ''.join(self.text)
+                self.done = True
+        elif tag == 'title' and self.in_title:
+            self.title = ''.join(self.text)
+            self.text = []
+            self.in_title = False
+
+    def handle_data(self, data):
+        if not self.done and (self.h1_depth > 0 or self.in_title):
+            self.text.append(data)
+
+    def get_title(self):
+        '''
+        Get the same title get_title would get from the soup (the first <h1>).
+        If the page has no <h1>, fall back to og:title or <title>.
+        '''
+        if self.h1 is not None:
+            return self.h1
+        fallback = self.og_title or self.title
+        if fallback is None:
+            raise ValueError('No title found in page')
+        return re.sub(r"\s+-\s+IMDb$", "", fallback.strip())
+
+def title_from_chunks(chunks, max_bytes=2 ** 21):
+    '''
+    Get title from an iterable of html chunks (str), reading only until
+    the first <h1> is closed or max_bytes have been read.
+    '''
+    parser = title_parser()
+    read = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        read += len(chunk)
+        if parser.done or read >= max_bytes:
+            break
+    return parser.get_title()
+
+def get_title_stream(url, max_bytes=2 ** 21):
+    '''
+    Get title from url without downloading or parsing the whole page.
+    Returns the same string as get_title(get_soup(getHTML(url))).
+    '''
+    response = http.get(url, headers = {"Accept-Language": "en-US", 'User-Agent': 'Mozilla/5.0'},
+        stream=True)
+    try:
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size=2 ** 14))
+        return title_from_chunks(chunks, max_bytes=max_bytes)
+    finally:
+        response.close()
+
 def imdb_url(tt):
     '''
     Create imdb url from tt
@@ -96,568 +285,3955 @@ def get_unique_id(chat_id, user_id):
     '''
     return f"{chat_id}_{user_id}"
 
-class sql_mem:
+def split_unique_id(unique_id):
     '''
-    Bot "memory". Synced to SQL database.
+    Get chat_id and user_id (as strings) from unique id
     '''
+    chat_id, user_id = unique_id.split('_', 1)
+    return chat_id, user_id
 
-    def __init__(self, DATABASE_URL):
-        self.DATABASE_URL = DATABASE_URL
-        self.get_database_connection()
-        self.initialize_database()
+def top_titles(counts):
+    '''
+    Get titles with the most votes from poll counts, given as (option_id, count, title).
+    '''
+    if len(counts) == 0:
+        return []
+    max_votes = max([i[1] for i in counts])
+    return [i[2] for i in counts if i[1] == max_votes]
 
-    def get_database_connection(self):
+def draw_winner(options, reroll_chance=None, rng=random):
+    '''
+    Randomly select one of the options, with extra slots for a reroll.
+    Returns the reroll_chance (in %) and the winner, which is None if there is a reroll.
+    '''
+    if reroll_chance is None:
+        reroll_slots = rng.randint(1, len(options))
+    else:
+        reroll_slots = int(len(options) * reroll_chance / (1 - reroll_chance))
+    
+    choices = options + [None] * reroll_slots
+    reroll_chance = 100 * reroll_slots / len(choices)
+
+    return reroll_chance, rng.choice(choices)
+
+def simulate_draw(options, rng=random):
+    '''
+    Draw a winner from the options, rerolling until there is one.
+    Returns the reroll_chance (in %) of the first draw, the number of rerolls and the winner.
+    Rerolls are drawn like draw_winner does when given the previous reroll_chance. As that chance is
+    a percentage and not a fraction, a reroll has no reroll slots left, so there is at most one.
+    '''
+    first_chance, winner = draw_winner(options, rng=rng)
+    reroll_chance = first_chance
+    rerolls = 0
+    while winner is None:
+        rerolls += 1
+        reroll_chance, winner = draw_winner(options, reroll_chance, rng)
+    return first_chance, rerolls, winner
+
+def group_messages(parts, max_messages=1):
+    '''
+    Group message parts into at most max_messages messages.
+    Parts are sent on their own until the last message, which gets the rest of them.
+    '''
+    max_messages = max(1, max_messages)
+    if len(parts) <= max_messages:
+        return parts
+    return parts[:max_messages - 1] + ['\n'.join(parts[max_messages - 1:])]
+
+class title_cache:
+    '''
+    Movie title cache keyed by tt tag.
+    In-process LRU with a size limit, backed by the bot memory (sql_mem or local_mem),
+    with entries expiring after ttl seconds.
+    If an offline title index is given, titles missing from both are looked up there before IMDb.
+    '''
+
+    def __init__(self, mem, max_size=1024, ttl=30 * 24 * 3600, index=None):
+        self.mem = mem
+        self.max_size = max_size
+        self.ttl = ttl
+        self.index = index
+        self.titles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.index_hits = 0
+        self.misses = 0
+
+    def get(self, tt):
         '''
-        Get database connection.
+        Get cached title for tt. Returns None if not cached or expired.
         '''
-        result = urlparse(self.DATABASE_URL)
-        username = result.username
-        password = result.password
-        database = result.path[1:]
-        hostname = result.hostname
-        port = result.port
-        
-        self.connection = psycopg2.connect(
-            database = database,
-            user = username,
-            password = password,
-            host = hostname,
-            port = port
-        )
-        self.cursor = self.connection.cursor()
-
-    def initialize_database(self):
-        '''
-        Create tables for the bot in the database.
-        '''
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS user_choices "\
-            "(unique_id TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT, username TEXT, "\
-                "tt TEXT, url TEXT, title TEXT);")
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS users_voted "\
-            "(unique_user_chat TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT, option_id INT);")
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS polls "\
-            "(chat_id TEXT PRIMARY KEY, poll_id TEXT, msg_id TEXT, poll_active BOOLEAN);")
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS poll_counts "\
-            "(unique_title TEXT PRIMARY KEY, chat_id TEXT, poll_id TEXT, "\
-                "option_id INT, title TEXT, count INT);")
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS enable_results "\
-            "(chat_id TEXT PRIMARY KEY, enable_results BOOLEAN);")
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS results "\
-            "(unique_tt TEXT PRIMARY KEY, chat_id TEXT, tt TEXT, url TEXT, title TEXT, "\
-                "polls_count INT, votes_count INT, wins_count INT, last_poll DATE, last_win DATE);")
-        self.connection.commit()
-    
-    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        now = time.time()
+        with self.lock:
+            if tt in self.titles:
+                title, cached_at = self.titles[tt]
+                if now - cached_at < self.ttl:
+                    self.titles.move_to_end(tt)
+                    self.hits += 1
+                    return title
+                del self.titles[tt]
+        cached = self.mem.get_cached_title(tt)
+        if cached is not None:
+            title, cached_at = cached
+            if now - cached_at < self.ttl:
+                self.remember(tt, title, cached_at)
+                with self.lock:
+                    self.store_hits += 1
+                return title
+        # the index has the original titles, so titles already saved from IMDb come first
+        if self.index is not None:
+            title = self.index.get(tt)
+            if title is not None:
+                self.remember(tt, title, now)
+                with self.lock:
+                    self.index_hits += 1
+                return title
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def remember(self, tt, title, cached_at):
         '''
-        Add choice to memory.
+        Save title in the in-process LRU, evicting the least recently used entries.
         '''
-        self.cursor.execute(
-                "SELECT * FROM user_choices WHERE unique_id = %s", (unique_id,))
-        if self.cursor.rowcount > 0:
-            self.cursor.execute(
-                """UPDATE user_choices
-                SET user_id = %s, chat_id = %s, username = %s, tt = %s, url = %s, title = %s
-                WHERE unique_id = %s;""", (str(user_id), str(chat_id), username, tt, url, title, unique_id))
-        else:
-            self.cursor.execute(
-                """INSERT INTO user_choices
-                (unique_id, user_id, chat_id, username, tt, url, title)
-                VALUES (%s, %s, %s, %s, %s, %s, %s);""",
-                (unique_id, str(user_id), str(chat_id), username, tt, url, title))
-        self.connection.commit()
-    
-    def delete_choice(self, unique_id):
+        with self.lock:
+            self.titles[tt] = (title, cached_at)
+            self.titles.move_to_end(tt)
+            while len(self.titles) > self.max_size:
+                self.titles.popitem(last=False)
+
+    def put(self, tt, title):
         '''
-        Delete choice from memory. Returns True if successful, False otherwise.
+        Save title in cache and in the bot memory.
         '''
-        self.cursor.execute(
-                "DELETE FROM user_choices WHERE unique_id = %s;", (unique_id,))
-        self.connection.commit()
-        if self.cursor.rowcount > 0:
-            return True
-        else:
-            return False
-    
-    def delete_by_title(self, chat_id, title):
+        cached_at = time.time()
+        self.remember(tt, title, cached_at)
+        self.mem.cache_title(tt, title, cached_at)
+
+    def resolve(self, tt):
         '''
-        Delete choice from memory. Returns True if successful, False otherwise.
+        Get title for tt, from cache if possible. Otherwise, get it from IMDb.
         '''
-        self.cursor.execute(
-                "DELETE FROM user_choices WHERE chat_id = %s AND title = %s;", (str(chat_id), title))
-        self.connection.commit()
-        if self.cursor.rowcount > 0:
-            return True
-        else:
-            return False
-    
-    def delete_all_choices(self, chat_id):
+        title = self.get(tt)
+        if title is None:
+            title = get_title_stream(imdb_url(tt))
+            self.put(tt, title)
+        return title
+
+    def stats(self):
         '''
-        Delete all choices from memory. Returns True if successful, False otherwise.
+        Get cache hit/miss counters.
         '''
-        result = False
-        
-        self.cursor.execute("DELETE FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            result = True
-        self.cursor.execute("DELETE FROM users_voted WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            result = True
-        self.cursor.execute("DELETE FROM poll_counts WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            result = True
-        self.cursor.execute("UPDATE polls SET poll_active = FALSE WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            result = True
-
-        self.connection.commit()
+        with self.lock:
+            return {
+                'size': len(self.titles),
+                'hits': self.hits,
+                'store_hits': self.store_hits,
+                'index_hits': self.index_hits,
+                'misses': self.misses
+            }
 
-        return result
-    
-    def get_choices(self, chat_id):
+def omdb_search(client, query):
+    '''
+    Search movies on OMDb with an OMDBClient.
+    Returns the first page of results and whether it holds every match for the query.
+    '''
+    data = client.request(s=query).json()
+    results = client.format_search_list(data.get('Search', []))
+    if data.get('Response') == 'True':
+        complete = int(data.get('totalResults', 0)) <= len(results)
+    else:
+        complete = data.get('Error') == 'Movie not found!'
+    return results, complete
+
+def normalize_query(query):
+    '''
+    Normalize search query: lowercase, with single spaces between words.
+    '''
+    return ' '.join(query.lower().split())
+
+def title_matches(title, query):
+    '''
+    Check if every word of query is a word of the title, as OMDb matches whole words.
+    '''
+    words = set(tokenize(title))
+    return all(part in words for part in tokenize(query))
+
+class search_cache:
+    '''
+    Cache of OMDb search results keyed by normalized query, with a size limit (LRU)
+    and entries expiring after ttl seconds.
+    Concurrent searches for the same query share a single OMDb request.
+    A query can also be answered from the results of a shorter query of whole words it starts with
+    ("the godfather" from "the"), if those were all the matches OMDb had.
+    '''
+
+    def __init__(self, search, max_size=1024, ttl=24 * 3600, min_length=3):
+        self.search = search
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_length = min_length
+        self.results = OrderedDict()
+        self.searching = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    def lookup(self, query):
         '''
-        Get choices for a chat.
+        Get cached results for a normalized query, or filtered results of a shorter one.
+        Returns None if neither is cached. Call with lock held.
         '''
-        self.cursor.execute(
-            "SELECT * FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
-        try:
-            return self.cursor.fetchall()
-        except:
-            return None
-    
-    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        now = time.time()
+        if query in self.results:
+            results, complete, cached_at = self.results[query]
+            if now - cached_at < self.ttl:
+                self.results.move_to_end(query)
+                self.hits += 1
+                return results
+            del self.results[query]
+        for length in range(len(query) - 1, self.min_length - 1, -1):
+            # OMDb matches whole words, so results for "god" do not have "godfather"
+            if query[length] != ' ':
+                continue
+            prefix = query[:length]
+            if prefix not in self.results:
+                continue
+            results, complete, cached_at = self.results[prefix]
+            if not complete or now - cached_at >= self.ttl:
+                continue
+            # an empty match is looked up, as OMDb may match words differently
+            matches = [movie for movie in results if title_matches(movie['title'], query)]
+            if len(matches) > 0:
+                self.results.move_to_end(prefix)
+                self.prefix_hits += 1
+                return matches
+        return None
+
+    def save(self, query, results, complete):
         '''
-        Add poll to memory.
+        Save results of a normalized query, evicting the least recently used queries. Call with lock held.
         '''
-        unique_titles = [get_unique_id(str(chat_id), i) for i in range(len(titles))]
-        unique_tts = [get_unique_id(str(chat_id), tt) for tt in tts]
-        urls = [imdb_url(tt) for tt in tts]
-        
-        self.cursor.execute("SELECT * FROM polls WHERE chat_id = %s", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            self.cursor.execute(
-                """UPDATE polls
-                SET poll_id = %s, msg_id = %s, poll_active = %s
-                WHERE chat_id = %s;""", (poll_id, msg_id, True, str(chat_id)))
-        else:
-            self.cursor.execute(
-                """INSERT INTO polls
-                (chat_id, poll_id, msg_id, poll_active)
-                VALUES (%s, %s, %s, %s);""", (str(chat_id), poll_id, msg_id, True))
-        
-        self.cursor.execute(
-            "DELETE FROM poll_counts WHERE chat_id = %s;", (str(chat_id),))
-        for i in range(len(titles)):
-            self.cursor.execute(
-                """INSERT INTO poll_counts
-                (unique_title, chat_id, poll_id, option_id, title, count)
-                VALUES (%s, %s, %s, %s, %s, %s);""",
-                (unique_titles[i], str(chat_id), poll_id, i, titles[i], 0))
-        
-            self.cursor.execute(
-                "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-            if self.cursor.rowcount > 0:
-                enable_results = self.cursor.fetchone()[0]
-                if enable_results:
-                    self.cursor.execute(
-                        "SELECT * FROM results WHERE unique_tt = %s;", (unique_tts[i],))
-                    if self.cursor.rowcount > 0:
-                        self.cursor.execute(
-                            """UPDATE results
-                            SET polls_count = polls_count + 1, last_poll = CAST(CURRENT_TIMESTAMP AS DATE)
-                            WHERE unique_tt = %s;""", (unique_tts[i],))
-                    else:
-                        self.cursor.execute(
-                            """INSERT INTO results
-                            (unique_tt, chat_id, tt, url, title, polls_count, votes_count, wins_count, last_poll, last_win)
-                            VALUES (%s, %s, %s, %s, %s, 1, 0, 0, CAST(CURRENT_TIMESTAMP AS DATE), NULL);""",
-                            (unique_tts[i], str(chat_id), tts[i], urls[i], titles[i]))
-        
-        self.connection.commit()
-    
-    def get_chat_from_poll(self, poll_id):
+        if self.max_size > 0:
+            self.results[query] = (results, complete, time.time())
+            self.results.move_to_end(query)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def get(self, query):
         '''
-        Check if poll exists. Returns chat_id if exists, None otherwise.
+        Get search results for query, from cache if possible. Otherwise, search OMDb.
         '''
-        self.cursor.execute(
-            "SELECT chat_id FROM polls WHERE poll_id = %s AND poll_active = %s;", (poll_id, True))
+        query = normalize_query(query)
+        with self.lock:
+            results = self.lookup(query)
+            if results is not None:
+                return results
+            searching = self.searching.get(query)
+            if searching is None:
+                searching = self.searching[query] = {'done': threading.Event(), 'results': None}
+                self.misses += 1
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+        if not owner:
+            searching['done'].wait()
+            if searching['results'] is None:
+                # the shared search failed, so this one searches on its own
+                return self.search(query)[0]
+            return searching['results']
         try:
-            return self.cursor.fetchone()[0]
-        except:
-            return None
-    
-    def get_msg_from_poll(self, poll_id):
+            results, complete = self.search(query)
+            searching['results'] = results
+            with self.lock:
+                self.save(query, results, complete)
+            return results
+        finally:
+            with self.lock:
+                del self.searching[query]
+            searching['done'].set()
+
+    def stats(self):
         '''
-        Check if poll exists. Returns msg_id if exists, None otherwise.
+        Get cache hit/miss counters.
         '''
-        self.cursor.execute(
-            "SELECT msg_id FROM polls WHERE poll_id = %s AND poll_active = %s;", (poll_id, True))
-        try:
-            return self.cursor.fetchone()[0]
-        except:
-            return None
-    
-    def add_vote(self, chat_id, user_id, option_id):
+        with self.lock:
+            return {
+                'size': len(self.results),
+                'hits': self.hits,
+                'prefix_hits': self.prefix_hits,
+                'shared': self.shared,
+                'misses': self.misses
+            }
+
+class known_titles:
+    '''
+    In-memory search index of the movies stored by the bot (choices and results), per chat.
+    Words of the titles of each chat are kept in a sorted list, so that titles are searched by word prefix
+    with a bisect. A user searches the chats they chose or voted in, and movies that were in more polls
+    of those chats (polls_count in results) are ranked first.
+    '''
+
+    def __init__(self, rows=(), members=()):
+        self.titles = defaultdict(dict)
+        self.polls = defaultdict(lambda: defaultdict(int))
+        self.words = defaultdict(list)
+        self.chats = defaultdict(set)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.update(rows)
+        self.update_members(members)
+
+    def add(self, chat_id, tt, title, polls=0):
         '''
-        Register vote. Save user to users_voted and choice to poll_counts.
+        Add a stored movie of a chat, counting polls more polls it was in.
+        Placeholder titles (the tt tag itself) are skipped.
         '''
-        unique_title = get_unique_id(str(chat_id), option_id)
-        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+        if tt is None or title is None or title == tt:
+            return
+        chat_id = str(chat_id)
+        with self.lock:
+            self.polls[chat_id][tt] += polls
+            titles = self.titles[chat_id]
+            words = self.words[chat_id]
+            old = titles.get(tt)
+            if old == title:
+                return
+            if old is not None:
+                for word in set(tokenize(old)):
+                    del words[bisect.bisect_left(words, (word, tt))]
+            titles[tt] = title
+            for word in set(tokenize(title)):
+                bisect.insort(words, (word, tt))
 
-        self.cursor.execute(
-            "SELECT * FROM users_voted WHERE unique_user_chat = %s;", (unique_user_chat,))
-        if self.cursor.rowcount > 0:
-            self.cursor.execute(
-                """UPDATE users_voted
-                SET option_id = %s
-                WHERE unique_user_chat = %s;""", (option_id, unique_user_chat))
-        else:
-            self.cursor.execute(
-                """INSERT INTO users_voted
-                (unique_user_chat, user_id, chat_id, option_id)
-                VALUES (%s, %s, %s, %s);""", (unique_user_chat, str(user_id), str(chat_id), option_id))
-        self.cursor.execute(
-            "UPDATE poll_counts SET count = count + 1 WHERE unique_title = %s;", (unique_title,))
-        
-        self.cursor.execute(
-            "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            enable_results = self.cursor.fetchone()[0]
-            if enable_results:
-                self.cursor.execute(
-                    "SELECT title FROM poll_counts WHERE unique_title = %s;", (unique_title,))
-                title = self.cursor.fetchone()[0]
-                self.cursor.execute(
-                    "SELECT tt FROM user_choices WHERE title = %s AND chat_id = %s;", (title, str(chat_id)))
-                tt = self.cursor.fetchone()[0]
-                unique_tt = get_unique_id(str(chat_id), tt)
-                self.cursor.execute(
-                    "UPDATE results SET votes_count = votes_count + 1 WHERE unique_tt = %s;", (unique_tt,))
-        
-        self.connection.commit()
-    
-    def remove_vote(self, chat_id, user_id):
+    def update(self, rows):
         '''
-        Recount vote for that user. If option_id differs from existing vote, delete old vote.
+        Add stored movies from (chat_id, tt, title, polls_count) rows.
         '''
-        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
-        
-        self.cursor.execute(
-            "SELECT option_id FROM users_voted WHERE unique_user_chat = %s;", (unique_user_chat,))
-        if self.cursor.rowcount > 0:
-            option_id = self.cursor.fetchone()[0]
-            unique_title = get_unique_id(str(chat_id), option_id)
-            self.cursor.execute(
-                "DELETE FROM users_voted WHERE unique_user_chat = %s;", (unique_user_chat,))
-            self.cursor.execute(
-                "UPDATE poll_counts SET count = count - 1 WHERE unique_title = %s;",
-                (unique_title,))
-
-            self.cursor.execute(
-                "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-            if self.cursor.rowcount > 0:
-                enable_results = self.cursor.fetchone()[0]
-                if enable_results:
-                    self.cursor.execute(
-                        "SELECT tt FROM user_choices WHERE unique_id = %s;", (unique_title,))
-                    tt = self.cursor.fetchone()[0]
-                    unique_tt = get_unique_id(str(chat_id), tt)
-                    self.cursor.execute(
-                        "UPDATE results SET votes_count = votes_count - 1 WHERE unique_tt = %s;",
-                        (unique_tt,))
-            
-            self.connection.commit()
-    
-    def check_user_vote(self, chat_id, user_id):
+        for chat_id, tt, title, polls in rows:
+            self.add(chat_id, tt, title, polls)
+
+    def clear_polls(self, chat_id):
         '''
-        Check if user has voted.
+        Forget the polls of a chat, after its results were cleared.
         '''
-        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
-        self.cursor.execute(
-            "SELECT * FROM users_voted WHERE unique_user_chat = %s;", (unique_user_chat,))
-        if self.cursor.rowcount > 0:
-            return True
-        else:
-            return False
-    
-    def check_poll_complete(self, chat_id):
+        with self.lock:
+            self.polls.pop(str(chat_id), None)
+
+    def reload(self, rows=(), members=()):
         '''
-        Check if poll is complete.
-        If all users in user_choices are present in users_voted, return True. False otherwise.
+        Replace all movies and members, after stored data of all chats was deleted.
         '''
-        self.cursor.execute(
-            "SELECT user_id FROM users_voted WHERE chat_id = %s;", (str(chat_id),))
-        users_voted = self.cursor.fetchall()
-        self.cursor.execute(
-            "SELECT user_id FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
-        users_choices = self.cursor.fetchall()
-        # check if all users in user_choices are present in users_voted
-        for user in users_choices:
-            if user not in users_voted and user[0] != '0':
-                return False
-        return True
-    
-    def get_poll_winner(self, chat_id):
+        with self.lock:
+            self.titles.clear()
+            self.polls.clear()
+            self.words.clear()
+            self.chats.clear()
+        self.update(rows)
+        self.update_members(members)
+
+    def add_member(self, user_id, chat_id):
         '''
-        Check which option has the most votes.
-        Return movie title if there is a single winner.
-        If there is a tie, return None.
+        Let user search the movies of a chat. The extra choices user is skipped.
         '''
-        self.cursor.execute(
-            "SELECT option_id, count, title FROM poll_counts WHERE chat_id = %s;", (str(chat_id),))
-        
-        counts = self.cursor.fetchall()
-        max_votes = max([i[1] for i in counts])
-        winners = [i[2] for i in counts if i[1] == max_votes]
-        
-        if len(winners) > 1:
-            return None
-        else:
-            return winners[0]
-    
-    def random_poll_winner(self, chat_id, reroll_chance=None):
+        if str(user_id) in NON_VOTING_USER_IDS:
+            return
+        with self.lock:
+            self.chats[str(user_id)].add(str(chat_id))
+
+    def update_members(self, rows):
         '''
-        If there is a tie, randomly select a winner.
-        Returns a reroll_chance and winner movie title.
-        Returns None if there is a reroll.
+        Add members from (user_id, chat_id) rows.
         '''
-        self.cursor.execute(
-            "SELECT option_id, count, title FROM poll_counts WHERE chat_id = %s;", (str(chat_id),))
-        
-        counts = self.cursor.fetchall()
-        max_votes = max([i[1] for i in counts])
-        winners = [i[2] for i in counts if i[1] == max_votes]
-        
-        if len(winners) > 1:
-            if reroll_chance is None:
-                reroll_slots = random.choice(list(range(1, len(winners) + 1)))
-            else:
-                reroll_slots = int(len(winners) * reroll_chance / (1 - reroll_chance))
-            
-            choices = winners + [None] * reroll_slots
-            reroll_chance = 100 * reroll_slots / len(choices)
+        for user_id, chat_id in rows:
+            self.add_member(user_id, chat_id)
 
-            winner = random.choice(choices)
-        
-        elif len(winners) == 1:
-            winner = winners[0]
-        else:
-            return None
-        
-        return reroll_chance, winner
-    
-    def end_poll(self, chat_id):
+    def search(self, user_id, query, limit=10):
         '''
-        Disable poll and delete all choices, users_voted and poll_counts.
+        Search the movies of the chats of user with a word starting with each word of query, most polled first.
+        Returns dicts with title, year and imdb_id, like OMDBClient.search, without the year.
         '''
-        self.cursor.execute(
-            "UPDATE polls SET poll_active = %s WHERE chat_id = %s;", (False, str(chat_id)))
-        self.cursor.execute(
-            "DELETE FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
-        self.cursor.execute(
-            "DELETE FROM users_voted WHERE chat_id = %s;", (str(chat_id),))
-        self.cursor.execute(
-            "DELETE FROM poll_counts WHERE chat_id = %s;", (str(chat_id),))
-        
-        self.connection.commit()
-    
-    def random_winner(self, chat_id, reroll_chance=None):
+        words = tokenize(query)
+        found = {}
+        with self.lock:
+            if len(words) > 0:
+                prefix = max(words, key=len)
+                for chat_id in self.chats.get(str(user_id), ()):
+                    chat_words = self.words.get(chat_id, [])
+                    titles = self.titles[chat_id]
+                    polls = self.polls.get(chat_id, {})
+                    i = bisect.bisect_left(chat_words, (prefix,))
+                    tts = set()
+                    while i < len(chat_words) and chat_words[i][0].startswith(prefix):
+                        tts.add(chat_words[i][1])
+                        i += 1
+                    for tt in tts:
+                        title_words = tokenize(titles[tt])
+                        if all(any(word.startswith(part) for word in title_words) for part in words):
+                            count, _ = found.get(tt, (0, None))
+                            found[tt] = (count + polls.get(tt, 0), titles[tt])
+            results = sorted((-polls, title, tt) for tt, (polls, title) in found.items())
+            if len(results) > 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return [{'title': title, 'year': '', 'imdb_id': tt} for _, title, tt in results[:limit]]
+
+    def stats(self):
         '''
-        Randomly select a winner from current choices.
+        Get index size and hit/miss counters.
         '''
-        self.cursor.execute(
-            "SELECT title FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
-        choices = self.cursor.fetchall()
-        
-        if len(choices) == 0:
-            return None
+        with self.lock:
+            return {
+                'chats': len(self.titles),
+                'titles': sum(len(titles) for titles in self.titles.values()),
+                'users': len(self.chats),
+                'hits': self.hits,
+                'misses': self.misses
+            }
 
-        if reroll_chance is None:
-            reroll_slots = random.choice(list(range(1, len(choices) + 1)))
-        else:
-            reroll_slots = int(len(choices) * reroll_chance / (1 - reroll_chance))
-        
-        choices = choices + [None] * reroll_slots
-        reroll_chance = 100 * reroll_slots / len(choices)
+class read_cache:
+    '''
+    Read-through cache of query results by key, with a size limit (LRU).
+    Writes update or invalidate keys. Results read while a key was being written are not saved,
+    so a slow read can not bring back an old value.
+    '''
 
-        winner = random.choice(choices)[0]
-        
-        return reroll_chance, winner
-    
-    def results_win(self, chat_id, title):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
         '''
-        Register win for a movie.
+        Get the value of key, calling load() to read it if not cached.
         '''
-        self.cursor.execute(
-            "SELECT tt FROM user_choices WHERE chat_id = %s AND title = %s;", (str(chat_id), title))
-        tt = self.cursor.fetchone()[0]
-        unique_tt = get_unique_id(str(chat_id), tt)
-
-        self.cursor.execute(
-            """UPDATE results
-            SET last_win = CAST(CURRENT_TIMESTAMP AS DATE), wins_count = wins_count + 1
-            WHERE unique_tt = %s;"""
-            , (unique_tt,))
-        self.connection.commit()
-    
-    def enable_results(self, chat_id):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            self.misses += 1
+            version = self.version
+        value = load()
+        with self.lock:
+            if self.version == version:
+                self.save(key, value)
+        return value
+
+    def save(self, key, value):
         '''
-        Enable results for a chat. Returns True if successful.
-        If results is already enabled, returns False.
+        Save value in cache, evicting the least recently used keys. Call with lock held.
         '''
-        self.cursor.execute(
-            "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            if self.cursor.fetchone()[0] == True:
-                return False
-            else:
-                self.cursor.execute(
-                    "UPDATE enable_results SET enable_results = %s WHERE chat_id = %s;", (True, str(chat_id)))
-                self.connection.commit()
-                return True
-        else:
-            self.cursor.execute(
-                "INSERT INTO enable_results (chat_id, enable_results) VALUES (%s, %s);", (str(chat_id), True))
-            self.connection.commit()
-            return True
-    
-    def disable_results(self, chat_id):
+        if self.max_size > 0:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def set(self, key, value):
         '''
-        Disable results for a chat. Returns True if successful.
-        If results is already disabled, returns False.
+        Set the value of key, after it was written.
         '''
-        self.cursor.execute(
-            "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            if self.cursor.fetchone()[0] == False:
-                return False
-            else:
-                self.cursor.execute(
-                    "UPDATE enable_results SET enable_results = %s WHERE chat_id = %s;", (False, str(chat_id)))
-                self.connection.commit()
-                return True
-        else:
-            self.cursor.execute(
-                "INSERT INTO enable_results (chat_id, enable_results) VALUES (%s, %s);", (str(chat_id), False))
-            self.connection.commit()
-            return True
-    
-    def results_enabled(self, chat_id):
+        with self.lock:
+            self.version += 1
+            self.save(key, value)
+
+    def invalidate(self, key=None):
         '''
-        Check if results are enabled for a chat.
+        Drop key from cache, or all keys if key is None.
         '''
-        self.cursor.execute(
-            "SELECT enable_results FROM enable_results WHERE chat_id = %s;", (str(chat_id),))
-        if self.cursor.rowcount > 0:
-            return self.cursor.fetchone()[0]
-        else:
-            return False
-    
-    def get_results(self, chat_id):
+        with self.lock:
+            self.version += 1
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+    def stats(self):
         '''
-        Get results for a chat.
+        Get cache hit/miss counters.
         '''
-        self.cursor.execute(
-            "SELECT * FROM results WHERE chat_id = %s;", (str(chat_id),))
-        return self.cursor.fetchall()
-    
-    def clear_results(self, chat_id):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.values),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else None
+            }
+
+class title_resolver:
+    '''
+    Resolve movie titles on a bounded pool of worker threads.
+    Pending resolutions are tracked per chat, so that they can be waited for.
+    '''
+
+    def __init__(self, titles, max_workers=4):
+        self.titles = titles
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='title_resolver')
+        self.pending = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def submit(self, chat_id, tt, callback):
         '''
-        Remove all results from given chat.
+        Resolve title for tt in the background, then call callback(title).
         '''
-        self.cursor.execute(
-            "DELETE FROM results WHERE chat_id = %s;", (str(chat_id),))
-        self.connection.commit()
+        future = self.executor.submit(self.run, tt, callback)
+        with self.lock:
+            self.pending[chat_id].add(future)
+        future.add_done_callback(lambda future: self.done(chat_id, future))
+        return future
 
-    def reset_database(self):
+    def run(self, tt, callback):
+        try:
+            title = self.titles.resolve(tt)
+        except Exception as e:
+            print(f'Could not resolve title for {tt}: {e}')
+            return
+        callback(title)
+
+    def done(self, chat_id, future):
+        with self.lock:
+            self.pending[chat_id].discard(future)
+            if len(self.pending[chat_id]) == 0:
+                del self.pending[chat_id]
+
+    def wait(self, chat_id, timeout=None):
         '''
-        Reset database.
+        Wait for pending resolutions in a chat.
+        Returns True if all are done, False if timed out.
         '''
-        self.cursor.execute("DROP TABLE user_choices;")
-        self.cursor.execute("DROP TABLE users_voted;")
-        self.cursor.execute("DROP TABLE polls;")
-        self.cursor.execute("DROP TABLE poll_counts;")
-        self.connection.commit()
+        with self.lock:
+            futures = set(self.pending.get(chat_id, ()))
+        if len(futures) == 0:
+            return True
+        _, not_done = wait(futures, timeout=timeout)
+        return len(not_done) == 0
+
+class inline_search:
+    '''
+    Answer inline queries on their own pool of worker threads, keeping only the newest query per user.
+    A query is looked up once the user stops typing for delay seconds. Queries superseded meanwhile
+    are dropped: before the lookup if they are still waiting, before the answer otherwise.
+    '''
+
+    def __init__(self, delay=0.3, max_workers=4):
+        self.delay = delay
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='inline_search')
+        self.latest = {}
+        self.timers = {}
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.debounced = 0
+        self.dropped = 0
+        self.answered = 0
+        self.errors = 0
+
+    def submit(self, user_id, lookup, answer):
+        '''
+        Make query of user_id the newest: call lookup() after the delay, then answer(result)
+        if no newer query arrived meanwhile.
+        '''
+        with self.lock:
+            self.submitted += 1
+            seq = next(self.order)
+            self.latest[user_id] = seq
+            timer = self.timers.pop(user_id, None)
+            if timer is not None:
+                timer.cancel()
+                self.debounced += 1
+            if self.delay > 0:
+                timer = threading.Timer(self.delay, self.start, (user_id, seq, lookup, answer))
+                timer.daemon = True
+                self.timers[user_id] = timer
+                timer.start()
+                return
+        self.executor.submit(self.run, user_id, seq, lookup, answer)
+
+    def current(self, user_id, seq):
+        '''
+        Check if seq is the newest query of user_id.
+        '''
+        with self.lock:
+            return self.latest.get(user_id) == seq
+
+    def start(self, user_id, seq, lookup, answer):
+        '''
+        Queue lookup of a query on the pool, once its delay is over.
+        '''
+        with self.lock:
+            if self.latest.get(user_id) != seq:
+                return
+            del self.timers[user_id]
+        self.executor.submit(self.run, user_id, seq, lookup, answer)
+
+    def run(self, user_id, seq, lookup, answer):
+        '''
+        Look up and answer a query, unless a newer one arrived.
+        '''
+        try:
+            if not self.current(user_id, seq):
+                with self.lock:
+                    self.dropped += 1
+                return
+            result = lookup()
+            with self.lock:
+                if self.latest.get(user_id) != seq:
+                    self.dropped += 1
+                    return
+                del self.latest[user_id]
+                self.answered += 1
+            answer(result)
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+                if self.latest.get(user_id) == seq:
+                    del self.latest[user_id]
+            print(f'Could not answer inline query: {e}')
+
+    def stats(self):
+        '''
+        Get query counters.
+        '''
+        with self.lock:
+            return {
+                'pending': len(self.latest),
+                'submitted': self.submitted,
+                'debounced': self.debounced,
+                'dropped': self.dropped,
+                'answered': self.answered,
+                'errors': self.errors
+            }
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+priority_names = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low'}
+
+class token_bucket:
+    '''
+    Rate limiter allowing rate calls per second on average, and bursts of up to burst calls.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        '''
+        Add the tokens earned since the last update.
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        '''
+        Seconds until a call can be made.
+        '''
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        '''
+        Use a token for a call.
+        '''
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        '''
+        Check if no tokens were used recently.
+        '''
+        self.refill(now)
+        return self.tokens >= self.burst
+
+def retry_after(e):
+    '''
+    Get retry_after (seconds) from a Telegram 429 Too Many Requests error. None for other errors.
+    '''
+    if getattr(e, 'error_code', None) != 429:
+        return None
+    result = getattr(e, 'result_json', None) or {}
+    return result.get('parameters', {}).get('retry_after', 1)
+
+class message_dispatcher:
+    '''
+    Outgoing queue for bot API calls (send_message, send_poll, edit_message_text, ...).
+    Calls are queued per chat and sent by a pool of workers, with at most one call in flight per chat,
+    so that messages to a chat keep their order, except low priority ones, which wait for the others.
+    Across chats, calls with a higher priority go first.
+    Token buckets keep each chat under chat_rate calls per second and the bot under global_rate.
+    When the API answers 429 Too Many Requests, the chat is paused for retry_after seconds and the
+    call is retried, up to max_retries times.
+    Each call returns a future with its result (e.g. the sent message), for callers that need it.
+    '''
+
+    def __init__(self, bot, chat_rate=1.0, chat_burst=3, global_rate=30.0, global_burst=30, workers=4,
+        max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = token_bucket(global_rate, global_burst)
+        self.queues = {}
+        self.buckets = {}
+        self.paused = {}
+        self.in_flight = set()
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.sent = 0
+        self.retries = 0
+        self.errors = 0
+        for i in range(workers):
+            threading.Thread(target=self.run, name=f'dispatcher_{i}', daemon=True).start()
+        atexit.register(self.drain)
+
+    def call(self, chat_id, method, *args, priority=PRIORITY_NORMAL, **kwargs):
+        '''
+        Queue a call to bot.method(*args, **kwargs), counted against the limits of chat_id.
+        Returns a future with the result.
+        '''
+        chat_id = str(chat_id)
+        future = Future()
+        with self.cond:
+            if chat_id not in self.buckets:
+                self.prune()
+                self.buckets[chat_id] = token_bucket(self.chat_rate, self.chat_burst)
+            heapq.heappush(self.queues.setdefault(chat_id, []),
+                (priority == PRIORITY_LOW, next(self.order), priority, [method, args, kwargs, future, 0]))
+            self.cond.notify()
+        return future
+
+    def prune(self):
+        '''
+        Forget rate limits of idle chats, when there are many. Call with cond held.
+        '''
+        if len(self.buckets) < 4096:
+            return
+        now = time.monotonic()
+        for chat_id in list(self.buckets):
+            if chat_id not in self.queues and chat_id not in self.in_flight and self.buckets[chat_id].full(now):
+                del self.buckets[chat_id]
+                self.paused.pop(chat_id, None)
+
+    def next_call(self):
+        '''
+        Wait for the next call that can be sent, and take it from its queue. Call with cond held.
+        '''
+        while True:
+            now = time.monotonic()
+            best = None
+            wait_time = None
+            for chat_id, pending in self.queues.items():
+                if chat_id in self.in_flight:
+                    continue
+                ready_in = max(self.paused.get(chat_id, 0) - now, self.buckets[chat_id].wait_time(now))
+                if ready_in > 0:
+                    wait_time = ready_in if wait_time is None else min(wait_time, ready_in)
+                elif best is None or (pending[0][2], pending[0][1]) < (self.queues[best][0][2], self.queues[best][0][1]):
+                    best = chat_id
+            if best is not None:
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait == 0:
+                    self.global_bucket.take(now)
+                    self.buckets[best].take(now)
+                    entry = heapq.heappop(self.queues[best])
+                    if len(self.queues[best]) == 0:
+                        del self.queues[best]
+                    self.in_flight.add(best)
+                    return best, entry
+                wait_time = global_wait if wait_time is None else min(wait_time, global_wait)
+            self.cond.wait(wait_time)
+
+    def run(self):
+        '''
+        Send queued calls.
+        '''
+        while True:
+            with self.cond:
+                chat_id, entry = self.next_call()
+            self.send(chat_id, entry)
+
+    def send(self, chat_id, entry):
+        '''
+        Make a queued call, and requeue it if the chat is over the API limits.
+        '''
+        method, args, kwargs, future, attempts = entry[3]
+        try:
+            result = getattr(self.bot, method)(*args, **kwargs)
+        except Exception as e:
+            wait_time = retry_after(e)
+            with self.cond:
+                self.in_flight.discard(chat_id)
+                if wait_time is not None and attempts < self.max_retries:
+                    entry[3][4] += 1
+                    self.retries += 1
+                    self.paused[chat_id] = time.monotonic() + wait_time
+                    heapq.heappush(self.queues.setdefault(chat_id, []), entry)
+                    self.cond.notify_all()
+                    return
+                self.errors += 1
+                self.cond.notify_all()
+            print(e)
+            future.set_exception(e)
+            return
+        with self.cond:
+            self.in_flight.discard(chat_id)
+            self.sent += 1
+            self.cond.notify_all()
+        future.set_result(result)
+
+    def drain(self, timeout=5):
+        '''
+        Wait up to timeout seconds for queued calls to be sent.
+        Returns True if the queue is empty.
+        '''
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.queues) > 0 or len(self.in_flight) > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def stats(self):
+        '''
+        Get queue depths and counters.
+        '''
+        with self.cond:
+            queued = {name: 0 for name in priority_names.values()}
+            for pending in self.queues.values():
+                for entry in pending:
+                    queued[priority_names.get(entry[2], str(entry[2]))] += 1
+            return {
+                'queued': queued,
+                'chats_waiting': len(self.queues),
+                'max_chat_depth': max([len(pending) for pending in self.queues.values()], default=0),
+                'in_flight': len(self.in_flight),
+                'sent': self.sent,
+                'retries': self.retries,
+                'errors': self.errors
+            }
+
+class poll_status:
+    '''
+    Single status message per poll, edited as votes arrive instead of sending a message per vote.
+    Edits are debounced: votes within delay seconds of the first one are shown by a single edit.
+    render(chat_id) returns the text of the status message of a chat.
+    The message id and text are kept in store, so that any process can edit the message.
+    '''
+
+    def __init__(self, outbox, render, store, delay=2.0):
+        self.outbox = outbox
+        self.render = render
+        self.store = store
+        self.delay = delay
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.edits = 0
+        self.skipped = 0
+
+    def key(self, chat_id):
+        return f'status:{chat_id}'
+
+    def start(self, chat_id, priority=PRIORITY_NORMAL):
+        '''
+        Send the status message of a new poll.
+        '''
+        chat_id = str(chat_id)
+        with self.lock:
+            self.cancel(chat_id)
+        with self.store.lock(self.key(chat_id)):
+            self.send(chat_id, self.render(chat_id), priority)
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL):
+        '''
+        Send a status message and save it. Call with the store lock of the chat held.
+        '''
+        try:
+            message = self.outbox.call(chat_id, 'send_message', chat_id, text, priority=priority).result()
+            self.store.set(self.key(chat_id), (message.message_id, text))
+        except Exception as e:
+            print(f'Could not send poll status: {e}')
+            self.store.delete(self.key(chat_id))
+
+    def update(self, chat_id):
+        '''
+        Schedule an edit of the status message, unless one is already scheduled.
+        '''
+        chat_id = str(chat_id)
+        with self.lock:
+            if chat_id in self.timers:
+                self.skipped += 1
+                return
+            timer = threading.Timer(self.delay, self.flush, (chat_id,))
+            timer.daemon = True
+            self.timers[chat_id] = timer
+        timer.start()
+
+    def cancel(self, chat_id):
+        '''
+        Cancel the scheduled edit of a chat. Call with lock held.
+        '''
+        timer = self.timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def flush(self, chat_id, final=False):
+        '''
+        Edit the status message to show the current state of the poll.
+        If the message is unknown (e.g. after a restart), a new one is sent, unless final.
+        With final, the message is forgotten afterwards.
+        '''
+        with self.lock:
+            self.timers.pop(chat_id, None)
+        with self.store.lock(self.key(chat_id)):
+            state = self.store.get(self.key(chat_id))
+            if state is None:
+                if not final:
+                    self.send(chat_id, self.render(chat_id))
+                return
+            message_id, old_text = state
+            text = self.render(chat_id)
+            # telegram rejects edits that do not change the message
+            if text != old_text:
+                self.outbox.call(chat_id, 'edit_message_text', text, chat_id, message_id)
+                with self.lock:
+                    self.edits += 1
+            if final:
+                self.store.delete(self.key(chat_id))
+            else:
+                self.store.set(self.key(chat_id), (message_id, text))
+
+    def stop(self, chat_id):
+        '''
+        Show the final state of the poll right away, and forget its status message.
+        '''
+        chat_id = str(chat_id)
+        with self.lock:
+            self.cancel(chat_id)
+        self.flush(chat_id, final=True)
+
+    def stats(self):
+        '''
+        Get number of scheduled edits, edits sent and votes merged into another edit.
+        '''
+        with self.lock:
+            return {'scheduled': len(self.timers), 'edits': self.edits, 'merged': self.skipped}
+
+class update_queue:
+    '''
+    Bounded queue of incoming updates, processed in order within a chat and in parallel across chats.
+    Updates are hashed by key(update), usually the chat id, onto a fixed set of lanes,
+    each one processed by its own worker thread.
+    When several processes serve the bot, a shared store can be given: updates are then pushed
+    to a per-chat queue in the store as they arrive, ordered by update id, and whichever process holds
+    the lock of the chat processes all its queued updates in order, so that a chat is served by one process at a time.
+    put returns False when the lane is full, so that the webhook can ask Telegram to send the update later.
+    '''
+
+    def __init__(self, bot, key, lanes=8, max_size=1000, store=None):
+        self.bot = bot
+        self.key = key
+        self.store = store
+        self.lanes = [queue.Queue(maxsize=max(1, max_size // lanes)) for i in range(lanes)]
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+        for i, lane in enumerate(self.lanes):
+            threading.Thread(target=self.run, args=(lane,), name=f'updates_{i}', daemon=True).start()
+
+    def get_key(self, update):
+        '''
+        Get the key of an update, as a string: chat ids are numbers in messages,
+        but strings when read from the bot memory (poll answers).
+        '''
+        try:
+            key = self.key(update)
+            return str(key) if key is not None else None
+        except Exception as e:
+            print(e)
+            return None
+
+    def put(self, update, block=False):
+        '''
+        Queue an update. Returns False if its lane is full.
+        With block, waits for room in the lane instead.
+        '''
+        key = self.get_key(update)
+        if self.store is not None:
+            # the lane only wakes up a worker, which takes the updates of the chat from the store
+            self.store.push(f'updates:{key}', update.update_id, update)
+        try:
+            self.lanes[hash(key) % len(self.lanes)].put((key, update), block=block)
+            return True
+        except queue.Full:
+            # taken back, unless another process already took it
+            if self.store is not None and not self.store.discard(f'updates:{key}', update.update_id):
+                return True
+            with self.lock:
+                self.rejected += 1
+            return False
+
+    def run(self, lane):
+        '''
+        Process the updates of a lane, one at a time.
+        '''
+        while True:
+            key, update = lane.get()
+            if self.store is None:
+                self.process(update)
+                continue
+            try:
+                with self.store.lock(f'chat:{key}'):
+                    while True:
+                        update = self.store.take(f'updates:{key}')
+                        if update is None:
+                            break
+                        self.process(update)
+            except Exception as e:
+                print(e)
+                with self.lock:
+                    self.errors += 1
+
+    def process(self, update):
+        '''
+        Process an update.
+        '''
+        try:
+            self.bot.process_new_updates([update])
+            with self.lock:
+                self.processed += 1
+        except Exception as e:
+            print(e)
+            with self.lock:
+                self.errors += 1
+
+    def stats(self):
+        '''
+        Get queue sizes and counters.
+        '''
+        with self.lock:
+            sizes = [lane.qsize() for lane in self.lanes]
+            return {'queued': sum(sizes), 'max_lane_depth': max(sizes), 'processed': self.processed,
+                'rejected': self.rejected, 'errors': self.errors}
+
+class memory_store:
+    '''
+    Store for conversational state (next step handlers, poll status messages) kept in this process.
+    Same interface as sql_store, which it stands in for when a single process serves the bot.
+    '''
+
+    def __init__(self, lock_stripes=64):
+        self.values = {}
+        self.queues = {}
+        self.values_lock = threading.Lock()
+        # reentrant, as a thread can lock a key while holding the lock of another key on the same stripe
+        self.locks = [threading.RLock() for i in range(lock_stripes)]
+
+    def get(self, key):
+        '''
+        Get the value of key, or None.
+        '''
+        with self.values_lock:
+            return self.values.get(key)
+
+    def set(self, key, value):
+        '''
+        Set the value of key.
+        '''
+        with self.values_lock:
+            self.values[key] = value
+
+    def pop(self, key):
+        '''
+        Delete key and return its value, or None.
+        '''
+        with self.values_lock:
+            return self.values.pop(key, None)
+
+    def delete(self, key):
+        '''
+        Delete key.
+        '''
+        self.pop(key)
+
+    def push(self, key, seq, value):
+        '''
+        Add value to the queue of key, ordered by seq. A seq already in the queue is ignored.
+        '''
+        with self.values_lock:
+            entries = self.queues.setdefault(key, {})
+            entries.setdefault(seq, value)
+
+    def discard(self, key, seq):
+        '''
+        Remove seq from the queue of key. Returns False if it was not in the queue.
+        '''
+        with self.values_lock:
+            entries = self.queues.get(key)
+            if not entries or seq not in entries:
+                return False
+            del entries[seq]
+            if len(entries) == 0:
+                del self.queues[key]
+            return True
+
+    def take(self, key):
+        '''
+        Remove and return the value with the lowest seq in the queue of key, or None if it is empty.
+        '''
+        with self.values_lock:
+            entries = self.queues.get(key)
+            if not entries:
+                return None
+            value = entries.pop(min(entries))
+            if len(entries) == 0:
+                del self.queues[key]
+            return value
+
+    def lock(self, key):
+        '''
+        Lock key, for use in a with statement.
+        '''
+        return self.locks[hash(key) % len(self.locks)]
+
+class sql_store:
+    '''
+    Store for conversational state (next step handlers, poll status messages) in a PostgreSQL database,
+    shared by all the processes serving the bot. Values are pickled.
+    Locks are leases on rows of state_locks, which expire after lease seconds in case their process dies.
+    While a lock is held, its lease is renewed in the background, so that it does not expire under a slow handler.
+    Waiting for a lock does not hold a connection, so locks can be nested without exhausting the pool.
+    '''
+
+    def __init__(self, DATABASE_URL, max_connections=10, lease=60, poll_interval=0.05):
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, max_connections, DATABASE_URL)
+        # the pool raises an error when exhausted, so callers wait here instead
+        self.pool_slots = threading.BoundedSemaphore(max_connections)
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (schema_lock_id,))
+            cursor.execute("CREATE TABLE IF NOT EXISTS state_store (key TEXT PRIMARY KEY, value BYTEA);")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS state_locks (key TEXT PRIMARY KEY, owner TEXT, expires TIMESTAMPTZ);")
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS state_queue (
+                key TEXT, seq BIGINT, value BYTEA, PRIMARY KEY (key, seq));""")
+
+    @contextmanager
+    def get_connection(self):
+        '''
+        Borrow a connection from the pool, in autocommit mode. Broken connections are discarded.
+        '''
+        with self.pool_slots:
+            connection = self.pool.getconn()
+            try:
+                connection.autocommit = True
+                yield connection
+            finally:
+                self.pool.putconn(connection, close=bool(connection.closed))
+
+    @contextmanager
+    def get_cursor(self):
+        '''
+        Get a cursor on a pooled connection.
+        '''
+        with self.get_connection() as connection:
+            with connection.cursor() as cursor:
+                yield cursor
+
+    def get(self, key):
+        '''
+        Get the value of key, or None.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT value FROM state_store WHERE key = %s;", (key,))
+            row = cursor.fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def set(self, key, value):
+        '''
+        Set the value of key.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO state_store (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;""",
+                (key, psycopg2.Binary(pickle.dumps(value, protocol=4))))
+
+    def pop(self, key):
+        '''
+        Delete key and return its value, or None.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DELETE FROM state_store WHERE key = %s RETURNING value;", (key,))
+            row = cursor.fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def delete(self, key):
+        '''
+        Delete key.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DELETE FROM state_store WHERE key = %s;", (key,))
+
+    @contextmanager
+    def lock(self, key):
+        '''
+        Lock key across processes, for use in a with statement.
+        '''
+        owner = os.urandom(8).hex()
+        while True:
+            with self.get_cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO state_locks (key, owner, expires)
+                    VALUES (%s, %s, now() + %s * INTERVAL '1 second')
+                    ON CONFLICT (key) DO UPDATE SET owner = EXCLUDED.owner, expires = EXCLUDED.expires
+                    WHERE state_locks.expires < now()
+                    RETURNING owner;""", (key, owner, self.lease))
+                if cursor.fetchone() is not None:
+                    break
+            time.sleep(self.poll_interval)
+        released = threading.Event()
+        threading.Thread(target=self.renew, args=(key, owner, released), daemon=True).start()
+        try:
+            yield
+        finally:
+            released.set()
+            with self.get_cursor() as cursor:
+                cursor.execute("DELETE FROM state_locks WHERE key = %s AND owner = %s;", (key, owner))
+
+    def renew(self, key, owner, released):
+        '''
+        Renew the lease of a held lock every third of the lease, until it is released.
+        '''
+        while not released.wait(self.lease / 3):
+            try:
+                with self.get_cursor() as cursor:
+                    cursor.execute(
+                        """UPDATE state_locks SET expires = now() + %s * INTERVAL '1 second'
+                        WHERE key = %s AND owner = %s;""", (self.lease, key, owner))
+            except Exception as e:
+                print(e)
+
+    def push(self, key, seq, value):
+        '''
+        Add value to the queue of key, ordered by seq. A seq already in the queue is ignored.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO state_queue (key, seq, value) VALUES (%s, %s, %s)
+                ON CONFLICT (key, seq) DO NOTHING;""",
+                (key, seq, psycopg2.Binary(pickle.dumps(value, protocol=4))))
+
+    def discard(self, key, seq):
+        '''
+        Remove seq from the queue of key. Returns False if it was not in the queue.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DELETE FROM state_queue WHERE key = %s AND seq = %s;", (key, seq))
+            return cursor.rowcount > 0
+
+    def take(self, key):
+        '''
+        Remove and return the value with the lowest seq in the queue of key, or None if it is empty.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM state_queue WHERE key = %s
+                AND seq = (SELECT min(seq) FROM state_queue WHERE key = %s) RETURNING value;""", (key, key))
+            row = cursor.fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+class store_handler_backend(HandlerBackend):
+    '''
+    Next step handlers of the bot (e.g. the reply to "Please, enter a choice:"), kept in a store,
+    so that the reply can be handled by any process.
+    '''
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def key(self, handler_group_id):
+        return f'handlers:{handler_group_id}'
+
+    def register_handler(self, handler_group_id, handler):
+        with self.store.lock(self.key(handler_group_id)):
+            handlers = self.store.get(self.key(handler_group_id)) or []
+            handlers.append(handler)
+            self.store.set(self.key(handler_group_id), handlers)
+
+    def clear_handlers(self, handler_group_id):
+        self.store.delete(self.key(handler_group_id))
+
+    def get_handlers(self, handler_group_id):
+        with self.store.lock(self.key(handler_group_id)):
+            return self.store.pop(self.key(handler_group_id))
+
+# records or retracts (p_option_id NULL) a vote, updates tallies and results history,
+# and returns the poll counts and whether all participants have voted
+record_vote_function = """
+CREATE OR REPLACE FUNCTION record_vote(p_chat_id TEXT, p_user_id TEXT, p_option_id INT)
+RETURNS TABLE (option_id INT, count INT, title TEXT, poll_complete BOOLEAN)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_unique_user_chat TEXT := p_user_id || '_' || p_chat_id;
+    v_results BOOLEAN;
+    v_option_id INT;
+    v_title TEXT;
+BEGIN
+    SELECT e.enable_results INTO v_results FROM enable_results e WHERE e.chat_id = p_chat_id;
+
+    DELETE FROM users_voted uv WHERE uv.unique_user_chat = v_unique_user_chat
+    RETURNING uv.option_id INTO v_option_id;
+    IF v_option_id IS NOT NULL THEN
+        UPDATE poll_counts pc SET count = pc.count - 1
+        WHERE pc.unique_title = p_chat_id || '_' || v_option_id
+        RETURNING pc.title INTO v_title;
+        IF v_results THEN
+            UPDATE results r SET votes_count = r.votes_count - 1
+            WHERE r.unique_tt IN (
+                SELECT p_chat_id || '_' || uc.tt FROM user_choices uc
+                WHERE uc.chat_id = p_chat_id AND uc.title = v_title);
+        END IF;
+    END IF;
+
+    v_option_id := NULL;
+    IF p_option_id IS NOT NULL THEN
+        INSERT INTO users_voted (unique_user_chat, user_id, chat_id, option_id)
+        VALUES (v_unique_user_chat, p_user_id, p_chat_id, p_option_id)
+        ON CONFLICT DO NOTHING
+        RETURNING users_voted.option_id INTO v_option_id;
+    END IF;
+    IF v_option_id IS NOT NULL THEN
+        UPDATE poll_counts pc SET count = pc.count + 1
+        WHERE pc.unique_title = p_chat_id || '_' || p_option_id
+        RETURNING pc.title INTO v_title;
+        IF v_results THEN
+            UPDATE results r SET votes_count = r.votes_count + 1
+            WHERE r.unique_tt IN (
+                SELECT p_chat_id || '_' || uc.tt FROM user_choices uc
+                WHERE uc.chat_id = p_chat_id AND uc.title = v_title);
+        END IF;
+    END IF;
+
+    RETURN QUERY
+    SELECT pc.option_id, pc.count, pc.title, NOT EXISTS (
+        SELECT 1 FROM user_choices uc
+        WHERE uc.chat_id = p_chat_id AND uc.user_id NOT IN ('0', 'dummy') AND NOT EXISTS (
+            SELECT 1 FROM users_voted uv WHERE uv.chat_id = p_chat_id AND uv.user_id = uc.user_id))
+    FROM poll_counts pc WHERE pc.chat_id = p_chat_id ORDER BY pc.option_id;
+END;
+$$;
+"""
+
+# schema migrations for sql_mem, as (version, statements)
+# applied in order at startup, each one only once; statements must be idempotent
+migrations = [
+    (1, [
+        "CREATE TABLE IF NOT EXISTS user_choices "\
+        "(unique_id TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT, username TEXT, "\
+            "tt TEXT, url TEXT, title TEXT);",
+        "CREATE TABLE IF NOT EXISTS users_voted "\
+        "(unique_user_chat TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT, option_id INT);",
+        "CREATE TABLE IF NOT EXISTS polls "\
+        "(chat_id TEXT PRIMARY KEY, poll_id TEXT, msg_id TEXT, poll_active BOOLEAN);",
+        "CREATE TABLE IF NOT EXISTS poll_counts "\
+        "(unique_title TEXT PRIMARY KEY, chat_id TEXT, poll_id TEXT, "\
+            "option_id INT, title TEXT, count INT);",
+        "CREATE TABLE IF NOT EXISTS enable_results "\
+        "(chat_id TEXT PRIMARY KEY, enable_results BOOLEAN);",
+        "CREATE TABLE IF NOT EXISTS results "\
+        "(unique_tt TEXT PRIMARY KEY, chat_id TEXT, tt TEXT, url TEXT, title TEXT, "\
+            "polls_count INT, votes_count INT, wins_count INT, last_poll DATE, last_win DATE);"
+    ]),
+    (2, [
+        "CREATE TABLE IF NOT EXISTS title_cache "\
+        "(tt TEXT PRIMARY KEY, title TEXT, cached_at DOUBLE PRECISION);",
+        record_vote_function
+    ]),
+    (3, [
+        "ALTER TABLE user_choices ALTER COLUMN chat_id SET NOT NULL;",
+        "ALTER TABLE users_voted ALTER COLUMN chat_id SET NOT NULL;",
+        "ALTER TABLE poll_counts ALTER COLUMN chat_id SET NOT NULL;",
+        "ALTER TABLE results ALTER COLUMN chat_id SET NOT NULL;",
+        "CREATE INDEX IF NOT EXISTS user_choices_chat_id_title ON user_choices (chat_id, title);",
+        "CREATE INDEX IF NOT EXISTS users_voted_chat_id ON users_voted (chat_id);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS polls_poll_id ON polls (poll_id);",
+        "CREATE INDEX IF NOT EXISTS poll_counts_chat_id ON poll_counts (chat_id);",
+        "CREATE INDEX IF NOT EXISTS results_chat_id ON results (chat_id);"
+    ]),
+    # the dummy choice has a user of its own, which polls do not wait for either
+    (4, [
+        record_vote_function
+    ])
+]
+schema_lock_id = 6170766
+
+# statements of sql_mem and async_sql_mem, with psycopg2 placeholders (async_sql_mem numbers them)
+sql_statements = {
+    'lock_schema': "SELECT pg_advisory_xact_lock(%s);",
+    'create_schema_version':
+        "CREATE TABLE IF NOT EXISTS schema_version "\
+        "(version INT PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);",
+    'get_schema_version': "SELECT COALESCE(MAX(version), 0) FROM schema_version;",
+    'set_schema_version': "INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING;",
+    'add_choice':
+        """INSERT INTO user_choices
+        (unique_id, user_id, chat_id, username, tt, url, title)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (unique_id) DO UPDATE
+        SET user_id = EXCLUDED.user_id, chat_id = EXCLUDED.chat_id, username = EXCLUDED.username,
+            tt = EXCLUDED.tt, url = EXCLUDED.url, title = EXCLUDED.title
+        RETURNING *;""",
+    'update_title': "UPDATE user_choices SET title = %s WHERE unique_id = %s AND tt = %s;",
+    'delete_choice': "DELETE FROM user_choices WHERE unique_id = %s;",
+    'delete_by_title': "DELETE FROM user_choices WHERE chat_id = %s AND title = %s;",
+    # run in one transaction, each with the chat_id
+    'end_poll': [
+        "UPDATE polls SET poll_active = FALSE WHERE chat_id = %s;",
+        "DELETE FROM user_choices WHERE chat_id = %s;",
+        "DELETE FROM users_voted WHERE chat_id = %s;",
+        "DELETE FROM poll_counts WHERE chat_id = %s;"
+    ],
+    'get_choices': "SELECT * FROM user_choices WHERE chat_id = %s;",
+    'add_poll':
+        """INSERT INTO polls
+        (chat_id, poll_id, msg_id, poll_active)
+        VALUES (%s, %s, %s, TRUE)
+        ON CONFLICT (chat_id) DO UPDATE
+        SET poll_id = EXCLUDED.poll_id, msg_id = EXCLUDED.msg_id, poll_active = EXCLUDED.poll_active
+        RETURNING *;""",
+    'delete_poll_counts': "DELETE FROM poll_counts WHERE chat_id = %s;",
+    # options are passed as arrays, see poll_rows
+    'add_poll_counts':
+        """INSERT INTO poll_counts
+        (unique_title, chat_id, poll_id, option_id, title, count)
+        SELECT unique_title, %s::TEXT, %s::TEXT, option_id, title, 0
+        FROM unnest(%s::TEXT[], %s::INT[], %s::TEXT[]) AS options (unique_title, option_id, title);""",
+    'add_poll_results':
+        """INSERT INTO results
+        (unique_tt, chat_id, tt, url, title, polls_count, votes_count, wins_count, last_poll, last_win)
+        SELECT unique_tt, %s::TEXT, tt, url, title, polls_count, 0, 0, CAST(CURRENT_TIMESTAMP AS DATE), NULL
+        FROM unnest(%s::TEXT[], %s::TEXT[], %s::TEXT[], %s::TEXT[], %s::INT[])
+            AS options (unique_tt, tt, url, title, polls_count)
+        WHERE EXISTS (
+            SELECT 1 FROM enable_results
+            WHERE enable_results.chat_id = %s::TEXT AND enable_results.enable_results)
+        ON CONFLICT (unique_tt) DO UPDATE
+        SET polls_count = results.polls_count + EXCLUDED.polls_count, last_poll = EXCLUDED.last_poll;""",
+    'get_active_poll': "SELECT chat_id, msg_id FROM polls WHERE poll_id = %s AND poll_active;",
+    'get_poll': "SELECT * FROM polls WHERE chat_id = %s;",
+    'get_poll_counts': "SELECT option_id, count, title FROM poll_counts WHERE chat_id = %s ORDER BY option_id;",
+    'get_votes': "SELECT user_id, option_id FROM users_voted WHERE chat_id = %s;",
+    'vote': "SELECT * FROM record_vote(%s, %s, %s);",
+    'get_choice_tt': "SELECT tt FROM user_choices WHERE chat_id = %s AND title = %s;",
+    'results_win':
+        """UPDATE results
+        SET last_win = CAST(CURRENT_TIMESTAMP AS DATE), wins_count = wins_count + 1
+        WHERE unique_tt = %s;""",
+    'set_results':
+        """INSERT INTO enable_results (chat_id, enable_results) VALUES (%s, %s)
+        ON CONFLICT (chat_id) DO UPDATE SET enable_results = EXCLUDED.enable_results
+        WHERE enable_results.enable_results IS DISTINCT FROM EXCLUDED.enable_results
+        RETURNING enable_results;""",
+    'results_enabled': "SELECT enable_results FROM enable_results WHERE chat_id = %s;",
+    'get_results': "SELECT * FROM results WHERE chat_id = %s;",
+    'clear_results': "DELETE FROM results WHERE chat_id = %s;",
+    'get_stored_titles':
+        """SELECT chat_id, tt, title, polls_count FROM results
+        UNION ALL SELECT chat_id, tt, title, 0 FROM user_choices WHERE tt IS NOT NULL;""",
+    'get_chat_members': "SELECT user_id, chat_id FROM user_choices UNION SELECT user_id, chat_id FROM users_voted;",
+    'get_cached_title': "SELECT title, cached_at FROM title_cache WHERE tt = %s;",
+    'cache_title':
+        """INSERT INTO title_cache (tt, title, cached_at) VALUES (%s, %s, %s)
+        ON CONFLICT (tt) DO UPDATE SET title = EXCLUDED.title, cached_at = EXCLUDED.cached_at;"""
+}
+
+def poll_rows(chat_id, poll_id, titles, tts):
+    '''
+    Get the parameters of the add_poll_counts and add_poll_results statements of a new poll.
+    Options and movies are passed as arrays, so that each statement runs once whatever their number.
+    '''
+    chat_id = str(chat_id)
+    option_ids = list(range(len(titles)))
+    counts = (chat_id, poll_id, [get_unique_id(chat_id, i) for i in option_ids], option_ids, list(titles))
+    # the same movie can be suggested more than once, and each one counts as a poll
+    polls_counts = defaultdict(int)
+    for tt in tts:
+        polls_counts[tt] += 1
+    movies = list(polls_counts)
+    results = (chat_id, [get_unique_id(chat_id, tt) for tt in movies], movies, [imdb_url(tt) for tt in movies],
+        [titles[tts.index(tt)] for tt in movies], [polls_counts[tt] for tt in movies], chat_id)
+    return counts, results
+
+class storage(ABC):
+    '''
+    Interface of the bot "memory", implemented by sql_mem, sqlite_mem, local_mem and cached_mem.
+    Rows are tuples in the column order of the SQL tables:
+    choices are (unique_id, user_id, chat_id, username, tt, url, title),
+    polls are (chat_id, poll_id, msg_id, poll_active), poll counts are (option_id, count, title)
+    and results are (unique_tt, chat_id, tt, url, title, polls_count, votes_count, wins_count,
+    last_poll, last_win). Chat and user ids are returned as strings.
+    '''
+
+    @abstractmethod
+    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+
+    @abstractmethod
+    def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+
+    @abstractmethod
+    def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+
+    @abstractmethod
+    def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+
+    @abstractmethod
+    def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices, votes and poll counts of a chat. Returns True if successful, False otherwise.
+        '''
+
+    @abstractmethod
+    def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+
+    @abstractmethod
+    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        '''
+
+    @abstractmethod
+    def get_poll(self, chat_id):
+        '''
+        Get the polls row of a chat, or None if the chat never had a poll.
+        '''
+
+    @abstractmethod
+    def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+
+    @abstractmethod
+    def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+
+    def get_active_poll(self, poll_id):
+        '''
+        Get (chat_id, msg_id) of an active poll, or None if the poll is not active.
+        '''
+        chat_id = self.get_chat_from_poll(poll_id)
+        if chat_id is None:
+            return None
+        return chat_id, self.get_msg_from_poll(poll_id)
+
+    @abstractmethod
+    def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+
+    @abstractmethod
+    def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+
+    @abstractmethod
+    def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+
+    @abstractmethod
+    def check_user_vote(self, chat_id, user_id):
+        '''
+        Check if user has voted.
+        '''
+
+    @abstractmethod
+    def check_poll_complete(self, chat_id):
+        '''
+        Check if poll is complete.
+        If all users in user_choices are present in users_voted, return True. False otherwise.
+        '''
+
+    @abstractmethod
+    def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts.
+        '''
+
+    @abstractmethod
+    def results_win(self, chat_id, title):
+        '''
+        Register win for a movie.
+        '''
+
+    @abstractmethod
+    def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat. Returns True if it changed, False if it was already set.
+        '''
+
+    @abstractmethod
+    def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat.
+        '''
+
+    @abstractmethod
+    def get_results(self, chat_id):
+        '''
+        Get results for a chat.
+        '''
+
+    @abstractmethod
+    def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat. Returns True if there were results, False otherwise.
+        '''
+
+    @abstractmethod
+    def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats.
+        Choices have a polls_count of 0.
+        '''
+
+    @abstractmethod
+    def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat.
+        '''
+
+    @abstractmethod
+    def get_cached_title(self, tt):
+        '''
+        Get cached title for tt. Returns (title, cached_at) if cached, None otherwise.
+        '''
+
+    @abstractmethod
+    def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in title cache.
+        '''
+
+    @abstractmethod
+    def reset_database(self):
+        '''
+        Delete all choices, votes and polls.
+        '''
+
+    @abstractmethod
+    def reset_prefs(self):
+        '''
+        Delete results preferences of all chats.
+        '''
+
+    @abstractmethod
+    def reset_results(self):
+        '''
+        Delete results of all chats.
+        '''
+
+    def flush(self):
+        '''
+        Make sure all changes are saved. Nothing to do for backends that save right away.
+        '''
+        pass
+
+    def get_poll_winner(self, chat_id, counts=None):
+        '''
+        Check which option has the most votes.
+        Return movie title if there is a single winner.
+        If there is a tie, return None.
+        Poll counts already returned by vote can be passed to avoid querying them again.
+        '''
+        if counts is None:
+            counts = self.get_poll_counts(chat_id)
+
+        winners = top_titles(counts)
+
+        if len(winners) > 1:
+            return None
+        else:
+            return winners[0]
+
+    def random_poll_winner(self, chat_id, counts=None, rng=random):
+        '''
+        If there is a tie, randomly select a winner, with all rerolls drawn at once.
+        Returns the reroll_chance (None if there is no tie), the number of rerolls and the winner movie title.
+        Returns None if the poll has no options.
+        Poll counts already returned by vote can be passed to avoid querying them again.
+        '''
+        if counts is None:
+            counts = self.get_poll_counts(chat_id)
+        winners = top_titles(counts)
+
+        if len(winners) > 1:
+            return simulate_draw(winners, rng)
+        elif len(winners) == 1:
+            return None, 0, winners[0]
+        else:
+            return None
+
+    def random_winner(self, chat_id, rng=random):
+        '''
+        Randomly select a winner from current choices, with all rerolls drawn at once.
+        Returns the reroll_chance, the number of rerolls and the winner movie title.
+        Returns None if there are no choices.
+        '''
+        choices = [row[6] for row in self.get_choices(chat_id) if row[6] is not None]
+
+        if len(choices) == 0:
+            return None
+
+        return simulate_draw(choices, rng)
+
+    def enable_results(self, chat_id):
+        '''
+        Enable results for a chat. Returns True if successful.
+        If results is already enabled, returns False.
+        '''
+        return self.set_results(chat_id, True)
+
+    def disable_results(self, chat_id):
+        '''
+        Disable results for a chat. Returns True if successful.
+        If results is already disabled, returns False.
+        '''
+        return self.set_results(chat_id, False)
+
+class sql_mem(storage):
+    '''
+    Bot "memory". Synced to SQL database.
+    Choices, active polls and results flags are cached in memory per chat (up to cache_size chats),
+    and invalidated by the methods that change them.
+    '''
+
+    def __init__(self, DATABASE_URL, min_connections=1, max_connections=10, idle_check=30, cache_size=1024):
+        self.DATABASE_URL = DATABASE_URL
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.idle_check = idle_check
+        self.choices_cache = read_cache(cache_size)
+        self.polls_cache = read_cache(cache_size)
+        self.results_cache = read_cache(cache_size)
+        # polls cached for each chat, to invalidate them when the chat poll changes
+        self.chat_polls = {}
+        self.get_database_connection()
+        self.initialize_database()
+
+    def get_database_connection(self):
+        '''
+        Create database connection pool.
+        '''
+        result = urlparse(self.DATABASE_URL)
+        username = result.username
+        password = result.password
+        database = result.path[1:]
+        hostname = result.hostname
+        port = result.port
+        
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            self.min_connections,
+            self.max_connections,
+            database = database,
+            user = username,
+            password = password,
+            host = hostname,
+            port = port
+        )
+        # the pool raises an error when exhausted, so callers wait here instead
+        self.pool_slots = threading.BoundedSemaphore(self.max_connections)
+        self.last_used = {}
+
+    def healthy(self, connection):
+        '''
+        Check if a connection from the pool can be used.
+        Connections idle for longer than idle_check seconds are pinged.
+        '''
+        if connection.closed or connection.get_transaction_status() == \
+            psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        last_used = self.last_used.get(id(connection))
+        if last_used is not None and time.monotonic() - last_used > self.idle_check:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                connection.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                return False
+        return True
+
+    def get_connection(self):
+        '''
+        Borrow a healthy connection from the pool, replacing broken ones.
+        '''
+        for _ in range(self.max_connections + 1):
+            connection = self.pool.getconn()
+            if self.healthy(connection):
+                return connection
+            self.last_used.pop(id(connection), None)
+            self.pool.putconn(connection, close=True)
+        raise psycopg2.OperationalError('Could not get a working database connection.')
+
+    @contextmanager
+    def get_cursor(self, autocommit=False):
+        '''
+        Borrow a connection from the pool and get a cursor.
+        Commits when done and rolls back on errors. Broken connections are discarded.
+        Single statements can use autocommit, which saves the BEGIN and COMMIT round trips.
+        '''
+        self.pool_slots.acquire()
+        try:
+            connection = self.get_connection()
+            connection.autocommit = autocommit
+        except:
+            self.pool_slots.release()
+            raise
+        broken = False
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except:
+            connection.rollback()
+            raise
+        finally:
+            broken = broken or bool(connection.closed)
+            if broken:
+                self.last_used.pop(id(connection), None)
+            else:
+                self.last_used[id(connection)] = time.monotonic()
+            self.pool.putconn(connection, close=broken)
+            self.pool_slots.release()
+
+    def initialize_database(self, force=False):
+        '''
+        Apply pending schema migrations. If the schema is current, no DDL is run.
+        With force, all migrations are applied again (they are idempotent).
+        '''
+        if not force and self.get_schema_version() >= migrations[-1][0]:
+            return
+        with self.get_cursor() as cursor:
+            # only one bot process migrates at a time
+            cursor.execute(sql_statements['lock_schema'], (schema_lock_id,))
+            cursor.execute(sql_statements['create_schema_version'])
+            cursor.execute(sql_statements['get_schema_version'])
+            current = 0 if force else cursor.fetchone()[0]
+            for version, statements in migrations:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(sql_statements['set_schema_version'], (version,))
+
+    def get_schema_version(self):
+        '''
+        Get current schema version. Returns 0 if no migrations were applied.
+        '''
+        try:
+            with self.get_cursor(autocommit=True) as cursor:
+                cursor.execute(sql_statements['get_schema_version'])
+                return cursor.fetchone()[0]
+        except psycopg2.errors.UndefinedTable:
+            return 0
+    
+    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['add_choice'],
+                (unique_id, str(user_id), str(chat_id), username, tt, url, title))
+            row = cursor.fetchone()
+        self.choices_cache.invalidate(str(chat_id))
+        return row
+    
+    def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['update_title'], (title, unique_id, tt))
+            if cursor.rowcount > 0:
+                self.choices_cache.invalidate(split_unique_id(unique_id)[0])
+                return True
+            else:
+                return False
+    
+    def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['delete_choice'], (unique_id,))
+            if cursor.rowcount > 0:
+                self.choices_cache.invalidate(split_unique_id(unique_id)[0])
+                return True
+            else:
+                return False
+    
+    def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['delete_by_title'], (str(chat_id), title))
+            if cursor.rowcount > 0:
+                self.choices_cache.invalidate(str(chat_id))
+                return True
+            else:
+                return False
+    
+    def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices from memory. Returns True if successful, False otherwise.
+        '''
+        result = False
+        
+        with self.get_cursor() as cursor:
+            for statement in sql_statements['end_poll']:
+                cursor.execute(statement, (str(chat_id),))
+                if cursor.rowcount > 0:
+                    result = True
+
+        self.invalidate_chat(chat_id)
+        return result
+    
+    def invalidate_chat(self, chat_id):
+        '''
+        Drop cached choices and poll of a chat, after its poll was ended or replaced.
+        '''
+        self.choices_cache.invalidate(str(chat_id))
+        poll_id = self.chat_polls.pop(str(chat_id), None)
+        if poll_id is not None:
+            self.polls_cache.invalidate(poll_id)
+
+    def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+        return list(self.choices_cache.get(str(chat_id), lambda: self.query_choices(chat_id)))
+
+    def query_choices(self, chat_id):
+        '''
+        Read choices of a chat from the database.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_choices'], (str(chat_id),))
+            return cursor.fetchall()
+    
+    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        Runs a fixed number of statements, whatever the number of options.
+        '''
+        counts, results = poll_rows(chat_id, poll_id, titles, tts)
+        # read before borrowing a connection, since a cache miss borrows one too
+        save_results = len(tts) > 0 and self.results_enabled(chat_id)
+        
+        with self.get_cursor() as cursor:
+            cursor.execute(sql_statements['add_poll'], (str(chat_id), poll_id, str(msg_id)))
+            poll = cursor.fetchone()
+        
+            cursor.execute(sql_statements['delete_poll_counts'], (str(chat_id),))
+            cursor.execute(sql_statements['add_poll_counts'], counts)
+            if save_results:
+                # the flag is also checked by the statement itself
+                cursor.execute(sql_statements['add_poll_results'], results)
+
+        self.invalidate_chat(chat_id)
+        self.polls_cache.set(poll_id, (str(chat_id), poll[2]))
+        self.chat_polls[str(chat_id)] = poll_id
+        return poll
+    
+    def get_active_poll(self, poll_id):
+        '''
+        Get (chat_id, msg_id) of an active poll, or None if the poll is not active.
+        '''
+        poll = self.polls_cache.get(poll_id, lambda: self.query_active_poll(poll_id))
+        if poll is not None:
+            self.chat_polls[poll[0]] = poll_id
+        return poll
+
+    def query_active_poll(self, poll_id):
+        '''
+        Read (chat_id, msg_id) of an active poll from the database.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_active_poll'], (poll_id,))
+            return cursor.fetchone()
+
+    def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+        poll = self.get_active_poll(poll_id)
+        if poll is None:
+            return None
+        return poll[0]
+    
+    def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+        poll = self.get_active_poll(poll_id)
+        if poll is None:
+            return None
+        return poll[1]
+    
+    def get_poll(self, chat_id):
+        '''
+        Get the polls row of a chat, or None if the chat never had a poll.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_poll'], (str(chat_id),))
+            return cursor.fetchone()
+    
+    def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_poll_counts'], (str(chat_id),))
+            return cursor.fetchall()
+    
+    def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_votes'], (str(chat_id),))
+            return cursor.fetchall()
+    
+    def add_vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote. Save user to users_voted and choice to poll_counts.
+        Returns the voted option as (title, count), or None if the option does not exist.
+        '''
+        unique_title = get_unique_id(str(chat_id), option_id)
+        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(
+                """WITH voted AS (
+                    INSERT INTO users_voted
+                    (unique_user_chat, user_id, chat_id, option_id)
+                    VALUES (%(unique_user_chat)s, %(user_id)s, %(chat_id)s, %(option_id)s)
+                    ON CONFLICT (unique_user_chat) DO UPDATE SET option_id = EXCLUDED.option_id
+                    RETURNING option_id
+                ), counted AS (
+                    UPDATE poll_counts SET count = count + 1 WHERE unique_title = %(unique_title)s
+                    RETURNING title, count
+                ), counted_results AS (
+                    UPDATE results SET votes_count = votes_count + 1
+                    FROM counted, user_choices, enable_results
+                    WHERE user_choices.chat_id = %(chat_id)s AND user_choices.title = counted.title
+                    AND results.unique_tt = user_choices.chat_id || '_' || user_choices.tt
+                    AND enable_results.chat_id = %(chat_id)s AND enable_results.enable_results
+                )
+                SELECT title, count FROM counted;""",
+                {'unique_user_chat': unique_user_chat, 'user_id': str(user_id), 'chat_id': str(chat_id),
+                    'option_id': option_id, 'unique_title': unique_title})
+            return cursor.fetchone()
+    
+    def remove_vote(self, chat_id, user_id):
+        '''
+        Retract vote for that user.
+        Returns the option the vote was removed from as (title, count), or None if there was no vote.
+        '''
+        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+        
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(
+                """WITH removed AS (
+                    DELETE FROM users_voted WHERE unique_user_chat = %(unique_user_chat)s
+                    RETURNING option_id
+                ), counted AS (
+                    UPDATE poll_counts SET count = count - 1
+                    FROM removed WHERE poll_counts.unique_title = %(chat_id)s || '_' || removed.option_id
+                    RETURNING poll_counts.title, poll_counts.count
+                ), counted_results AS (
+                    UPDATE results SET votes_count = votes_count - 1
+                    FROM counted, user_choices, enable_results
+                    WHERE user_choices.chat_id = %(chat_id)s AND user_choices.title = counted.title
+                    AND results.unique_tt = user_choices.chat_id || '_' || user_choices.tt
+                    AND enable_results.chat_id = %(chat_id)s AND enable_results.enable_results
+                )
+                SELECT title, count FROM counted;""",
+                {'unique_user_chat': unique_user_chat, 'chat_id': str(chat_id)})
+            return cursor.fetchone()
+    
+    def check_user_vote(self, chat_id, user_id):
+        '''
+        Check if user has voted.
+        '''
+        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(
+                "SELECT * FROM users_voted WHERE unique_user_chat = %s;", (unique_user_chat,))
+            if cursor.rowcount > 0:
+                return True
+            else:
+                return False
+    
+    def check_poll_complete(self, chat_id):
+        '''
+        Check if poll is complete.
+        If all users in user_choices are present in users_voted, return True. False otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id FROM users_voted WHERE chat_id = %s;", (str(chat_id),))
+            users_voted = cursor.fetchall()
+            cursor.execute(
+                "SELECT user_id FROM user_choices WHERE chat_id = %s;", (str(chat_id),))
+            users_choices = cursor.fetchall()
+            # check if all users in user_choices are present in users_voted
+            for user in users_choices:
+                if user not in users_voted and user[0] not in NON_VOTING_USER_IDS:
+                    return False
+            return True
+    
+    def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None, in a single round trip.
+        Updates users_voted, poll_counts and results, then checks if the poll is complete.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['vote'], (str(chat_id), str(user_id), option_id))
+            rows = cursor.fetchall()
+        counts = [row[:3] for row in rows]
+        complete = len(rows) > 0 and rows[0][3]
+        return counts, complete
+    
+    def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts.
+        '''
+        with self.get_cursor() as cursor:
+            for statement in sql_statements['end_poll']:
+                cursor.execute(statement, (str(chat_id),))
+        self.invalidate_chat(chat_id)
+    
+    def results_win(self, chat_id, title):
+        '''
+        Register win for a movie.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(sql_statements['get_choice_tt'], (str(chat_id), title))
+            tt = cursor.fetchone()[0]
+            unique_tt = get_unique_id(str(chat_id), tt)
+
+            cursor.execute(sql_statements['results_win'], (unique_tt,))
+    
+    def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat. Returns True if it changed, False if it was already set.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['set_results'], (str(chat_id), enabled))
+            self.results_cache.set(str(chat_id), enabled)
+            if cursor.rowcount > 0:
+                return True
+            else:
+                return False
+
+    def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat.
+        '''
+        return self.results_cache.get(str(chat_id), lambda: self.query_results_enabled(chat_id))
+
+    def query_results_enabled(self, chat_id):
+        '''
+        Read results flag of a chat from the database.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['results_enabled'], (str(chat_id),))
+            if cursor.rowcount > 0:
+                return cursor.fetchone()[0]
+            else:
+                return False
+    
+    def get_results(self, chat_id):
+        '''
+        Get results for a chat.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_results'], (str(chat_id),))
+            return cursor.fetchall()
+    
+    def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat. Returns True if there were results, False otherwise.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['clear_results'], (str(chat_id),))
+            if cursor.rowcount > 0:
+                return True
+            else:
+                return False
+    
+    def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats.
+        Choices have a polls_count of 0.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_stored_titles'])
+            return cursor.fetchall()
+
+    def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_chat_members'])
+            return cursor.fetchall()
+    
+    def cache_stats(self):
+        '''
+        Get hit/miss counters of the per-chat caches.
+        '''
+        return {
+            'choices': self.choices_cache.stats(),
+            'polls': self.polls_cache.stats(),
+            'results_enabled': self.results_cache.stats()
+        }
+    
+    def get_cached_title(self, tt):
+        '''
+        Get cached title for tt. Returns (title, cached_at) if cached, None otherwise.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['get_cached_title'], (tt,))
+            if cursor.rowcount > 0:
+                return cursor.fetchone()
+            else:
+                return None
+    
+    def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in title cache.
+        '''
+        with self.get_cursor(autocommit=True) as cursor:
+            cursor.execute(sql_statements['cache_title'], (tt, title, cached_at))
+    
+    def reset_database(self):
+        '''
+        Reset database.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DROP TABLE user_choices;")
+            cursor.execute("DROP TABLE users_voted;")
+            cursor.execute("DROP TABLE polls;")
+            cursor.execute("DROP TABLE poll_counts;")
+
+        self.choices_cache.invalidate()
+        self.polls_cache.invalidate()
+        self.chat_polls.clear()
+        self.initialize_database(force=True)
+    
+    def reset_prefs(self):
+        '''
+        Reset enable_results table.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DROP TABLE enable_results;")
+
+        self.results_cache.invalidate()
+        self.initialize_database(force=True)
+    
+    def reset_results(self):
+        '''
+        Reset results database.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DROP TABLE results;")
+
+        self.initialize_database(force=True)
+
+sqlite_migrations = [
+    (1, [
+        "CREATE TABLE IF NOT EXISTS user_choices "\
+        "(unique_id TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT NOT NULL, username TEXT, "\
+            "tt TEXT, url TEXT, title TEXT);",
+        "CREATE TABLE IF NOT EXISTS users_voted "\
+        "(unique_user_chat TEXT PRIMARY KEY, user_id TEXT, chat_id TEXT NOT NULL, option_id INT);",
+        "CREATE TABLE IF NOT EXISTS polls "\
+        "(chat_id TEXT PRIMARY KEY, poll_id TEXT, msg_id TEXT, poll_active BOOLEAN);",
+        "CREATE TABLE IF NOT EXISTS poll_counts "\
+        "(unique_title TEXT PRIMARY KEY, chat_id TEXT NOT NULL, poll_id TEXT, "\
+            "option_id INT, title TEXT, count INT);",
+        "CREATE TABLE IF NOT EXISTS enable_results "\
+        "(chat_id TEXT PRIMARY KEY, enable_results BOOLEAN);",
+        "CREATE TABLE IF NOT EXISTS results "\
+        "(unique_tt TEXT PRIMARY KEY, chat_id TEXT NOT NULL, tt TEXT, url TEXT, title TEXT, "\
+            "polls_count INT, votes_count INT, wins_count INT, last_poll DATE, last_win DATE);",
+        "CREATE TABLE IF NOT EXISTS title_cache "\
+        "(tt TEXT PRIMARY KEY, title TEXT, cached_at REAL);",
+        "CREATE INDEX IF NOT EXISTS user_choices_chat_id_title ON user_choices (chat_id, title);",
+        "CREATE INDEX IF NOT EXISTS users_voted_chat_id ON users_voted (chat_id);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS polls_poll_id ON polls (poll_id);",
+        "CREATE INDEX IF NOT EXISTS poll_counts_chat_id ON poll_counts (chat_id);",
+        "CREATE INDEX IF NOT EXISTS results_chat_id ON results (chat_id);"
+    ])
+]
+
+# results dates are returned as dates, as with PostgreSQL
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode()))
+
+class sqlite_mem(storage):
+    '''
+    Bot "memory". Synced to an embedded SQLite database file.
+    Same methods as sql_mem, so results history works without a database server.
+    '''
+
+    def __init__(self, path='mem/moviepoll.db', busy_timeout=30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.initialize_database()
+
+    def get_connection(self):
+        '''
+        Get the connection for the current thread, opening it if needed.
+        sqlite3 keeps the prepared statements of each connection, so queries are only compiled once.
+        '''
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
+            # readers do not block the writer in WAL mode
+            connection.execute("PRAGMA journal_mode = WAL;")
+            connection.execute("PRAGMA synchronous = NORMAL;")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def get_cursor(self, transaction=False):
+        '''
+        Get a cursor for the current thread's connection.
+        Statements commit on their own, unless transaction is set: then they commit together when done,
+        and roll back on errors. Transactions take the write lock at the start, so they never deadlock.
+        '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            if transaction:
+                cursor.execute("BEGIN IMMEDIATE;")
+            try:
+                yield cursor
+            except:
+                if transaction:
+                    cursor.execute("ROLLBACK;")
+                raise
+            if transaction:
+                cursor.execute("COMMIT;")
+        finally:
+            cursor.close()
+
+    def initialize_database(self, force=False):
+        '''
+        Apply pending schema migrations. The schema version is kept in user_version.
+        With force, all migrations are applied again (they are idempotent).
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            cursor.execute("PRAGMA user_version;")
+            current = 0 if force else cursor.fetchone()[0]
+            for version, statements in sqlite_migrations:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute("PRAGMA user_version = %d;" % version)
+
+    def get_schema_version(self):
+        '''
+        Get current schema version. Returns 0 if no migrations were applied.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("PRAGMA user_version;")
+            return cursor.fetchone()[0]
+
+    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO user_choices
+                (unique_id, user_id, chat_id, username, tt, url, title)
+                VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                (unique_id, str(user_id), str(chat_id), username, tt, url, title))
+        return (unique_id, str(user_id), str(chat_id), username, tt, url, title)
+
+    def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "UPDATE user_choices SET title = ? WHERE unique_id = ? AND tt = ?;",
+                (title, unique_id, tt))
+            return cursor.rowcount > 0
+
+    def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM user_choices WHERE unique_id = ?;", (unique_id,))
+            return cursor.rowcount > 0
+
+    def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM user_choices WHERE chat_id = ? AND title = ?;", (str(chat_id), title))
+            return cursor.rowcount > 0
+
+    def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices from memory. Returns True if successful, False otherwise.
+        '''
+        result = False
+
+        with self.get_cursor(transaction=True) as cursor:
+            cursor.execute("DELETE FROM user_choices WHERE chat_id = ?;", (str(chat_id),))
+            result = result or cursor.rowcount > 0
+            cursor.execute("DELETE FROM users_voted WHERE chat_id = ?;", (str(chat_id),))
+            result = result or cursor.rowcount > 0
+            cursor.execute("DELETE FROM poll_counts WHERE chat_id = ?;", (str(chat_id),))
+            result = result or cursor.rowcount > 0
+            cursor.execute("UPDATE polls SET poll_active = 0 WHERE chat_id = ?;", (str(chat_id),))
+            result = result or cursor.rowcount > 0
+
+        return result
+
+    def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT * FROM user_choices WHERE chat_id = ? ORDER BY rowid;", (str(chat_id),))
+            return cursor.fetchall()
+
+    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        '''
+        options = [(get_unique_id(str(chat_id), i), str(chat_id), poll_id, i, titles[i], 0)
+            for i in range(len(titles))]
+        # the same movie can be suggested more than once, and each one counts as a poll
+        polls_counts = defaultdict(int)
+        for tt in tts:
+            polls_counts[tt] += 1
+        results = [(get_unique_id(str(chat_id), tt), str(chat_id), tt, imdb_url(tt),
+            titles[tts.index(tt)], polls_count) for tt, polls_count in polls_counts.items()]
+        today = datetime.date.today().isoformat()
+
+        with self.get_cursor(transaction=True) as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO polls (chat_id, poll_id, msg_id, poll_active) VALUES (?, ?, ?, 1);",
+                (str(chat_id), poll_id, msg_id))
+            cursor.execute(
+                "DELETE FROM poll_counts WHERE chat_id = ?;", (str(chat_id),))
+            cursor.executemany(
+                """INSERT INTO poll_counts
+                (unique_title, chat_id, poll_id, option_id, title, count)
+                VALUES (?, ?, ?, ?, ?, ?);""", options)
+            cursor.execute(
+                "SELECT enable_results FROM enable_results WHERE chat_id = ?;", (str(chat_id),))
+            enabled = cursor.fetchone()
+            if enabled is not None and enabled[0]:
+                cursor.executemany(
+                    """INSERT INTO results
+                    (unique_tt, chat_id, tt, url, title, polls_count, votes_count, wins_count, last_poll, last_win)
+                    VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?, NULL)
+                    ON CONFLICT (unique_tt) DO UPDATE
+                    SET polls_count = polls_count + excluded.polls_count, last_poll = excluded.last_poll;""",
+                    [result + (today,) for result in results])
+
+        return (str(chat_id), poll_id, msg_id, True)
+
+    def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT chat_id FROM polls WHERE poll_id = ? AND poll_active;", (poll_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT msg_id FROM polls WHERE poll_id = ? AND poll_active;", (poll_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_poll(self, chat_id):
+        '''
+        Get the polls row of a chat, or None if the chat never had a poll.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT chat_id, poll_id, msg_id, poll_active FROM polls WHERE chat_id = ?;", (str(chat_id),))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[:3] + (bool(row[3]),)
+
+    def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, option_id FROM users_voted WHERE chat_id = ?;", (str(chat_id),))
+            return cursor.fetchall()
+
+    def count_vote(self, cursor, chat_id, option_id, change):
+        '''
+        Add change to the count of an option, and to its results if enabled.
+        Returns the option as (title, count), or None if the option does not exist.
+        '''
+        unique_title = get_unique_id(str(chat_id), option_id)
+        cursor.execute(
+            "UPDATE poll_counts SET count = count + ? WHERE unique_title = ?;", (change, unique_title))
+        cursor.execute(
+            "SELECT title, count FROM poll_counts WHERE unique_title = ?;", (unique_title,))
+        counted = cursor.fetchone()
+        if counted is None:
+            return None
+        cursor.execute(
+            """UPDATE results SET votes_count = votes_count + ?
+            WHERE unique_tt IN (
+                SELECT chat_id || '_' || tt FROM user_choices WHERE chat_id = ? AND title = ?)
+            AND EXISTS (
+                SELECT 1 FROM enable_results WHERE chat_id = ? AND enable_results);""",
+            (change, str(chat_id), counted[0], str(chat_id)))
+        return counted
+
+    def retract_vote(self, cursor, chat_id, user_id):
+        '''
+        Remove the vote of a user, if any. Returns the option it was removed from as (title, count).
+        '''
+        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+        cursor.execute(
+            "SELECT option_id FROM users_voted WHERE unique_user_chat = ?;", (unique_user_chat,))
+        voted = cursor.fetchone()
+        if voted is None:
+            return None
+        cursor.execute(
+            "DELETE FROM users_voted WHERE unique_user_chat = ?;", (unique_user_chat,))
+        return self.count_vote(cursor, chat_id, voted[0], -1)
+
+    def cast_vote(self, cursor, chat_id, user_id, option_id):
+        '''
+        Save the vote of a user. Returns the voted option as (title, count).
+        '''
+        cursor.execute(
+            """INSERT INTO users_voted (unique_user_chat, user_id, chat_id, option_id)
+            VALUES (?, ?, ?, ?);""",
+            (get_unique_id(str(user_id), str(chat_id)), str(user_id), str(chat_id), option_id))
+        return self.count_vote(cursor, chat_id, option_id, 1)
+
+    def add_vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote. Save user to users_voted and choice to poll_counts.
+        Returns the voted option as (title, count), or None if the option does not exist.
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            self.retract_vote(cursor, chat_id, user_id)
+            return self.cast_vote(cursor, chat_id, user_id, option_id)
+
+    def remove_vote(self, chat_id, user_id):
+        '''
+        Retract vote for that user.
+        Returns the option the vote was removed from as (title, count), or None if there was no vote.
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            return self.retract_vote(cursor, chat_id, user_id)
+
+    def check_user_vote(self, chat_id, user_id):
+        '''
+        Check if user has voted.
+        '''
+        unique_user_chat = get_unique_id(str(user_id), str(chat_id))
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM users_voted WHERE unique_user_chat = ?;", (unique_user_chat,))
+            return cursor.fetchone() is not None
+
+    def poll_complete(self, cursor, chat_id):
+        '''
+        Check if all users in user_choices (except extra choices) are present in users_voted.
+        '''
+        cursor.execute(
+            """SELECT NOT EXISTS (
+                SELECT 1 FROM user_choices
+                WHERE chat_id = ? AND user_id NOT IN ('0', 'dummy') AND user_id NOT IN (
+                    SELECT user_id FROM users_voted WHERE chat_id = ?));""",
+            (str(chat_id), str(chat_id)))
+        return bool(cursor.fetchone()[0])
+
+    def check_poll_complete(self, chat_id):
+        '''
+        Check if poll is complete.
+        If all users in user_choices are present in users_voted, return True. False otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            return self.poll_complete(cursor, chat_id)
+
+    def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None, in a single transaction.
+        Updates users_voted, poll_counts and results, then checks if the poll is complete.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            self.retract_vote(cursor, chat_id, user_id)
+            if option_id is not None:
+                self.cast_vote(cursor, chat_id, user_id, option_id)
+            cursor.execute(
+                "SELECT option_id, count, title FROM poll_counts WHERE chat_id = ? ORDER BY option_id;",
+                (str(chat_id),))
+            counts = cursor.fetchall()
+            complete = len(counts) > 0 and self.poll_complete(cursor, chat_id)
+        return counts, complete
+
+    def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT option_id, count, title FROM poll_counts WHERE chat_id = ? ORDER BY option_id;",
+                (str(chat_id),))
+            return cursor.fetchall()
+
+    def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts.
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            cursor.execute(
+                "UPDATE polls SET poll_active = 0 WHERE chat_id = ?;", (str(chat_id),))
+            cursor.execute(
+                "DELETE FROM user_choices WHERE chat_id = ?;", (str(chat_id),))
+            cursor.execute(
+                "DELETE FROM users_voted WHERE chat_id = ?;", (str(chat_id),))
+            cursor.execute(
+                "DELETE FROM poll_counts WHERE chat_id = ?;", (str(chat_id),))
+
+    def results_win(self, chat_id, title):
+        '''
+        Register win for a movie.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """UPDATE results
+                SET last_win = ?, wins_count = wins_count + 1
+                WHERE unique_tt IN (
+                    SELECT chat_id || '_' || tt FROM user_choices WHERE chat_id = ? AND title = ? LIMIT 1);""",
+                (datetime.date.today().isoformat(), str(chat_id), title))
+
+    def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat. Returns True if it changed, False if it was already set.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO enable_results (chat_id, enable_results) VALUES (?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET enable_results = excluded.enable_results
+                WHERE enable_results.enable_results IS NOT excluded.enable_results;""",
+                (str(chat_id), enabled))
+            return cursor.rowcount > 0
+
+    def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT enable_results FROM enable_results WHERE chat_id = ?;", (str(chat_id),))
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        return bool(row[0])
+
+    def get_results(self, chat_id):
+        '''
+        Get results for a chat.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT * FROM results WHERE chat_id = ?;", (str(chat_id),))
+            return cursor.fetchall()
+
+    def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat. Returns True if there were results, False otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM results WHERE chat_id = ?;", (str(chat_id),))
+            return cursor.rowcount > 0
+
+    def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats.
+        Choices have a polls_count of 0.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT chat_id, tt, title, polls_count FROM results
+                UNION ALL SELECT chat_id, tt, title, 0 FROM user_choices WHERE tt IS NOT NULL;""")
+            return cursor.fetchall()
+
+    def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, chat_id FROM user_choices UNION SELECT user_id, chat_id FROM users_voted;")
+            return cursor.fetchall()
+
+    def get_cached_title(self, tt):
+        '''
+        Get cached title for tt. Returns (title, cached_at) if cached, None otherwise.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT title, cached_at FROM title_cache WHERE tt = ?;", (tt,))
+            return cursor.fetchone()
+
+    def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in title cache.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO title_cache (tt, title, cached_at) VALUES (?, ?, ?);",
+                (tt, title, cached_at))
+
+    def reset_database(self):
+        '''
+        Reset database.
+        '''
+        with self.get_cursor(transaction=True) as cursor:
+            cursor.execute("DROP TABLE user_choices;")
+            cursor.execute("DROP TABLE users_voted;")
+            cursor.execute("DROP TABLE polls;")
+            cursor.execute("DROP TABLE poll_counts;")
+
+        self.initialize_database(force=True)
+
+    def reset_prefs(self):
+        '''
+        Reset enable_results table.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DROP TABLE enable_results;")
+
+        self.initialize_database(force=True)
+
+    def reset_results(self):
+        '''
+        Reset results database.
+        '''
+        with self.get_cursor() as cursor:
+            cursor.execute("DROP TABLE results;")
+
+        self.initialize_database(force=True)
+
+def write_atomic(path, data):
+    '''
+    Write data (bytes) to path atomically: a crash leaves either the old or the new file.
+    '''
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+# classes
+class local_mem(storage):
+    '''
+    Bot "memory". Synced to local files.
+    State is sharded per chat: each chat is saved in its own file (mem/chats/<chat_id>.pkl),
+    loaded on first access and evicted from memory after min_idle seconds without access,
+    if memory_budget (bytes) is exceeded.
+    Each change to a chat is appended to a journal (mem/journal.<generation>.log) as a record
+    with the new state of that chat, and the chat is marked as dirty. The journal is fsynced every
+    fsync_interval seconds. Every snapshot_every records, dirty chats are saved in the background
+    and the journal is restarted. On load, the journal is replayed on top of the saved chats.
+    Resolved titles are journaled too, as records without a chat, and the title cache is saved with the chats.
+    A chat holds user_choices ({user_id: choice}), users_voted ({user_id: option_id}),
+    poll ((poll_id, msg_id, poll_active)), poll_counts ([[title, count]]), enable_results
+    and results ({tt: result}).
+    '''
+    chat_objects = ['user_choices', 'users_voted', 'poll', 'poll_counts', 'enable_results', 'results']
+    legacy_objects = ['user_choices', 'users_voted', 'last_poll', 'poll_counts']
+
+    def __init__(self, path='mem', fsync_interval=1.0, snapshot_every=1000, memory_budget=64 * 2 ** 20,
+        min_idle=60):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.memory_budget = memory_budget
+        self.min_idle = min_idle
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        self.last_access = {}
+        # chats being written to disk, kept in memory until their file is replaced
+        self.saving = set()
+        self.journal = None
+        self.titles_dirty = False
+        self.load_title_cache()
+        self.load_mem()
+        threading.Thread(target=self.flush_loop, name='local_mem_flush', daemon=True).start()
+        atexit.register(self.flush)
+    
+    def create_mem(self):
+        '''
+        Create memory. Objects are pickle files.
+        '''
+        os.makedirs(os.path.join(self.path, 'chats'), exist_ok=True)
+        with self.lock:
+            for name in os.listdir(os.path.join(self.path, 'chats')):
+                os.remove(os.path.join(self.path, 'chats', name))
+            self.shards = OrderedDict()
+            self.sizes = {}
+            self.dirty = set()
+            self.poll_chats = {}
+            self.chat_polls = {}
+            self.generation = getattr(self, 'generation', 0)
+        self.sync_mem()
+
+    def load_mem(self):
+        '''
+        Load memory from mem folder: read the chat index and replay the journal.
+        Chats are only read from disk when first accessed.
+        Memory saved by older versions (a single snapshot, or separate pickle files)
+        is split into chat shards.
+        '''
+        index = os.path.join(self.path, 'index.pkl')
+        snapshot = os.path.join(self.path, 'snapshot.pkl')
+        legacy = [os.path.join(self.path, f'{name}.pkl') for name in self.legacy_objects + ['poll_chats']]
+        self.shards = OrderedDict()
+        self.sizes = {}
+        self.dirty = set()
+        if os.path.exists(index):
+            with open(index, 'rb') as f:
+                state = pickle.load(f)
+            self.generation = state['generation']
+            self.poll_chats = {poll_id: str(chat_id) for poll_id, chat_id in state['poll_chats'].items()}
+        elif os.path.exists(snapshot) or all(os.path.exists(path) for path in legacy):
+            if os.path.exists(snapshot):
+                with open(snapshot, 'rb') as f:
+                    state = pickle.load(f)
+            else:
+                state = {'generation': 0}
+                for name in self.legacy_objects + ['poll_chats']:
+                    with open(os.path.join(self.path, f'{name}.pkl'), 'rb') as f:
+                        state[name] = pickle.load(f)
+            os.makedirs(os.path.join(self.path, 'chats'), exist_ok=True)
+            self.generation = state['generation']
+            self.poll_chats = {poll_id: str(chat_id) for poll_id, chat_id in state['poll_chats'].items()}
+            for name in self.legacy_objects:
+                for chat_id, value in state[name].items():
+                    self.shards.setdefault(str(chat_id), {})[name] = value
+                    self.dirty.add(str(chat_id))
+            for shard in self.shards.values():
+                self.upgrade(shard)
+        else:
+            self.create_mem()
+            return
+        self.chat_polls = {}
+        for poll_id, chat_id in self.poll_chats.items():
+            self.chat_polls.setdefault(chat_id, []).append(poll_id)
+        for generation in self.journal_generations():
+            if generation >= self.generation:
+                self.replay(self.journal_path(generation))
+                self.generation = generation
+        # save replayed chats, so that the replayed journals can be removed
+        self.sync_mem()
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+    def upgrade(self, shard):
+        '''
+        Convert a chat saved by older versions, which kept the poll message and lists of votes,
+        with user ids as numbers.
+        '''
+        if 'last_poll' in shard:
+            last_poll = shard.pop('last_poll')
+            counts = shard.pop('poll_counts', [])
+            if last_poll is not None:
+                shard['poll'] = (last_poll.poll.id, str(last_poll.message_id), len(counts) > 0)
+                shard['poll_counts'] = [[option.text, count]
+                    for option, count in zip(last_poll.poll.options, counts)]
+            # the option each user voted for was not saved
+            shard['users_voted'] = {str(user_id): None for user_id in shard.get('users_voted', [])}
+        if 'user_choices' in shard:
+            shard['user_choices'] = {str(user_id): choice for user_id, choice in shard['user_choices'].items()}
+        return shard
+
+    def shard_path(self, chat_id):
+        return os.path.join(self.path, 'chats', f'{chat_id}.pkl')
+
+    def has_shard(self, chat_id):
+        return chat_id in self.shards or os.path.exists(self.shard_path(chat_id))
+
+    def shard(self, chat_id):
+        '''
+        Get the objects of a chat, loading them from disk if needed.
+        '''
+        chat_id = str(chat_id)
+        with self.lock:
+            self.last_access[chat_id] = time.monotonic()
+            if chat_id in self.shards:
+                self.shards.move_to_end(chat_id)
+                return self.shards[chat_id]
+            shard = {}
+            if os.path.exists(self.shard_path(chat_id)):
+                with open(self.shard_path(chat_id), 'rb') as f:
+                    data = f.read()
+                shard = self.upgrade(pickle.loads(data))
+                self.sizes[chat_id] = len(data)
+            self.shards[chat_id] = shard
+            self.evict()
+            return shard
+
+    def evict(self):
+        '''
+        Remove least recently used chats from memory while over the memory budget.
+        Dirty chats are kept until they are saved (and their file written), and recently used chats
+        are always kept.
+        '''
+        total = sum(self.sizes.get(chat_id, 0) for chat_id in self.shards)
+        now = time.monotonic()
+        for chat_id in list(self.shards)[:-1]:
+            if total <= self.memory_budget or now - self.last_access.get(chat_id, 0) < self.min_idle:
+                break
+            if chat_id not in self.dirty and chat_id not in self.saving:
+                total -= self.sizes.pop(chat_id, 0)
+                del self.shards[chat_id]
+                self.last_access.pop(chat_id, None)
+
+    def journal_path(self, generation):
+        return os.path.join(self.path, f'journal.{generation}.log')
+
+    def journal_generations(self):
+        '''
+        Get generations of the journal files in mem folder, in order.
+        '''
+        generations = []
+        for name in os.listdir(self.path):
+            match = re.fullmatch(r"journal\.([0-9]+)\.log", name)
+            if match is not None:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    def replay(self, path):
+        '''
+        Apply journal records to memory. A torn record at the end (from a crash) is ignored.
+        '''
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    chat_id, state = pickle.load(f)
+                except Exception:
+                    break
+                if chat_id is None:
+                    tt, title, cached_at = state
+                    self.title_cache[tt] = (title, cached_at)
+                    self.titles_dirty = True
+                else:
+                    self.apply(chat_id, state)
+
+    def apply(self, chat_id, state):
+        '''
+        Set the state of a chat.
+        '''
+        chat_id = str(chat_id)
+        polls = state.pop('polls')
+        self.shards[chat_id] = self.upgrade(state)
+        self.dirty.add(chat_id)
+        self.set_polls(chat_id, polls)
+
+    def set_polls(self, chat_id, polls):
+        '''
+        Set the polls of a chat in the poll index. Call with lock held.
+        '''
+        for poll_id in self.chat_polls.pop(chat_id, []):
+            self.poll_chats.pop(poll_id, None)
+        for poll_id in polls:
+            self.poll_chats[poll_id] = chat_id
+        if len(polls) > 0:
+            self.chat_polls[chat_id] = list(polls)
+
+    def chat_state(self, chat_id):
+        '''
+        Get the state of a chat, as saved in a journal record.
+        '''
+        state = dict(self.shard(chat_id))
+        state['polls'] = list(self.chat_polls.get(str(chat_id), []))
+        return state
+
+    def sync_mem(self, chat_id=None):
+        '''
+        Sync memory with mem folder.
+        If chat_id is given, only the state of that chat is appended to the journal.
+        Otherwise, all changed chats are saved.
+        '''
+        if chat_id is None:
+            self.compact()
+            return
+        chat_id = str(chat_id)
+        with self.lock:
+            data = pickle.dumps((chat_id, self.chat_state(chat_id)))
+            self.journal.write(data)
+            self.journal.flush()
+            self.sizes[chat_id] = len(data)
+            self.dirty.add(chat_id)
+            self.unsynced = True
+            self.records += 1
+
+    def compact(self):
+        '''
+        Save changed chats and the poll index, and start a new journal.
+        Older journals are removed.
+        '''
+        with self.compact_lock:
+            self.save_shards()
+
+    def save_shards(self):
+        '''
+        Save dirty chats, then the poll index with the new journal generation.
+        '''
+        with self.lock:
+            shards = {}
+            for chat_id in self.dirty:
+                for _ in range(3):
+                    try:
+                        shards[chat_id] = pickle.dumps(self.shards[chat_id])
+                        break
+                    except RuntimeError:
+                        # a handler changed the chat while it was being pickled
+                        time.sleep(0.01)
+                else:
+                    return
+            index = pickle.dumps({'generation': self.generation + 1, 'poll_chats': self.poll_chats})
+            titles = pickle.dumps(self.title_cache) if self.titles_dirty else None
+            self.titles_dirty = False
+            old_generation = self.generation
+            if self.journal is not None:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+            self.generation += 1
+            self.journal = open(self.journal_path(self.generation), 'ab')
+            self.saving.update(shards)
+            self.dirty.clear()
+            self.unsynced = False
+            self.records = 0
+        try:
+            for chat_id, data in shards.items():
+                write_atomic(self.shard_path(chat_id), data)
+        finally:
+            with self.lock:
+                self.saving.difference_update(shards)
+        if titles is not None:
+            write_atomic(os.path.join(self.path, 'title_cache.pkl'), titles)
+        write_atomic(os.path.join(self.path, 'index.pkl'), index)
+        for generation in self.journal_generations():
+            if generation <= old_generation:
+                os.remove(self.journal_path(generation))
+        with self.lock:
+            self.evict()
+
+    def flush(self):
+        '''
+        Make sure all journal records are on disk.
+        '''
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.journal.fileno())
+                self.unsynced = False
+
+    def flush_loop(self):
+        '''
+        Batch journal fsyncs and save changed chats in the background.
+        '''
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.flush()
+                if self.records >= self.snapshot_every:
+                    self.compact()
+            except Exception as e:
+                print(e)
+
+    def reset(self, names):
+        '''
+        Remove objects from all chats, loading each chat from disk.
+        '''
+        with self.lock:
+            for chat_id in self.chat_ids():
+                shard = self.shard(chat_id)
+                for name in names:
+                    shard.pop(name, None)
+                self.dirty.add(chat_id)
+            if 'poll' in names:
+                self.poll_chats = {}
+                self.chat_polls = {}
+        self.sync_mem()
+
+    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+        with self.lock:
+            self.shard(chat_id).setdefault('user_choices', {})[str(user_id)] = {
+                'username': username,
+                'tt': tt,
+                'url': url,
+                'title': title
+            }
+            self.sync_mem(chat_id)
+        return (unique_id, str(user_id), str(chat_id), username, tt, url, title)
+
+    def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+        chat_id, user_id = split_unique_id(unique_id)
+        with self.lock:
+            choice = self.shard(chat_id).get('user_choices', {}).get(user_id)
+            if choice is None or choice['tt'] != tt:
+                return False
+            choice['title'] = title
+            self.sync_mem(chat_id)
+            return True
+
+    def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        chat_id, user_id = split_unique_id(unique_id)
+        with self.lock:
+            if self.shard(chat_id).get('user_choices', {}).pop(user_id, None) is None:
+                return False
+            self.sync_mem(chat_id)
+            return True
+
+    def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.lock:
+            choices = self.shard(chat_id).get('user_choices', {})
+            vetoed = [user_id for user_id, choice in choices.items() if choice['title'] == title]
+            if len(vetoed) == 0:
+                return False
+            for user_id in vetoed:
+                del choices[user_id]
+            self.sync_mem(chat_id)
+            return True
+
+    def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices from memory. Returns True if successful, False otherwise.
+        '''
+        with self.lock:
+            shard = self.shard(chat_id)
+            poll = shard.get('poll')
+            result = len(shard.get('user_choices', {})) > 0 or len(shard.get('users_voted', {})) > 0 \
+                or len(shard.get('poll_counts', [])) > 0 or poll is not None
+            shard['user_choices'] = {}
+            shard['users_voted'] = {}
+            shard['poll_counts'] = []
+            if poll is not None:
+                shard['poll'] = poll[:2] + (False,)
+            self.sync_mem(chat_id)
+            return result
+
+    def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+        with self.lock:
+            return [(get_unique_id(chat_id, user_id), user_id, str(chat_id), choice.get('username'),
+                choice['tt'], choice['url'], choice['title'])
+                for user_id, choice in self.shard(chat_id).get('user_choices', {}).items()]
+
+    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        '''
+        chat_id = str(chat_id)
+        with self.lock:
+            shard = self.shard(chat_id)
+            shard['poll'] = (poll_id, str(msg_id), True)
+            shard['users_voted'] = {}
+            shard['poll_counts'] = [[title, 0] for title in titles]
+            self.set_polls(chat_id, [poll_id])
+            if shard.get('enable_results', False):
+                results = shard.setdefault('results', {})
+                for tt in tts:
+                    result = results.setdefault(tt, {
+                        'url': imdb_url(tt),
+                        'title': titles[tts.index(tt)],
+                        'polls_count': 0,
+                        'votes_count': 0,
+                        'wins_count': 0,
+                        'last_poll': None,
+                        'last_win': None
+                    })
+                    result['polls_count'] += 1
+                    result['last_poll'] = datetime.date.today()
+            self.sync_mem(chat_id)
+        return (chat_id, poll_id, str(msg_id), True)
 
-        self.initialize_database()
-    
-    def reset_prefs(self):
+    def get_poll(self, chat_id):
         '''
-        Reset enable_results table.
+        Get the polls row of a chat, or None if the chat never had a poll.
         '''
-        self.cursor.execute("DROP TABLE enable_results;")
-        self.connection.commit()
+        with self.lock:
+            poll = self.shard(chat_id).get('poll')
+        if poll is None:
+            return None
+        return (str(chat_id),) + poll
 
-        self.initialize_database()
+    def active_poll_row(self, poll_id):
+        '''
+        Get the chat and polls row of an active poll, or None if the poll is not active.
+        '''
+        with self.lock:
+            chat_id = self.poll_chats.get(poll_id)
+            if chat_id is None:
+                return None
+            poll = self.get_poll(chat_id)
+        if poll is None or poll[1] != poll_id or not poll[3]:
+            return None
+        return poll
+
+    def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+        poll = self.active_poll_row(poll_id)
+        if poll is None:
+            return None
+        return poll[0]
+
+    def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+        poll = self.active_poll_row(poll_id)
+        if poll is None:
+            return None
+        return poll[2]
+
+    def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+        with self.lock:
+            return [(option_id, count, title)
+                for option_id, (title, count) in enumerate(self.shard(chat_id).get('poll_counts', []))]
+
+    def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+        with self.lock:
+            return list(self.shard(chat_id).get('users_voted', {}).items())
+
+    def count_vote(self, shard, option_id, change):
+        '''
+        Add change to the count of an option, and to its results if enabled.
+        '''
+        counts = shard.get('poll_counts', [])
+        if option_id is None or option_id >= len(counts):
+            return
+        counts[option_id][1] += change
+        if shard.get('enable_results', False):
+            results = shard.get('results', {})
+            tts = set(choice['tt'] for choice in shard.get('user_choices', {}).values()
+                if choice['title'] == counts[option_id][0])
+            for tt in tts:
+                if tt in results:
+                    results[tt]['votes_count'] += change
+
+    def poll_complete(self, shard):
+        '''
+        Check if all users in user_choices (except extra choices) are present in users_voted.
+        '''
+        users_voted = shard.get('users_voted', {})
+        return all(user_id in users_voted for user_id in shard.get('user_choices', {})
+            if user_id not in NON_VOTING_USER_IDS)
+
+    def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None.
+        Updates users_voted, poll_counts and results, then checks if the poll is complete.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+        with self.lock:
+            shard = self.shard(chat_id)
+            users_voted = shard.setdefault('users_voted', {})
+            if str(user_id) in users_voted:
+                self.count_vote(shard, users_voted.pop(str(user_id)), -1)
+            if option_id is not None:
+                users_voted[str(user_id)] = option_id
+                self.count_vote(shard, option_id, 1)
+            self.sync_mem(chat_id)
+            counts = self.get_poll_counts(chat_id)
+            return counts, len(counts) > 0 and self.poll_complete(shard)
+
+    def check_user_vote(self, chat_id, user_id):
+        '''
+        Check if user has voted.
+        '''
+        with self.lock:
+            return str(user_id) in self.shard(chat_id).get('users_voted', {})
+
+    def check_poll_complete(self, chat_id):
+        '''
+        Check if poll is complete.
+        If all users in user_choices are present in users_voted, return True. False otherwise.
+        '''
+        with self.lock:
+            return self.poll_complete(self.shard(chat_id))
+
+    def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts.
+        '''
+        with self.lock:
+            shard = self.shard(chat_id)
+            if shard.get('poll') is not None:
+                shard['poll'] = shard['poll'][:2] + (False,)
+            shard['user_choices'] = {}
+            shard['users_voted'] = {}
+            shard['poll_counts'] = []
+            self.sync_mem(chat_id)
+
+    def results_win(self, chat_id, title):
+        '''
+        Register win for a movie.
+        '''
+        with self.lock:
+            shard = self.shard(chat_id)
+            for choice in shard.get('user_choices', {}).values():
+                if choice['title'] == title:
+                    result = shard.get('results', {}).get(choice['tt'])
+                    if result is not None:
+                        result['wins_count'] += 1
+                        result['last_win'] = datetime.date.today()
+                        self.sync_mem(chat_id)
+                    return
+
+    def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat. Returns True if it changed, False if it was already set.
+        '''
+        with self.lock:
+            shard = self.shard(chat_id)
+            if shard.get('enable_results', False) == enabled:
+                return False
+            shard['enable_results'] = enabled
+            self.sync_mem(chat_id)
+            return True
+
+    def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat.
+        '''
+        with self.lock:
+            return self.shard(chat_id).get('enable_results', False)
+
+    def get_results(self, chat_id):
+        '''
+        Get results for a chat.
+        '''
+        with self.lock:
+            return [(get_unique_id(chat_id, tt), str(chat_id), tt, result['url'], result['title'],
+                result['polls_count'], result['votes_count'], result['wins_count'],
+                result['last_poll'], result['last_win'])
+                for tt, result in self.shard(chat_id).get('results', {}).items()]
+
+    def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat. Returns True if there were results, False otherwise.
+        '''
+        with self.lock:
+            if len(self.shard(chat_id).pop('results', {})) == 0:
+                return False
+            self.sync_mem(chat_id)
+            return True
+
+    def chat_ids(self):
+        '''
+        Get the ids of the chats in memory or on disk. Call with lock held.
+        '''
+        return set(self.shards) | {name[:-len('.pkl')]
+            for name in os.listdir(os.path.join(self.path, 'chats')) if name.endswith('.pkl')}
+
+    def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats,
+        loading each chat from disk. Choices have a polls_count of 0.
+        '''
+        rows = []
+        with self.lock:
+            for chat_id in self.chat_ids():
+                shard = self.shard(chat_id)
+                for tt, result in shard.get('results', {}).items():
+                    rows.append((chat_id, tt, result['title'], result['polls_count']))
+                for choice in shard.get('user_choices', {}).values():
+                    if choice['tt'] is not None:
+                        rows.append((chat_id, choice['tt'], choice['title'], 0))
+        return rows
+
+    def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat, loading each chat from disk.
+        '''
+        rows = set()
+        with self.lock:
+            for chat_id in self.chat_ids():
+                shard = self.shard(chat_id)
+                for user_id in list(shard.get('user_choices', {})) + list(shard.get('users_voted', {})):
+                    rows.add((user_id, chat_id))
+        return list(rows)
+
+    def reset_database(self):
+        '''
+        Delete all choices, votes and polls.
+        '''
+        self.reset(['user_choices', 'users_voted', 'poll', 'poll_counts'])
+
+    def reset_prefs(self):
+        '''
+        Delete results preferences of all chats.
+        '''
+        self.reset(['enable_results'])
 
     def reset_results(self):
         '''
-        Reset results database.
+        Delete results of all chats.
         '''
-        self.cursor.execute("DROP TABLE results;")
-        self.connection.commit()
+        self.reset(['results'])
 
-        self.initialize_database()
+    def load_title_cache(self):
+        '''
+        Load title cache from mem folder. Kept apart from the other objects,
+        so that it survives memory resets.
+        '''
+        if os.path.exists(os.path.join(self.path, 'title_cache.pkl')):
+            with open(os.path.join(self.path, 'title_cache.pkl'), 'rb') as f:
+                self.title_cache = pickle.load(f)
+        else:
+            self.title_cache = {}
 
-# classes
-class local_mem:
+    def get_cached_title(self, tt):
+        '''
+        Get cached title for tt. Returns (title, cached_at) if cached, None otherwise.
+        '''
+        return self.title_cache.get(tt)
+
+    def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in title cache, through the journal.
+        '''
+        with self.lock:
+            self.title_cache[tt] = (title, cached_at)
+            self.journal.write(pickle.dumps((None, (tt, title, cached_at))))
+            self.journal.flush()
+            self.titles_dirty = True
+            self.unsynced = True
+            self.records += 1
+
+class cached_mem(storage):
     '''
-    Bot "memory". Synced to local files.
+    Write-behind cache on top of another storage (mem).
+    The current state of a chat (choices, poll, poll counts and votes) is read from mem on first
+    access and then served from memory. Changes are made in memory right away and queued, and a
+    background thread writes them to mem in batches of up to batch_size, every flush_interval seconds.
+    Queued changes to the same choice, or to the vote of the same user, are coalesced as long as no
+    other change to the chat was queued in between that depends on them (e.g. a new poll).
+    Other calls (results, preferences) write the queue to mem first. The queue is written on exit.
+    Up to max_chats chats are kept in memory; chats with queued changes are never dropped.
     '''
-    def __init__(self):
-        self.load_mem()
-    
-    def create_mem(self):
+
+    def __init__(self, mem, flush_interval=0.5, batch_size=100, max_chats=1024):
+        self.mem = mem
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.polls = {}
+        self.queue = deque()
+        self.keys = defaultdict(dict)
+        self.pending = defaultdict(int)
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self.flush_loop, name='cached_mem_flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def chat(self, chat_id):
         '''
-        Create memory. Objects are pickle files.
+        Get the cached state of a chat, reading it from mem if needed.
         '''
-        if os.path.isdir('mem') == False:
-            os.mkdir('mem')	
-        self.user_choices = defaultdict(dict)
-        self.users_voted = defaultdict(dict)
-        self.last_poll = defaultdict(dict)
-        self.poll_chats = {}
-        self.poll_counts = defaultdict(dict)
-        self.sync_mem()
+        chat_id = str(chat_id)
+        with self.lock:
+            if chat_id in self.chats:
+                self.chats.move_to_end(chat_id)
+                return self.chats[chat_id]
+            poll = self.mem.get_poll(chat_id)
+            chat = {
+                'choices': OrderedDict((row[0], tuple(row)) for row in self.mem.get_choices(chat_id)),
+                'poll': tuple(poll) if poll is not None else None,
+                'counts': [list(row) for row in self.mem.get_poll_counts(chat_id)],
+                'votes': dict(self.mem.get_votes(chat_id))
+            }
+            if poll is not None:
+                self.polls[poll[1]] = chat_id
+            self.chats[chat_id] = chat
+            self.evict()
+            return chat
 
-    def load_mem(self):
+    def evict(self):
+        '''
+        Drop least recently used chats without queued changes while over max_chats.
+        '''
+        for chat_id in list(self.chats)[:-1]:
+            if len(self.chats) <= self.max_chats:
+                break
+            if self.pending[chat_id] == 0:
+                poll = self.chats.pop(chat_id)['poll']
+                if poll is not None:
+                    self.polls.pop(poll[1], None)
+                del self.pending[chat_id]
+                self.keys.pop(chat_id, None)
+
+    def write(self, chat_id, name, args, key=None):
+        '''
+        Queue a call to mem. A queued call with the same key is dropped, since the new call
+        replaces its effect. Calls without a key are not coalesced, and later calls are not
+        coalesced with the ones queued before them.
         '''
-        Load memory from mem folder. Objects are pickle files.
-        '''
-        if os.path.exists('mem/user_choices.pkl') and \
-            os.path.exists('mem/users_voted.pkl') and \
-                os.path.exists('mem/last_poll.pkl') and \
-                    os.path.exists('mem/poll_chats.pkl') and \
-                        os.path.exists('mem/poll_counts.pkl'):
-            with open('mem/user_choices.pkl', 'rb') as f:
-                self.user_choices = pickle.load(f)
-            with open('mem/users_voted.pkl', 'rb') as f:
-                self.users_voted = pickle.load(f)
-            with open('mem/last_poll.pkl', 'rb') as f:
-                self.last_poll = pickle.load(f)
-            with open('mem/poll_chats.pkl', 'rb') as f:
-                self.poll_chats = pickle.load(f)
-            with open('mem/poll_counts.pkl', 'rb') as f:
-                self.poll_counts = pickle.load(f)
+        chat_id = str(chat_id)
+        call = [name, args]
+        keys = self.keys[chat_id]
+        if key is None:
+            keys.clear()
         else:
-            self.create_mem()
+            old = keys.get(key)
+            if old is not None and old[0] is not None:
+                old[0] = None
+                self.pending[chat_id] -= 1
+            keys[key] = call
+        self.queue.append((chat_id, call))
+        self.pending[chat_id] += 1
+
+    def flush(self):
+        '''
+        Write queued changes to mem, in batches.
+        '''
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                    calls = []
+                    for chat_id, call in batch:
+                        if call[0] is not None:
+                            calls.append((chat_id, call[0], call[1]))
+                            # taken calls can not be dropped anymore
+                            call[0] = None
+                if len(batch) == 0:
+                    break
+                for chat_id, name, args in calls:
+                    try:
+                        getattr(self.mem, name)(*args)
+                    except Exception as e:
+                        print(e)
+                    with self.lock:
+                        self.pending[chat_id] -= 1
+            self.mem.flush()
+
+    def flush_loop(self):
+        '''
+        Write queued changes in the background.
+        '''
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+
+    def add_choice(self, unique_id, user_id, chat_id, username, tt, url, title):
+        '''
+        Add choice to memory. Returns the saved row.
+        '''
+        row = (unique_id, str(user_id), str(chat_id), username, tt, url, title)
+        with self.lock:
+            self.chat(chat_id)['choices'][unique_id] = row
+            self.write(chat_id, 'add_choice', row, ('choice', unique_id))
+        return row
+
+    def update_title(self, unique_id, tt, title):
+        '''
+        Replace the placeholder title of a choice, if the choice is still tt.
+        '''
+        chat_id, _ = split_unique_id(unique_id)
+        with self.lock:
+            choices = self.chat(chat_id)['choices']
+            row = choices.get(unique_id)
+            if row is None or row[4] != tt:
+                return False
+            choices[unique_id] = row[:6] + (title,)
+            self.write(chat_id, 'update_title', (unique_id, tt, title), ('title', unique_id))
+            return True
+
+    def delete_choice(self, unique_id):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        chat_id, _ = split_unique_id(unique_id)
+        with self.lock:
+            if self.chat(chat_id)['choices'].pop(unique_id, None) is None:
+                return False
+            self.write(chat_id, 'delete_choice', (unique_id,), ('choice', unique_id))
+            return True
+
+    def delete_by_title(self, chat_id, title):
+        '''
+        Delete choice from memory. Returns True if successful, False otherwise.
+        '''
+        with self.lock:
+            choices = self.chat(chat_id)['choices']
+            vetoed = [unique_id for unique_id, row in choices.items() if row[6] == title]
+            if len(vetoed) == 0:
+                return False
+            for unique_id in vetoed:
+                del choices[unique_id]
+            self.write(chat_id, 'delete_by_title', (str(chat_id), title))
+            return True
+
+    def delete_all_choices(self, chat_id):
+        '''
+        Delete all choices from memory. Returns True if successful, False otherwise.
+        '''
+        with self.lock:
+            chat = self.chat(chat_id)
+            result = len(chat['choices']) > 0 or len(chat['votes']) > 0 or len(chat['counts']) > 0 \
+                or chat['poll'] is not None
+            chat['choices'].clear()
+            chat['votes'].clear()
+            chat['counts'] = []
+            if chat['poll'] is not None:
+                chat['poll'] = chat['poll'][:3] + (False,)
+            self.write(chat_id, 'delete_all_choices', (str(chat_id),))
+            return result
+
+    def get_choices(self, chat_id):
+        '''
+        Get choices for a chat.
+        '''
+        with self.lock:
+            return list(self.chat(chat_id)['choices'].values())
+
+    def add_poll(self, chat_id, poll_id, msg_id, titles, tts):
+        '''
+        Add poll to memory. Returns the saved polls row.
+        '''
+        poll = (str(chat_id), poll_id, str(msg_id), True)
+        with self.lock:
+            chat = self.chat(chat_id)
+            if chat['poll'] is not None:
+                self.polls.pop(chat['poll'][1], None)
+            chat['poll'] = poll
+            chat['counts'] = [[option_id, 0, title] for option_id, title in enumerate(titles)]
+            chat['votes'] = {}
+            self.polls[poll_id] = str(chat_id)
+            self.write(chat_id, 'add_poll', (str(chat_id), poll_id, msg_id, list(titles), list(tts)))
+        return poll
+
+    def get_poll(self, chat_id):
+        '''
+        Get the polls row of a chat, or None if the chat never had a poll.
+        '''
+        with self.lock:
+            return self.chat(chat_id)['poll']
+
+    def active_poll_row(self, poll_id):
+        '''
+        Get the polls row of an active poll, or None if the poll is not active.
+        '''
+        with self.lock:
+            chat_id = self.polls.get(poll_id)
+        if chat_id is None:
+            chat_id = self.mem.get_chat_from_poll(poll_id)
+            if chat_id is None:
+                return None
+        poll = self.get_poll(chat_id)
+        if poll is None or poll[1] != poll_id or not poll[3]:
+            return None
+        return poll
+
+    def get_chat_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns chat_id if exists, None otherwise.
+        '''
+        poll = self.active_poll_row(poll_id)
+        if poll is None:
+            return None
+        return poll[0]
+
+    def get_msg_from_poll(self, poll_id):
+        '''
+        Check if poll exists. Returns msg_id if exists, None otherwise.
+        '''
+        poll = self.active_poll_row(poll_id)
+        if poll is None:
+            return None
+        return poll[2]
+
+    def get_poll_counts(self, chat_id):
+        '''
+        Get poll counts for a chat, as (option_id, count, title).
+        '''
+        with self.lock:
+            return [tuple(option) for option in self.chat(chat_id)['counts']]
+
+    def get_votes(self, chat_id):
+        '''
+        Get votes of the current poll of a chat, as (user_id, option_id).
+        '''
+        with self.lock:
+            return list(self.chat(chat_id)['votes'].items())
+
+    def poll_complete(self, chat):
+        '''
+        Check if all users in choices (except extra choices) have voted.
+        '''
+        return all(row[1] in chat['votes'] for row in chat['choices'].values()
+            if row[1] not in NON_VOTING_USER_IDS)
+
+    def vote(self, chat_id, user_id, option_id):
+        '''
+        Register vote, or retract it if option_id is None.
+        Returns poll counts as a list of (option_id, count, title) and True if the poll is complete.
+        '''
+        with self.lock:
+            chat = self.chat(chat_id)
+            counts = chat['counts']
+            old = chat['votes'].pop(str(user_id), None)
+            if old is not None and old < len(counts):
+                counts[old][1] -= 1
+            if option_id is not None:
+                chat['votes'][str(user_id)] = option_id
+                if option_id < len(counts):
+                    counts[option_id][1] += 1
+            self.write(chat_id, 'vote', (str(chat_id), str(user_id), option_id), ('vote', str(user_id)))
+            return [tuple(option) for option in counts], len(counts) > 0 and self.poll_complete(chat)
+
+    def check_user_vote(self, chat_id, user_id):
+        '''
+        Check if user has voted.
+        '''
+        with self.lock:
+            return str(user_id) in self.chat(chat_id)['votes']
+
+    def check_poll_complete(self, chat_id):
+        '''
+        Check if poll is complete.
+        If all users in user_choices are present in users_voted, return True. False otherwise.
+        '''
+        with self.lock:
+            return self.poll_complete(self.chat(chat_id))
+
+    def end_poll(self, chat_id):
+        '''
+        Disable poll and delete all choices, users_voted and poll_counts.
+        '''
+        with self.lock:
+            chat = self.chat(chat_id)
+            if chat['poll'] is not None:
+                chat['poll'] = chat['poll'][:3] + (False,)
+            chat['choices'].clear()
+            chat['votes'].clear()
+            chat['counts'] = []
+            self.write(chat_id, 'end_poll', (str(chat_id),))
+
+    def results_win(self, chat_id, title):
+        '''
+        Register win for a movie. Queued, since it needs the choices of the poll.
+        '''
+        with self.lock:
+            self.chat(chat_id)
+            self.write(chat_id, 'results_win', (str(chat_id), title))
+
+    def set_results(self, chat_id, enabled):
+        '''
+        Set results flag for a chat, after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.set_results(chat_id, enabled)
+
+    def results_enabled(self, chat_id):
+        '''
+        Check if results are enabled for a chat, after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.results_enabled(chat_id)
 
-    def sync_mem(self):
+    def get_results(self, chat_id):
+        '''
+        Get results for a chat, after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.get_results(chat_id)
+
+    def clear_results(self, chat_id):
+        '''
+        Remove all results from given chat, after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.clear_results(chat_id)
+
+    def get_stored_titles(self):
+        '''
+        Get (chat_id, tt, title, polls_count) of the movies in results and choices of all chats,
+        after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.get_stored_titles()
+
+    def get_chat_members(self):
+        '''
+        Get (user_id, chat_id) of the users with a choice or a vote in each chat, after writing queued changes.
+        '''
+        self.flush()
+        return self.mem.get_chat_members()
+
+    def get_cached_title(self, tt):
+        '''
+        Get cached title for tt from mem.
+        '''
+        return self.mem.get_cached_title(tt)
+
+    def cache_title(self, tt, title, cached_at):
+        '''
+        Save title for tt in the title cache of mem.
+        '''
+        self.mem.cache_title(tt, title, cached_at)
+
+    def reset(self, name):
+        '''
+        Write queued changes, call a reset method of mem and drop all cached chats.
+        '''
+        self.flush()
+        with self.lock:
+            getattr(self.mem, name)()
+            self.chats.clear()
+            self.polls.clear()
+
+    def reset_database(self):
+        '''
+        Delete all choices, votes and polls.
+        '''
+        self.reset('reset_database')
+
+    def reset_prefs(self):
+        '''
+        Delete results preferences of all chats.
+        '''
+        self.reset('reset_prefs')
+
+    def reset_results(self):
         '''
-        Sync memory with mem folder. Objects are pickle files.
+        Delete results of all chats.
         '''
-        with open('mem/user_choices.pkl', 'wb') as f:
-            pickle.dump(self.user_choices, f)
-        with open('mem/users_voted.pkl', 'wb') as f:
-            pickle.dump(self.users_voted, f)
-        with open('mem/last_poll.pkl', 'wb') as f:
-            pickle.dump(self.last_poll, f)
-        with open('mem/poll_chats.pkl', 'wb') as f:
-            pickle.dump(self.poll_chats, f)
-        with open('mem/poll_counts.pkl', 'wb') as f:
-            pickle.dump(self.poll_counts, f)
+        self.reset('reset_results')